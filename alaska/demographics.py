@@ -0,0 +1,70 @@
+"""
+Majority-minority districts for whole ensembles. Any number of population columns (AMINPOP20,
+BVAP20, HVAP20, ...) are summed by district with one group-sum over the assignment arrays, so each
+district's share of each group, and the number of districts where a group is the majority, come out
+for many plans at once.
+"""
+import numpy as np
+
+from metrics import BATCH_SIZE, assignment_array
+
+
+class DemographicScorer:
+    """
+    District-level demographics over a fixed node order. ``groups`` maps a group name to its
+    per-node population array and ``total`` is the per-node total population the shares are taken
+    of (e.g. TOTPOP20 for AMINPOP20, VAP20 for BVAP20).
+    """
+
+    def __init__(self, nodes, groups, total):
+        self.nodes = list(nodes)
+        self.group_names = list(groups)
+        # (nodes x groups), so one pass over the plans sums every group
+        self.values = np.column_stack([np.asarray(groups[name], dtype=np.float64)
+                                       for name in self.group_names])
+        self.total = np.asarray(total, dtype=np.float64)
+
+    @classmethod
+    def from_graph(cls, graph, group_cols, total_col):
+        """Read ``group_cols`` (names of node attributes) and ``total_col`` off a graph's nodes."""
+        nodes = list(graph.nodes)
+        groups = {col: [graph.nodes[n][col] for n in nodes] for col in group_cols}
+        return cls(nodes, groups, [graph.nodes[n][total_col] for n in nodes])
+
+    def district_totals(self, plans, num_districts):
+        """
+        ``(groups, totals)``: the (plans x districts x groups) population of each group and the
+        (plans x districts) total population of each district.
+        """
+        a = assignment_array(self.nodes, plans, num_districts)
+        groups = np.empty((len(a), num_districts, len(self.group_names)))
+        totals = np.empty((len(a), num_districts))
+        for start in range(0, len(a), BATCH_SIZE):
+            batch = a[start:start + BATCH_SIZE]
+            # Number the districts of plan p as p * num_districts + district so one bincount
+            # handles the whole batch
+            ids = (batch + (np.arange(len(batch)) * num_districts)[:, None]).ravel()
+            size = len(batch) * num_districts
+            rows = slice(start, start + len(batch))
+            totals[rows] = np.bincount(ids, np.tile(self.total, len(batch)), size) \
+                .reshape(len(batch), num_districts)
+            for g in range(len(self.group_names)):
+                groups[rows, :, g] = np.bincount(ids, np.tile(self.values[:, g], len(batch)),
+                                                 size).reshape(len(batch), num_districts)
+        return groups, totals
+
+    def shares(self, plans, num_districts):
+        """(plans x districts x groups) fraction of each district's population in each group."""
+        groups, totals = self.district_totals(plans, num_districts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return groups / totals[:, :, None]
+
+    def majority_counts(self, plans, num_districts, threshold = 0.5):
+        """
+        (plans x groups) number of districts in which each group is more than ``threshold`` of the
+        population. For a single plan dictionary, a ``{group: count}`` dictionary instead.
+        """
+        counts = (self.shares(plans, num_districts) > threshold).sum(axis=1)
+        if isinstance(plans, dict) or np.ndim(plans) == 1:
+            return dict(zip(self.group_names, counts[0].tolist()))
+        return counts
@@ -1,15 +1,33 @@
+import os
+import sys
 import warnings
-import matplotlib.pyplot as plt
-from gerrychain import Graph
-from gerrychain.tree import recursive_tree_part
-import networkx as nx
+from functools import partial
+# Races recursive_tree_part attempts in worker processes
+from seeding import seed_plan
+# Cut edges and other plan metrics over NumPy edge arrays
+from metrics import EdgeMetrics
+# Share of each district's population in a demographic group
+from demographics import DemographicScorer
+# Draws plans from precomputed coordinate and edge arrays
+from render import PlanRenderer
+
+# Shared helpers live next to the Pennsylvania chain
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recombination"))
+from graph_cache import load_graph # pylint: disable=wrong-import-position
+# gerrychain's bipartition_tree on NumPy arrays
+from bipartition import bipartition_tree_csr # pylint: disable=wrong-import-position
+# Node attributes read from the cached column files, shared by the seeding workers
+from shared_attrs import shared_graph # pylint: disable=wrong-import-position
 
 warnings.filterwarnings("ignore") # Suppress bipartition warning
 
 # Make a districting plan with 20 districts (the number of seats in Alaska's State Senate) using the
 # recursive_tree_part function
 
-ak_graph = Graph.from_json("ak-bg-connected.json")
+# Parsing the JSON only happens on the first run; afterwards the attributes we use below are read
+# from .graph_cache
+ak_columns = ["TOTPOP20", "AMINPOP20", "INTPTLON20", "INTPTLAT20"]
+ak_graph = shared_graph(load_graph("ak-bg-connected.json", columns = ak_columns), ak_columns)
 # print(ak_graph.nodes()[0].keys())
 # dict_keys(['boundary_node', 'area', 'NWBHPOP20', 'AWATER20', 'VAP20', 'APAMIPOP20', 'FUNCSTAT20',
 # 'SUMLEV', 'NHPIPOP20', 'OTHERPOP20', 'WVAP20', 'STATEFP20', 'APAMIVAP20', 'OTHERVAP20', 'BPOP20',
@@ -40,42 +58,41 @@ total_pop = sum(list_of_pop)
 NUM_DIST = 20 # number of seats in Alaska's State Senate
 ideal_pop = total_pop/NUM_DIST
 
-# Try until a valid partition is found
-initial_plan = None
-
-while initial_plan is None:
-    try:
-        initial_plan = recursive_tree_part(ak_graph,
-                                           range(NUM_DIST),
-                                           ideal_pop,
-                                           'TOTPOP20',
-                                           0.02,
-                                           10)
-    except RuntimeError as e:
-        print(f"Error encountered: {e}. Retrying...")
-
-print("Successfully found a valid partition.")
+# recursive_tree_part sometimes fails with these settings, so race up to 200 attempts with
+# different seeds across all cores and keep the first plan found; give up after 10 minutes. Each
+# split draws its spanning trees and finds balanced cuts on arrays rather than networkx dicts
+initial_plan, seeding_stats = seed_plan(ak_graph,
+                                        range(NUM_DIST),
+                                        ideal_pop,
+                                        'TOTPOP20',
+                                        0.02,
+                                        10,
+                                        max_attempts = 200,
+                                        deadline = 600,
+                                        method = partial(bipartition_tree_csr,
+                                                         max_attempts = 10000))
+
+print(f"Successfully found a valid partition: {seeding_stats.summary()}")
 
 print(f"Districting plan: {initial_plan}")
 
 # Print the number of cutedges in this districting plan you've made
 
-cutedges = 0
-
-for e in ak_graph.edges():
-    if initial_plan[e[0]] != initial_plan[e[1]]:
-        cutedges = cutedges + 1
+# The edge list is turned into two arrays of node indices once; counting cut edges compares the
+# districts at both ends of every edge in one go (and works the same for a whole batch of plans)
+ak_metrics = EdgeMetrics.from_graph(ak_graph)
+cutedges = ak_metrics.cut_edges(initial_plan)
 
 print(f"Number of cutedges in redistricting plan: {cutedges}")
 
 # Compute and print the number of districts in their districting plan that have more than half their
 # population being Native American and Alaska Native
 
-AMIN_dists = 0
-for v in ak_graph.nodes():
-    dist = initial_plan[v]
-    if ak_graph.nodes()[v]['AMINPOP20'] > 0.5 * ak_graph.nodes()[v]['TOTPOP20']:
-        AMIN_dists += 1
+# Sum AMINPOP20 and TOTPOP20 over the nodes of each district, then count the districts where the
+# first is more than half of the second. Other groups (BPOP20, HISP20, ...) can be added to the
+# list, and a whole ensemble of plans can be passed at once instead of initial_plan
+ak_demographics = DemographicScorer.from_graph(ak_graph, ['AMINPOP20'], 'TOTPOP20')
+AMIN_dists = ak_demographics.majority_counts(initial_plan, NUM_DIST)['AMINPOP20']
 
 print(f"Number of Native American and Alaska Native Majority Districts: {AMIN_dists}")
 
@@ -83,12 +100,8 @@ print(f"Number of Native American and Alaska Native Majority Districts: {AMIN_di
 # the positions of the nodes reflect the latitude and longitude of the geographic region represented
 # by that node.
 
-# Get lat/lon to be fed into nx.draw
-node_locations = { v : ( float(ak_graph.nodes()[v]["INTPTLON20"]),
-                        float(ak_graph.nodes()[v]["INTPTLAT20"])) for v in ak_graph.nodes() }
-
-plt.figure()
-nx.draw(ak_graph, node_size = 10, node_color = [initial_plan[v] for v in ak_graph.nodes()],
-        pos = node_locations, cmap="tab20")
-plt.savefig("initial-plan.jpg")
+# Coordinates are parsed from the INTPTLON20/INTPTLAT20 strings once, and the edges and nodes are
+# drawn as one collection each; render.py can also draw a whole chain's plans as frames
+ak_renderer = PlanRenderer.from_graph(ak_graph, "INTPTLON20", "INTPTLAT20")
+ak_renderer.save(initial_plan, "initial-plan.jpg")
 print("Saved initial-plan.jpg")
@@ -0,0 +1,159 @@
+"""
+Cut edges, boundary nodes and Polsby-Popper scores computed with NumPy over an edge list.
+
+The graph's edges are turned into two int32 arrays of node indices once. A plan is then an array of
+district indices with one entry per node (a batch of plans is a 2-D array, one plan per row), and
+every metric is a handful of array operations over all edges of all plans at once instead of a
+Python loop over ``graph.edges()`` per plan.
+"""
+import numpy as np
+
+# Plans are scored this many at a time, which bounds the (plans x edges) temporary arrays
+BATCH_SIZE = 1024
+
+
+def assignment_array(nodes, plans, num_districts=None):
+    """
+    Turn a plan (node -> district dictionary) or a list of plans into a (plans x nodes) array of
+    district indices, with columns in the order of ``nodes``. District labels are numbered 0, 1,
+    ... in sorted order, so a plan numbered 1 to k gets indices 0 to k - 1. Arrays are taken to be
+    district indices already and passed through unchanged. With ``num_districts``, raises
+    ValueError unless every index is between 0 and ``num_districts - 1``.
+    """
+    if isinstance(plans, np.ndarray):
+        a = np.atleast_2d(plans)
+    else:
+        if isinstance(plans, dict):
+            plans = [plans]
+        labels = np.array([[plan[node] for node in nodes] for plan in plans])
+        _, inverse = np.unique(labels, return_inverse=True)
+        a = inverse.reshape(labels.shape)
+    if num_districts is not None and a.size and (a.min() < 0 or a.max() >= num_districts):
+        raise ValueError(f"Plans have district indices {a.min()} to {a.max()}, but with "
+                         f"{num_districts} districts they must be 0 to {num_districts - 1}")
+    return a
+
+
+class EdgeMetrics:
+    """
+    Plan metrics over a fixed graph. ``nodes`` gives the node order of assignment arrays and
+    ``u``/``v`` the endpoints (as indices into ``nodes``) of each edge.
+
+    For Polsby-Popper, ``area`` and ``boundary_perim`` are per-node arrays (area, and length of the
+    node's boundary on the outside of the state) and ``shared_perim`` is the per-edge length of the
+    boundary between the two endpoints, as gerrychain's ``Graph.from_file`` computes them.
+    """
+
+    def __init__(self, nodes, u, v, area=None, boundary_perim=None, shared_perim=None):
+        self.nodes = list(nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        self.u = np.asarray(u, dtype=np.int32)
+        self.v = np.asarray(v, dtype=np.int32)
+        self.area = None if area is None else np.asarray(area, dtype=np.float64)
+        self.boundary_perim = (None if boundary_perim is None
+                               else np.asarray(boundary_perim, dtype=np.float64))
+        self.shared_perim = (None if shared_perim is None
+                             else np.asarray(shared_perim, dtype=np.float64))
+
+    @classmethod
+    def from_graph(cls, graph, area_col=None, boundary_col=None, perim_col=None):
+        """Build the edge arrays (and optional geometry columns) from a networkx graph."""
+        nodes = list(graph.nodes)
+        index = {node: i for i, node in enumerate(nodes)}
+        edges = list(graph.edges)
+        u = np.fromiter((index[a] for a, _ in edges), dtype=np.int32, count=len(edges))
+        v = np.fromiter((index[b] for _, b in edges), dtype=np.int32, count=len(edges))
+        area = None if area_col is None else [graph.nodes[n][area_col] for n in nodes]
+        boundary = None if boundary_col is None else [graph.nodes[n][boundary_col] for n in nodes]
+        shared = None if perim_col is None else [graph.edges[e][perim_col] for e in edges]
+        return cls(nodes, u, v, area, boundary, shared)
+
+    @classmethod
+    def from_cached(cls, cached, area_col=None, boundary_col=None, perim_col=None):
+        """Same as from_graph, but straight from a graph_cache.CachedGraph's arrays."""
+        u, v = cached.edges()
+        return cls(cached.nodes.tolist(), u, v,
+                   area = None if area_col is None else cached[area_col],
+                   boundary_perim = None if boundary_col is None else cached[boundary_col],
+                   shared_perim = None if perim_col is None else cached.edge_values(perim_col))
+
+    def assignments(self, plans, num_districts=None):
+        """Plan(s) as a (plans x nodes) array of district indices; see assignment_array."""
+        return assignment_array(self.nodes, plans, num_districts)
+
+    def _batches(self, plans, num_districts=None):
+        a = self.assignments(plans, num_districts)
+        for start in range(0, len(a), BATCH_SIZE):
+            yield a[start:start + BATCH_SIZE]
+
+    def _single(self, plans, values):
+        # A single plan dictionary gets a single answer back
+        return values[0] if isinstance(plans, dict) or np.ndim(plans) == 1 else values
+
+    def cut_mask(self, plans):
+        """(plans x edges) boolean array: is each edge cut in each plan."""
+        a = self.assignments(plans)
+        return a[:, self.u] != a[:, self.v]
+
+    def cut_edges(self, plans):
+        """Number of cut edges of each plan."""
+        counts = np.concatenate([(a[:, self.u] != a[:, self.v]).sum(axis=1)
+                                 for a in self._batches(plans)])
+        return self._single(plans, counts)
+
+    def _by_district(self, a, num_districts, edge_weights=None):
+        """
+        For each plan, sum over cut edges of ``edge_weights`` into both endpoint districts:
+        a (plans x districts) array.
+        """
+        cut = a[:, self.u] != a[:, self.v]
+        weights = cut if edge_weights is None else cut * edge_weights
+        offsets = (np.arange(len(a)) * num_districts)[:, None]
+        size = len(a) * num_districts
+        totals = (np.bincount((a[:, self.u] + offsets).ravel(), weights.ravel(), size)
+                  + np.bincount((a[:, self.v] + offsets).ravel(), weights.ravel(), size))
+        return totals.reshape(len(a), num_districts)
+
+    def cut_edges_by_district(self, plans, num_districts):
+        """(plans x districts) number of cut edges touching each district."""
+        counts = np.concatenate([self._by_district(a, num_districts).astype(np.int64)
+                                 for a in self._batches(plans, num_districts)])
+        return self._single(plans, counts)
+
+    def boundary_nodes(self, plans):
+        """(plans x nodes) boolean array: does each node have a neighbor in another district."""
+        masks = []
+        for a in self._batches(plans):
+            cut = a[:, self.u] != a[:, self.v]
+            mask = np.zeros(a.shape, dtype=bool)
+            rows, edges = np.nonzero(cut)
+            mask[rows, self.u[edges]] = True
+            mask[rows, self.v[edges]] = True
+            masks.append(mask)
+        return self._single(plans, np.concatenate(masks))
+
+    def boundary_node_sets(self, plans):
+        """Boundary nodes of each plan as sets of node labels."""
+        masks = np.atleast_2d(self.boundary_nodes(plans))
+        sets = [{self.nodes[i] for i in np.flatnonzero(mask)} for mask in masks]
+        return self._single(plans, sets)
+
+    def polsby_popper(self, plans, num_districts):
+        """
+        (plans x districts) Polsby-Popper score 4*pi*area/perimeter**2 of each district. A
+        district's perimeter is the outer boundary of its nodes plus the shared boundary along its
+        cut edges.
+        """
+        if self.area is None or self.boundary_perim is None or self.shared_perim is None:
+            raise ValueError("Polsby-Popper needs area, boundary_perim and shared_perim columns")
+        scores = []
+        for a in self._batches(plans, num_districts):
+            offsets = (np.arange(len(a)) * num_districts)[:, None]
+            size = len(a) * num_districts
+            ids = (a + offsets).ravel()
+            area = np.bincount(ids, np.tile(self.area, len(a)), size)
+            outer = np.bincount(ids, np.tile(self.boundary_perim, len(a)), size)
+            perimeter = outer + self._by_district(a, num_districts, self.shared_perim).ravel()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores.append((4 * np.pi * area / perimeter**2).reshape(len(a), num_districts))
+        return self._single(plans, np.concatenate(scores))
@@ -0,0 +1,203 @@
+"""
+Draw districting plans fast enough to make movies of chains.
+
+nx.draw rebuilds everything (node positions from the attribute strings, one artist per call, the
+edges) for every picture. PlanRenderer does that work once: node coordinates go into an array,
+edges into a single LineCollection (or district shapes into a single PolyCollection), and drawing
+another plan only changes the colors of the existing artists before saving. For quick previews
+raster() skips matplotlib altogether and paints each node as a few pixels of a NumPy image.
+
+render_frames() saves a batch of plans (say every 100th step of a chain) as numbered PNGs using
+several worker processes.
+"""
+import multiprocessing as mp
+import os
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+
+from metrics import assignment_array
+
+
+class PlanRenderer:
+    """
+    Draws plans over a fixed set of nodes. ``x`` and ``y`` are the node coordinates (e.g.
+    longitude and latitude) in the order of ``nodes``, ``u``/``v`` optional edge endpoints as node
+    indices, and ``polygons`` an optional ``(rings, owner)`` pair: a list of (points x 2) arrays
+    and, for each ring, the index of the node it belongs to (see from_shapefile). Districts are
+    colored ``cmap(district % cmap.N)``.
+    """
+
+    def __init__(self, nodes, x, y, u=None, v=None, polygons=None, cmap="tab20", node_size=10,
+                 figsize=(8, 8), dpi=100, aspect="auto"):
+        self.nodes = list(nodes)
+        self.xy = np.column_stack([np.asarray(x, dtype=np.float64),
+                                   np.asarray(y, dtype=np.float64)])
+        self.segments = None
+        if u is not None:
+            self.segments = np.stack([self.xy[np.asarray(u)], self.xy[np.asarray(v)]], axis=1)
+        self.polygons = polygons
+        self.cmap = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+        self.node_size = node_size
+        self.figsize = figsize
+        self.dpi = dpi
+        self.aspect = aspect
+        self._figure = None
+        self._artist = None
+        self._pixels = {}
+
+    @classmethod
+    def from_graph(cls, graph, x_col, y_col, draw_edges=True, **kwargs):
+        """
+        Coordinates from two node attributes, which may be numbers or strings like INTPTLON20's
+        "-149.8635014" (parsed once here rather than for every drawing).
+        """
+        nodes = list(graph.nodes)
+        x = np.asarray([graph.nodes[n][x_col] for n in nodes], dtype=np.float64)
+        y = np.asarray([graph.nodes[n][y_col] for n in nodes], dtype=np.float64)
+        u = v = None
+        if draw_edges:
+            index = {node: i for i, node in enumerate(nodes)}
+            edges = np.array([(index[a], index[b]) for a, b in graph.edges]).reshape(-1, 2)
+            u, v = edges[:, 0], edges[:, 1]
+        return cls(nodes, x, y, u, v, **kwargs)
+
+    @classmethod
+    def from_cached(cls, cached, x_col, y_col, draw_edges=True, **kwargs):
+        """Same as from_graph, from a graph_cache.CachedGraph's arrays."""
+        u = v = None
+        if draw_edges:
+            u, v = cached.edges()
+        return cls(cached.nodes.tolist(), np.asarray(cached[x_col], dtype=np.float64),
+                   np.asarray(cached[y_col], dtype=np.float64), u, v, **kwargs)
+
+    @classmethod
+    def from_shapefile(cls, path, nodes=None, **kwargs):
+        """
+        Draw each node as its shape from the shapefile at ``path`` (whose rows are the nodes of
+        ``Graph.from_file(path)``, in order). ``nodes`` defaults to the row index.
+        """
+        import geopandas as gpd # pylint: disable=import-outside-toplevel
+
+        gdf = gpd.read_file(path)
+        rings, owner = [], []
+        for i, geometry in enumerate(gdf.geometry):
+            if geometry is None:
+                continue
+            for polygon in getattr(geometry, "geoms", [geometry]):
+                rings.append(np.asarray(polygon.exterior.coords)[:, :2])
+                owner.append(i)
+        points = gdf.geometry.representative_point()
+        nodes = list(gdf.index) if nodes is None else nodes
+        return cls(nodes, points.x.to_numpy(), points.y.to_numpy(),
+                   polygons=(rings, np.asarray(owner)), **kwargs)
+
+    def district_indices(self, plan):
+        """A plan (dictionary or array) as an array of district indices in node order."""
+        return assignment_array(self.nodes, plan)[0]
+
+    def colors(self, plan):
+        """(nodes x 4) RGBA color of each node under ``plan``."""
+        return self.cmap(self.district_indices(plan) % self.cmap.N)
+
+    def _setup(self):
+        figure = Figure(figsize=self.figsize, dpi=self.dpi)
+        FigureCanvasAgg(figure)
+        ax = figure.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        if self.polygons is not None:
+            rings, _ = self.polygons
+            self._artist = PolyCollection(rings, edgecolors="none")
+            ax.add_collection(self._artist)
+        else:
+            if self.segments is not None:
+                ax.add_collection(LineCollection(self.segments, colors="black", linewidths=0.5,
+                                                 zorder=1))
+            self._artist = ax.scatter(self.xy[:, 0], self.xy[:, 1], s=self.node_size,
+                                      linewidths=0, zorder=2)
+        ax.update_datalim(self.xy)
+        ax.autoscale_view()
+        ax.set_aspect(self.aspect)
+        self._figure = figure
+
+    def draw(self, plan):
+        """The matplotlib Figure showing ``plan`` (the same Figure is reused for every plan)."""
+        if self._figure is None:
+            self._setup()
+        colors = self.colors(plan)
+        if self.polygons is not None:
+            colors = colors[self.polygons[1]]
+        self._artist.set_facecolor(colors)
+        return self._figure
+
+    def save(self, plan, path):
+        """Draw ``plan`` and save it to ``path`` (any format matplotlib writes: png, jpg, ...)."""
+        self.draw(plan).savefig(path)
+
+    def _pixel_coords(self, width, height):
+        if (width, height) not in self._pixels:
+            low = self.xy.min(axis=0)
+            span = np.where(np.ptp(self.xy, axis=0) > 0, np.ptp(self.xy, axis=0), 1)
+            scaled = (self.xy - low) / span
+            px = np.round(scaled[:, 0] * (width - 1)).astype(np.int64)
+            py = np.round((1 - scaled[:, 1]) * (height - 1)).astype(np.int64) # y up, rows down
+            self._pixels[width, height] = (px, py)
+        return self._pixels[width, height]
+
+    def raster(self, plan, width=800, height=800, radius=1):
+        """
+        ``plan`` as a (height x width x 3) uint8 image with each node a (2 radius + 1)-pixel
+        square on white. No matplotlib involved, so it is as fast as NumPy indexing.
+        """
+        px, py = self._pixel_coords(width, height)
+        colors = (self.colors(plan)[:, :3] * 255).astype(np.uint8)
+        image = np.full((height, width, 3), 255, dtype=np.uint8)
+        for dy in range(-radius, radius + 1):
+            for dx in range(-radius, radius + 1):
+                image[np.clip(py + dy, 0, height - 1), np.clip(px + dx, 0, width - 1)] = colors
+        return image
+
+    def save_raster(self, plan, path, **kwargs):
+        imsave(path, self.raster(plan, **kwargs))
+
+
+_RENDERER = None
+
+
+def _init_worker(renderer):
+    global _RENDERER
+    _RENDERER = renderer
+
+
+def _render_frame(args):
+    path, plan, raster = args
+    if raster:
+        _RENDERER.save_raster(plan, path)
+    else:
+        _RENDERER.save(plan, path)
+    return path
+
+
+def render_frames(renderer, plans, directory, prefix="frame", processes=None, raster=False):
+    """
+    Save each of ``plans`` (plan dictionaries, or a (plans x nodes) array of district indices) to
+    ``directory/prefix-00000.png``, ``...-00001.png``, ... on ``processes`` worker processes
+    (default: one per core). Returns the paths in order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    # Arrays of district indices are much cheaper to send to the workers than dictionaries
+    plans = assignment_array(renderer.nodes, plans)
+    tasks = [(os.path.join(directory, f"{prefix}-{i:05d}.png"), plan, raster)
+             for i, plan in enumerate(plans)]
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(tasks) == 1:
+        _init_worker(renderer)
+        return [_render_frame(task) for task in tasks]
+    context = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else None
+    with (context or mp).Pool(processes, initializer = _init_worker,
+                              initargs = (renderer,)) as pool:
+        return pool.map(_render_frame, tasks, chunksize = max(1, len(tasks) // (4 * processes)))
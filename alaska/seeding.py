@@ -0,0 +1,131 @@
+"""
+Find a starting plan with recursive_tree_part by racing several attempts in worker processes.
+
+recursive_tree_part sometimes gives up with an error (especially with many districts and a tight
+population tolerance), and then all we can do is try again with different random choices. Instead
+of retrying one attempt at a time forever, seed_plan runs attempts with distinct seeds in parallel,
+returns the first plan found and stops the others, and gives up after a maximum number of attempts
+or a deadline.
+"""
+import multiprocessing as mp
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from functools import partial
+
+from gerrychain.tree import (recursive_tree_part, bipartition_tree, BalanceError,
+                             PopulationBalanceError)
+
+# What recursive_tree_part raises when an attempt fails and is worth retrying
+ATTEMPT_ERRORS = (RuntimeError, BalanceError, PopulationBalanceError)
+
+
+@dataclass
+class SeedingStats:
+    """What it took to find a plan: attempts finished, failures, and time per attempt."""
+    attempts: int = 0
+    failures: int = 0
+    attempt_times: list = field(default_factory=list)
+    errors: list = field(default_factory=list)
+    elapsed: float = 0.0
+    seed: int = None
+
+    def summary(self):
+        mean = sum(self.attempt_times)/len(self.attempt_times) if self.attempt_times else 0.0
+        found = "found" if self.seed is not None else "no plan found"
+        return (f"{found} after {self.attempts} attempts ({self.failures} failed, "
+                f"{mean:.2f}s per attempt) in {self.elapsed:.2f}s")
+
+
+_GRAPH = None
+
+
+def _init_worker(graph):
+    global _GRAPH
+    _GRAPH = graph
+
+
+def _attempt(args):
+    """One recursive_tree_part attempt; returns (seed, plan or None, error message, seconds)."""
+    seed, parts, pop_target, pop_col, epsilon, node_repeats, method = args
+    random.seed(seed)
+    start = time.perf_counter()
+    try:
+        plan = recursive_tree_part(_GRAPH, parts, pop_target, pop_col, epsilon, node_repeats,
+                                   method = method)
+        return seed, plan, None, time.perf_counter() - start
+    except ATTEMPT_ERRORS as e:
+        return seed, None, f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+
+def _record(stats, result):
+    seed, plan, error, seconds = result
+    stats.attempt_times.append(seconds)
+    if plan is None:
+        stats.failures += 1
+        stats.errors.append(error)
+    else:
+        stats.seed = seed
+    return plan
+
+
+def seed_plan(graph, parts, pop_target, pop_col, epsilon, node_repeats = 1,
+              workers = None, max_attempts = 100, deadline = None, seed = 0,
+              method = partial(bipartition_tree, max_attempts = 10000)):
+    """
+    Run up to ``max_attempts`` recursive_tree_part attempts (seeds ``seed, seed + 1, ...``) on
+    ``workers`` processes (default: one per core) and return ``(plan, stats)`` for the first one
+    that succeeds. ``deadline`` is a time limit in seconds, and ``method`` is the bipartition
+    function recursive_tree_part uses (its own default unless given).
+
+    Raises RuntimeError, like recursive_tree_part itself, if the attempts or the time run out.
+    """
+    parts = list(parts)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, max_attempts))
+    stats = SeedingStats()
+    start = time.perf_counter()
+    tasks = ((seed + i, parts, pop_target, pop_col, epsilon, node_repeats, method)
+             for i in range(max_attempts))
+
+    def out_of_time():
+        return deadline is not None and time.perf_counter() - start >= deadline
+
+    plan = None
+    if workers == 1:
+        _init_worker(graph)
+        for task in tasks:
+            if out_of_time():
+                break
+            stats.attempts += 1
+            plan = _record(stats, _attempt(task))
+            if plan is not None:
+                break
+    else:
+        context = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else None
+        pool = (context or mp).Pool(workers, initializer = _init_worker, initargs = (graph,))
+        try:
+            results = pool.imap_unordered(_attempt, tasks)
+            while stats.attempts < max_attempts:
+                timeout = None if deadline is None else deadline - (time.perf_counter() - start)
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    result = results.next(timeout = timeout)
+                except mp.TimeoutError:
+                    break
+                stats.attempts += 1
+                plan = _record(stats, result)
+                if plan is not None:
+                    break
+        finally:
+            # Stops attempts that are still running as well as the ones not started yet
+            pool.terminate()
+            pool.join()
+
+    stats.elapsed = time.perf_counter() - start
+    if plan is None:
+        raise RuntimeError(f"recursive_tree_part did not find a plan: {stats.summary()}")
+    return plan, stats
@@ -0,0 +1,66 @@
+"""
+File handling shared by the on-disk caches (recombination/graph_cache.py and
+ecological-inference/ei_inputs.py): hashing the source files an entry is keyed on, building an
+entry in a temporary directory that is moved into place only when complete, numbering column files
+and rewriting meta.json atomically.
+
+The scripts in each directory are run from that directory, so this isn't importable by name from
+them; they load this file by its path (see graph_cache.py) rather than changing sys.path, which
+could let one directory's modules shadow another's.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+def hash_files(paths):
+    """sha256 of the contents of ``paths``, in order."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def building(directory):
+    """
+    Yield a temporary directory next to ``directory`` to build a cache entry in, and move it into
+    place (replacing any old entry) once the block finishes, so a killed run never leaves a
+    half-written entry behind.
+    """
+    parent = os.path.dirname(directory) or "."
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=".building-")
+    try:
+        yield tmp
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp, directory)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def new_column_file(directory, prefix=""):
+    """
+    The first ``columns/<prefix>NNNN.npy`` name not taken in ``directory``. Files are never
+    reused, since a replaced column's old file may still be mapped (or named in meta) elsewhere.
+    """
+    os.makedirs(os.path.join(directory, "columns"), exist_ok=True)
+    number = 0
+    while os.path.exists(os.path.join(directory, "columns", f"{prefix}{number:04d}.npy")):
+        number += 1
+    return os.path.join("columns", f"{prefix}{number:04d}.npy")
+
+
+def write_meta(directory, meta):
+    """Replace ``directory``'s meta.json with ``meta`` in one step."""
+    tmp = os.path.join(directory, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(directory, "meta.json"))
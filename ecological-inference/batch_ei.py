@@ -0,0 +1,182 @@
+"""
+Fit TwoByTwoEI for every (demographic group column x candidate column) pair of a precinct table at
+once, in a pool of worker processes, and collect the results into one table.
+
+Each fit samples ``chains`` chains on ``cores_per_fit`` cores, and the pool runs
+``total_cores // cores_per_fit`` fits at a time so the machine is never oversubscribed. With
+enough cores the whole report takes about as long as the slowest single fit.
+
+    $ python batch_ei.py WaterburySampleData.csv --output waterbury-ei.csv
+"""
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+
+import numpy as np
+import pandas as pd
+
+from ei_cache import CACHE_DIR, cached_fit
+from ei_inputs import check_fractions, check_totals, fit_inputs, load_table
+
+# Columns of WaterburySampleData.csv
+GROUP_COLUMNS = ["White.Pct", "Black.Pct", "Hispanic.Pct"]
+CANDIDATE_COLUMNS = ["Tom.Foley", "Dan.Malloy"]
+POP_COLUMN = "Total.Votes"
+PRECINCT_COLUMN = "Precinct"
+
+
+@dataclass
+class FitSettings:
+    """Model and sampler settings shared by every fit in a batch."""
+    model_name: str = "king99_pareto_modification"
+    pareto_scale: float = 15
+    pareto_shape: float = 2
+    draws: int = 1200
+    tune: int = 3000
+    chains: int = 4
+    cores_per_fit: int = 1
+    random_seed: int = 0
+    # Fitted traces are cached here (see ei_cache); None samples every time
+    cache_dir: str = CACHE_DIR
+
+    def model_params(self):
+        if self.model_name == "king99_pareto_modification":
+            return {"pareto_scale": self.pareto_scale, "pareto_shape": self.pareto_shape}
+        return {}
+
+
+def _limit_threads(cores):
+    """
+    Keep a worker within its budget of ``cores``: single-threaded BLAS/OpenMP, and one XLA host
+    device per core. Has to run before jax (through pyei) is imported, which is why pyei is only
+    imported inside fit_pair.
+    """
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[var] = "1"
+    # One XLA host device per core lets numpyro run the chains in parallel on exactly those cores
+    os.environ["XLA_FLAGS"] = (f"--xla_force_host_platform_device_count={cores} "
+                               "--xla_cpu_multi_thread_eigen=false")
+
+
+def fit_pair(group_fraction, votes_fraction, precinct_pops, group_name, candidate_name,
+             settings, precinct_names=None):
+    """Fit one TwoByTwoEI (or load it from the trace cache) and return ``(ei, summary row)``."""
+    # pylint: disable=import-outside-toplevel
+    from pyei.two_by_two import TwoByTwoEI
+
+    start = time.perf_counter()
+    fit_args = {"draws": settings.draws,
+                "tune": settings.tune,
+                "chains": settings.chains,
+                "chain_method": "parallel" if settings.cores_per_fit > 1 else "vectorized",
+                "random_seed": settings.random_seed,
+                "progressbar": False}
+    if settings.cache_dir is not None:
+        ei = cached_fit(group_fraction, votes_fraction, precinct_pops, group_name,
+                        candidate_name, settings.model_name, settings.model_params(),
+                        cache_dir=settings.cache_dir, precinct_names=precinct_names, **fit_args)
+    else:
+        ei = TwoByTwoEI(model_name=settings.model_name, **settings.model_params())
+        ei.fit(group_fraction,
+               votes_fraction,
+               precinct_pops,
+               demographic_group_name=group_name,
+               candidate_name=candidate_name,
+               precinct_names=precinct_names,
+               **fit_args)
+    return ei, summary_row(ei, time.perf_counter() - start)
+
+
+def summary_row(ei, seconds):
+    """The numbers from ei.summary() and ei.polarization_report() as one table row."""
+    low, high = ei.polarization_report(percentile=95, reference_group=0, verbose=False)
+    return {
+        "group": ei.demographic_group_name,
+        "candidate": ei.candidate_name,
+        "model": ei.model_name,
+        "group_support": ei.posterior_mean_voting_prefs[0],
+        "group_support_low": ei.credible_interval_95_mean_voting_prefs[0][0],
+        "group_support_high": ei.credible_interval_95_mean_voting_prefs[0][1],
+        "others_support": ei.posterior_mean_voting_prefs[1],
+        "others_support_low": ei.credible_interval_95_mean_voting_prefs[1][0],
+        "others_support_high": ei.credible_interval_95_mean_voting_prefs[1][1],
+        # 95% central interval of (group - others) support, and P(group - others > 0.10)
+        "polarization_low": low,
+        "polarization_high": high,
+        "prob_polarized_10": ei.polarization_report(threshold=0.10, reference_group=0,
+                                                    verbose=False),
+        "seconds": seconds,
+    }
+
+
+def _fit_in_worker(args):
+    data, group_col, candidate_col, pop_col, precinct_col, settings = args
+    group_fraction, votes_fraction, pops = fit_inputs(data, group_col, candidate_col, pop_col)
+    names = np.asarray(data[precinct_col]) if precinct_col in data else None
+    _, row = fit_pair(group_fraction, votes_fraction, pops, group_col, candidate_col, settings,
+                      names)
+    return row
+
+
+def run_batch(data, group_cols = None, candidate_cols = None, pop_col = POP_COLUMN,
+              precinct_col = PRECINCT_COLUMN, settings = None, total_cores = None):
+    """
+    Fit every (group, candidate) pair of columns of ``data`` (a DataFrame, or an
+    ei_inputs.PrecinctTable, which workers memory-map instead of receiving a copy) and return one
+    row per fit (see summary_row) as a DataFrame, ordered like the pairs.
+    """
+    group_cols = group_cols or GROUP_COLUMNS
+    candidate_cols = candidate_cols or CANDIDATE_COLUMNS
+    settings = settings or FitSettings()
+    total_cores = total_cores or os.cpu_count() or 1
+
+    # Bad inputs fail here, before any worker starts sampling
+    check_fractions(data, list(group_cols) + list(candidate_cols))
+    check_totals(data, pop_col)
+    pairs = list(itertools.product(group_cols, candidate_cols))
+    tasks = [(data, g, c, pop_col, precinct_col, settings) for g, c in pairs]
+
+    workers = max(1, min(len(tasks), total_cores // settings.cores_per_fit))
+    rows = [None] * len(tasks)
+    # Spawned (not forked) workers, so each one can set its thread limits before jax starts up
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=mp.get_context("spawn"),
+                             initializer=_limit_threads,
+                             initargs=(settings.cores_per_fit,)) as pool:
+        futures = {pool.submit(_fit_in_worker, task): i for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            rows[futures[future]] = future.result()
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EI for every group x candidate pair")
+    parser.add_argument("csv", nargs="?", default="WaterburySampleData.csv")
+    parser.add_argument("--groups", nargs="+", default=GROUP_COLUMNS)
+    parser.add_argument("--candidates", nargs="+", default=CANDIDATE_COLUMNS)
+    parser.add_argument("--pop-col", default=POP_COLUMN)
+    parser.add_argument("--draws", type=int, default=1200)
+    parser.add_argument("--tune", type=int, default=3000)
+    parser.add_argument("--chains", type=int, default=4)
+    parser.add_argument("--cores-per-fit", type=int, default=1)
+    parser.add_argument("--cores", type=int, default=None, help="total cores to use")
+    parser.add_argument("--output", default="ei-report.csv")
+    parser.add_argument("--no-cache", action="store_true", help="always sample, ignore .ei_cache")
+    args = parser.parse_args()
+
+    fit_settings = FitSettings(draws=args.draws, tune=args.tune, chains=args.chains,
+                               cores_per_fit=args.cores_per_fit,
+                               cache_dir=None if args.no_cache else CACHE_DIR)
+    start_time = time.perf_counter()
+    table = load_table(args.csv, args.groups + args.candidates + [args.pop_col])
+    report = run_batch(table, args.groups, args.candidates, args.pop_col,
+                       settings=fit_settings, total_cores=args.cores)
+    print(report.to_string(index=False))
+    print(f"{len(report)} fits in {time.perf_counter() - start_time:.1f}s "
+          f"(slowest single fit {report['seconds'].max():.1f}s)")
+    print(f"Settings: {asdict(fit_settings)}")
+    report.to_csv(args.output, index=False)
@@ -0,0 +1,114 @@
+"""
+On-disk cache of fitted TwoByTwoEI models. Sampling the king99_pareto_modification model takes
+minutes of NUTS, but everything we do with a fit afterwards (summary(), polarization_report(),
+plot()) only needs the trace. So a fit's trace is saved as NetCDF under a key made from everything
+that determines it: the input arrays, model name and parameters, and sampler settings. The next run
+with the same inputs loads the trace instead of sampling again.
+
+The cache keeps at most ``max_entries`` fits and evicts the least recently used ones; a hit bumps
+the file's modification time, which is what "recently used" goes by.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_DIR = ".ei_cache"
+MAX_ENTRIES = 32
+
+
+def fit_key(group_fraction, votes_fraction, precinct_pops, demographic_group_name,
+            candidate_name, model_name, model_params = None, **fit_args):
+    """sha256 naming a fit: the input arrays plus every model and sampler setting."""
+    digest = hashlib.sha256()
+    for values in [group_fraction, votes_fraction, precinct_pops]:
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    settings = {"group": demographic_group_name, "candidate": candidate_name,
+                "model": model_name, "params": model_params or {}, "fit": fit_args}
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def load_fit(path, model_params = None):
+    """
+    Rebuild a fitted TwoByTwoEI from a file written by pyei.io_utils.to_netcdf. (pyei 1.1.1's own
+    from_netcdf computes the voting preference samples before attaching the trace and fails.)
+    """
+    # pylint: disable=import-outside-toplevel
+    import arviz as az
+    from pyei.two_by_two import TwoByTwoEI
+
+    trace = az.from_netcdf(path, engine="netcdf4")
+    attrs = dict(trace.posterior.attrs) # pylint: disable=no-member
+    ei = TwoByTwoEI(attrs["model_name"], **(model_params or {}))
+    for name in ["precinct_pops", "demographic_group_fraction", "votes_fraction"]:
+        setattr(ei, name, np.asarray(attrs[name]))
+    for name in ["demographic_group_name", "candidate_name"]:
+        setattr(ei, name, attrs[name])
+    if "precinct_names" in attrs:
+        ei.precinct_names = list(np.atleast_1d(attrs["precinct_names"]))
+    # Those were only attached to the posterior for saving
+    for name in list(attrs):
+        del trace.posterior.attrs[name] # pylint: disable=no-member
+    ei.sim_trace = trace
+    ei.calculate_sampled_voting_prefs()
+    ei.calculate_summary()
+    return ei
+
+
+def evict(cache_dir, max_entries = MAX_ENTRIES):
+    """Delete all but the ``max_entries`` most recently used fits in ``cache_dir``."""
+    paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+             if name.endswith(".nc")]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[max_entries:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError: # another process evicted it first
+            pass
+
+
+def cached_fit(group_fraction, votes_fraction, precinct_pops, demographic_group_name,
+               candidate_name, model_name = "king99_pareto_modification", model_params = None,
+               cache_dir = CACHE_DIR, max_entries = MAX_ENTRIES, precinct_names = None,
+               **fit_args):
+    """
+    TwoByTwoEI(model_name, **model_params).fit(...) through the cache. ``fit_args`` (draws, tune,
+    chains, random_seed, ...) are passed on to fit and are part of the key. ``precinct_names``
+    don't change the fit, so they aren't; a cache hit gets this call's names, not the ones saved
+    with the trace. Returns the fitted object; on a cache hit ``sim_model`` is None, since pyei
+    only saves the trace.
+    """
+    # pylint: disable=import-outside-toplevel
+    from pyei.io_utils import to_netcdf
+    from pyei.two_by_two import TwoByTwoEI
+
+    model_params = model_params or {}
+    if precinct_names is not None:
+        precinct_names = [str(p) for p in precinct_names]
+    key = fit_key(group_fraction, votes_fraction, precinct_pops, demographic_group_name,
+                  candidate_name, model_name, model_params, **fit_args)
+    path = os.path.join(cache_dir, f"{key}.nc")
+    if os.path.exists(path):
+        os.utime(path)
+        ei = load_fit(path, model_params)
+        ei.precinct_names = precinct_names
+        return ei
+
+    ei = TwoByTwoEI(model_name=model_name, **model_params)
+    ei.fit(np.asarray(group_fraction),
+           np.asarray(votes_fraction),
+           np.asarray(precinct_pops),
+           demographic_group_name=demographic_group_name,
+           candidate_name=candidate_name,
+           precinct_names=precinct_names,
+           **fit_args)
+
+    # Write under a temporary name and rename, so readers never see half a file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    to_netcdf(ei, tmp)
+    os.replace(tmp, path)
+    evict(cache_dir, max_entries)
+    return ei
@@ -0,0 +1,198 @@
+"""
+Precinct tables for EI as memory-mapped NumPy columns.
+
+A statewide precinct file has thousands of rows and dozens of demographic and candidate columns,
+and parsing the CSV (then copying each column out with np.array) on every run adds up. load_table
+parses only the columns asked for, in chunks, the first time, and saves each one as a .npy file in
+.ei_inputs/ keyed on a hash of the CSV, with the same cache file handling as the dual graph cache
+(common/cache_files.py). Later runs memory-map those files, so ``table["Black.Pct"]`` is a
+read-only float64 array backed by the file that can go straight to TwoByTwoEI.fit,
+GoodmansER.fit or ei_cache.cached_fit without a copy. Columns asked for later are parsed and added
+to the same entry.
+
+    table = load_table("WaterburySampleData.csv", ["Black.Pct", "Dan.Malloy", "Total.Votes"])
+    check_fractions(table, ["Black.Pct", "Dan.Malloy"])
+    check_totals(table, "Total.Votes")
+    ei.fit(table["Black.Pct"], table["Dan.Malloy"], table["Total.Votes"], ...)
+"""
+import importlib.util
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# File handling shared with recombination/graph_cache.py, loaded from ../common by its path
+_spec = importlib.util.spec_from_file_location(
+    "cache_files", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common",
+                                "cache_files.py"))
+cache_files = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(cache_files)
+building = cache_files.building
+hash_files = cache_files.hash_files
+new_column_file = cache_files.new_column_file
+write_meta = cache_files.write_meta
+
+INPUT_DIR = ".ei_inputs"
+PRECINCT_COLUMN = "Precinct"
+# Rows parsed at a time
+CHUNK_ROWS = 100000
+
+
+def _parse(path, columns, chunk_rows=CHUNK_ROWS):
+    """Read ``columns`` of the CSV at ``path`` chunk by chunk into one array each."""
+    parts = {name: [] for name in columns}
+    for chunk in pd.read_csv(path, usecols=list(columns), chunksize=chunk_rows):
+        for name in columns:
+            parts[name].append(chunk[name].to_numpy())
+    arrays = {}
+    for name, pieces in parts.items():
+        values = np.concatenate(pieces) if pieces else np.zeros(0)
+        if values.dtype.kind in "iub":
+            arrays[name] = values.astype(np.int64)
+        elif values.dtype.kind == "f":
+            arrays[name] = values.astype(np.float64)
+        else:
+            arrays[name] = values.astype(np.str_)
+    return arrays
+
+
+def _write_columns(directory, meta, arrays):
+    for name, values in arrays.items():
+        filename = new_column_file(directory)
+        np.save(os.path.join(directory, filename), values)
+        meta["columns"][name] = filename
+    if arrays:
+        meta["rows"] = len(next(iter(arrays.values())))
+
+
+class PrecinctTable:
+    """
+    Columns of a precinct CSV as read-only memory-mapped arrays. ``table[name]`` is a column,
+    ``table.names`` the precinct names (if the CSV has ``precinct_col``). Supports enough of the
+    DataFrame interface (``shape``, ``columns``, ``in``, ``head()``) for the scripts here.
+
+    Pickling sends only the entry's directory, so worker processes map the same files.
+    """
+
+    def __init__(self, directory, precinct_col=PRECINCT_COLUMN):
+        self.directory = directory
+        self.precinct_col = precinct_col
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self._columns = {}
+
+    def __reduce__(self):
+        return PrecinctTable, (self.directory, self.precinct_col)
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            if name not in self.meta["columns"]:
+                raise KeyError(f"Column {name!r} is not loaded from {self.meta['source']}")
+            self._columns[name] = np.load(os.path.join(self.directory,
+                                                       self.meta["columns"][name]),
+                                          mmap_mode="r")
+        return self._columns[name]
+
+    def __contains__(self, name):
+        return name in self.meta["columns"]
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    @property
+    def columns(self):
+        return list(self.meta["columns"])
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columns))
+
+    @property
+    def names(self):
+        return self[self.precinct_col] if self.precinct_col in self else None
+
+    def head(self, n=5):
+        return pd.DataFrame({name: self[name][:n] for name in self.columns})
+
+    def to_frame(self):
+        return pd.DataFrame({name: np.asarray(self[name]) for name in self.columns})
+
+
+def load_table(path, columns=None, precinct_col=PRECINCT_COLUMN, cache_dir=None,
+               chunk_rows=CHUNK_ROWS):
+    """
+    The PrecinctTable of ``columns`` (default: every column) of the CSV at ``path``, plus its
+    ``precinct_col`` if it has one. The CSV is only parsed for columns not already in the cache
+    entry, which is keyed on the file's contents.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), INPUT_DIR)
+    header = list(pd.read_csv(path, nrows=0).columns)
+    wanted = header if columns is None else list(columns)
+    missing = [name for name in wanted if name not in header]
+    if missing:
+        raise KeyError(f"{path} has no columns {missing}")
+    if precinct_col in header and precinct_col not in wanted:
+        wanted.append(precinct_col)
+
+    digest = hash_files([path])
+    stem = os.path.splitext(os.path.basename(path))[0]
+    directory = os.path.join(cache_dir, f"{stem}-{digest[:16]}")
+
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        with building(directory) as tmp:
+            meta = {"source": path, "hash": digest, "rows": 0, "columns": {}}
+            _write_columns(tmp, meta, _parse(path, wanted, chunk_rows))
+            write_meta(tmp, meta)
+        return PrecinctTable(directory, precinct_col)
+
+    table = PrecinctTable(directory, precinct_col)
+    new = [name for name in wanted if name not in table]
+    if new:
+        meta = dict(table.meta)
+        meta["columns"] = dict(meta["columns"])
+        _write_columns(directory, meta, _parse(path, new, chunk_rows))
+        write_meta(directory, meta)
+        table = PrecinctTable(directory, precinct_col)
+    return table
+
+
+def _bad_rows(data, mask, what):
+    """ValueError naming (up to five of) the precincts where ``mask`` is set."""
+    rows = np.flatnonzero(mask)
+    names = np.asarray(data[PRECINCT_COLUMN]) if PRECINCT_COLUMN in data else None
+    examples = [str(names[i]) if names is not None else str(i) for i in rows[:5]]
+    return ValueError(f"{len(rows)} precincts {what}, e.g. {', '.join(examples)}")
+
+
+def check_fractions(data, columns):
+    """
+    Raise ValueError unless every value of each of ``columns`` (of a PrecinctTable or a DataFrame)
+    is a fraction in [0, 1].
+    """
+    for name in columns:
+        values = np.asarray(data[name], dtype=np.float64)
+        bad = ~((values >= 0) & (values <= 1))
+        if bad.any():
+            raise _bad_rows(data, bad, f"have {name} outside [0, 1]")
+
+
+def check_totals(data, column):
+    """Raise ValueError unless ``column`` holds positive, whole-number totals."""
+    values = np.asarray(data[column], dtype=np.float64)
+    bad = ~((values > 0) & (values == np.round(values)))
+    if bad.any():
+        raise _bad_rows(data, bad, f"have a {column} that isn't a positive whole number")
+
+
+def fit_inputs(data, group_col, candidate_col, pop_col):
+    """
+    ``(group_fraction, votes_fraction, precinct_pops)`` for TwoByTwoEI.fit or GoodmansER.fit,
+    checked. For a PrecinctTable these are views of the mapped files, not copies.
+    """
+    check_fractions(data, [group_col, candidate_col])
+    check_totals(data, pop_col)
+    return (np.asarray(data[group_col], dtype=np.float64),
+            np.asarray(data[candidate_col], dtype=np.float64),
+            np.asarray(data[pop_col]))
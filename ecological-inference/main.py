@@ -1,12 +1,13 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.linear_model import LinearRegression
 import numpy as np
 import pymc as pm
-import pandas as pd
-from pyei.two_by_two import TwoByTwoEI
 from pyei.goodmans_er import GoodmansER
-from pyei.io_utils import from_netcdf, to_netcdf
+
+from ei_cache import cached_fit
+from ei_inputs import load_table, fit_inputs
+from goodmans import fit_goodmans, goodmans_er as goodmans_screen
+from tomography import tomography_lines, plot_tomography
 
 # Code heavily yoinked from chatgpt
 # https://chatgpt.com/share/6725cda6-11b4-800f-8b2a-ed5f58067224
@@ -22,16 +23,13 @@ plt.xlabel('Percent of Voters who are Black')
 plt.ylabel('Percentage Voting for Candidate A')
 plt.savefig("scatterplot.png")
 
-# Create and fit the model
-model = LinearRegression()
-model.fit(percent_black, a_support)
+# Fit the line (Goodman's ER in closed form, every precinct weighted the same)
+intercepts, slopes = fit_goodmans(percent_black, a_support.reshape(-1, 1), np.ones(len(a_support)))
+slope = slopes[0, 0, 0]
+intercept = intercepts[0, 0, 0]
 
 # Predict y values for the line of best fit
-a_support_pred = model.predict(percent_black)
-
-# Get the equation of the line
-slope = model.coef_[0]
-intercept = model.intercept_
+a_support_pred = intercept + slope * percent_black.ravel()
 print(f"Equation of the line: y = {slope:.2f}x + {intercept:.2f}")
 
 # Plot the line of best fit
@@ -41,29 +39,22 @@ plt.plot(percent_black, a_support_pred, color='red',
 plt.legend()
 plt.savefig("best_fit.png")
 
-# Create tomography lines for each district
-plt.figure()
+# Create tomography lines for each district: every (Black support, non-Black support) pair
+# consistent with the district's Black share p and vote share t lies on t = p*b + (1 - p)*w, i.e.
+# w = (t - p*b)/(1 - p), clipped to the unit square. The ends of each segment are the district's
+# Duncan-Davis bounds
+district_lines = tomography_lines(percent_black.ravel(), a_support)
 
-# Generate x values (possible proportion of Black voters supporting the candidate)
-x_vals = np.linspace(0, 1, 100)
-
-# Plot each district's tomography line using the given formula
 plt.figure(figsize=(10, 8))
-for i in range(len(percent_black)):
-    # Calculate y values based on the provided formula
-    y_vals = ((percent_black[i] - 1) / percent_black[i]) * x_vals + a_support[i]/percent_black[i]
-    
-    # Plot the tomography line for this district
-    plt.plot(x_vals, y_vals, label=f'District {i+1}')
-
-plt.ylim(0, 1)
+plot_tomography(plt.gca(), district_lines,
+                labels=[f'District {i+1}' for i in range(len(percent_black))])
 plt.xlabel("Proportion of Black Voters Supporting Candidate")
 plt.ylabel("Proportion of Non-Black Voters Supporting Candidate")
 plt.title("Ecological Inference Tomographic Plot")
-plt.legend()
 plt.savefig("tomography.png")
 
-waterbury_data = pd.read_csv("WaterburySampleData.csv")
+# The CSV is parsed once into .ei_inputs/; after that its columns are memory-mapped arrays
+waterbury_data = load_table("WaterburySampleData.csv")
 print(waterbury_data.shape)
 # (23, 7)
 print(waterbury_data.columns)
@@ -78,30 +69,52 @@ print(waterbury_data.head())
 # 3     72-1          310      0.223       0.770      0.391      0.530         0.475
 # 4     72-2          413      0.148       0.816      0.231      0.686         0.445
 
-group_fraction_2by2 = np.array(waterbury_data["Black.Pct"])
-# group_fraction_2by2 = np.array(waterbury_data["Hispanic.Pct"])
-votes_fraction_2by2 = np.array(waterbury_data["Dan.Malloy"])
-precinct_pops = np.array(waterbury_data["Total.Votes"])
+# Checked (fractions in [0, 1], positive vote totals) views of the mapped columns, not copies
+group_fraction_2by2, votes_fraction_2by2, precinct_pops = fit_inputs(waterbury_data,
+                                                                     "Black.Pct",
+                                                                     # "Hispanic.Pct",
+                                                                     "Dan.Malloy",
+                                                                     "Total.Votes")
 
 demographic_group_name_2by2 = "Black"
 candidate_name_2by2 = "Malloy"
-precinct_names = waterbury_data['Precinct']
+precinct_names = waterbury_data.names
 
-ei_2by2 = TwoByTwoEI(model_name="king99_pareto_modification", pareto_scale=15, pareto_shape=2)
-
-# Fit the model
-ei_2by2.fit(group_fraction_2by2,
+# The same plot for Waterbury's precincts (drawn as one collection of lines, or as a density image
+# for thousands of precincts), and the Duncan-Davis bounds over the whole city
+waterbury_lines = tomography_lines(group_fraction_2by2, votes_fraction_2by2)
+plt.figure(figsize=(10, 8))
+plot_tomography(plt.gca(), waterbury_lines)
+plt.xlabel("Proportion of Black Voters Supporting Malloy")
+plt.ylabel("Proportion of Non-Black Voters Supporting Malloy")
+plt.title("Waterbury Tomographic Plot")
+plt.savefig("tomography-waterbury.png")
+print("Duncan-Davis bounds (Black low, Black high, non-Black low, non-Black high): "
+      f"{waterbury_lines.aggregate_bounds(precinct_pops)}")
+
+# First look at every group x candidate pair: Goodman's ER with 2000 bootstrap resamples takes a
+# fraction of a second, so it's worth checking which pairs look polarized before sampling
+screen = goodmans_screen(waterbury_data, weighted=True, resamples=2000)
+print(screen.report().to_string(index=False))
+
+# Sampling takes minutes, so the fit goes through the trace cache in .ei_cache/: a rerun with the
+# same data and settings loads the saved trace instead
+ei_2by2 = cached_fit(group_fraction_2by2,
        votes_fraction_2by2,
        precinct_pops,
        demographic_group_name=demographic_group_name_2by2,
        candidate_name=candidate_name_2by2,
+       model_name="king99_pareto_modification",
+       model_params={"pareto_scale": 15, "pareto_shape": 2},
        precinct_names=precinct_names,
        draws=1200, # optional
        tune=3000, # optional
 )
 
+# Only available when the model was actually sampled this run (not for a cached trace)
 model = ei_2by2.sim_model
-pm.model_to_graphviz(model)
+if model is not None:
+    pm.model_to_graphviz(model)
 
 plt.figure()
 ei_2by2.plot()
@@ -142,3 +155,9 @@ print(goodmans_er.summary())
 plt.figure()
 goodmans_er.plot()
 plt.savefig("goodmans.png")
+
+# To fit every group x candidate pair in the data at once (in parallel) and get one table of
+# results, run batch_ei.py instead:
+#   python batch_ei.py WaterburySampleData.csv --output waterbury-ei.csv
+# and for a quick Goodman's ER screen of every pair, with bootstrap intervals:
+#   python goodmans.py WaterburySampleData.csv --weighted --resamples 5000
@@ -0,0 +1,131 @@
+"""
+Tomography plots for any number of precincts.
+
+In a precinct where a fraction ``p`` of voters is in the group and a fraction ``t`` voted for the
+candidate, the group's support ``b`` and everyone else's support ``w`` satisfy
+
+    t = p * b + (1 - p) * w,
+
+so every possible (b, w) lies on one line in the unit square. Where that line enters and leaves
+the square are the Duncan-Davis bounds: b is between max(0, (t - (1 - p)) / p) and min(1, t / p),
+and w between max(0, (t - p) / (1 - p)) and min(1, t / (1 - p)). tomography_lines works out the
+clipped segment and the bounds for every precinct at once with array arithmetic, and
+plot_tomography draws all the segments as one LineCollection, or for many thousands of
+precincts as a density image, which stays readable where overlapping lines turn into a solid
+block.
+
+    lines = tomography_lines(table["Black.Pct"], table["Dan.Malloy"])
+    plot_tomography(plt.gca(), lines)
+    print(lines.aggregate_bounds(table["Total.Votes"]))
+"""
+from dataclasses import dataclass
+
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+
+# Above this many precincts plot_tomography draws a density image instead of lines
+RASTER_THRESHOLD = 2000
+
+
+@dataclass
+class TomographyLines:
+    """
+    ``segments[i]`` is ``[(b_low, w at b_low), (b_high, w at b_high)]`` for precinct i (NaN where
+    ``p`` and ``t`` admit no solution), and the bounds arrays are the Duncan-Davis bounds on the
+    group's support ``b`` and everyone else's ``w``.
+    """
+    group_fraction: np.ndarray
+    votes_fraction: np.ndarray
+    segments: np.ndarray
+    b_low: np.ndarray
+    b_high: np.ndarray
+    w_low: np.ndarray
+    w_high: np.ndarray
+
+    def __len__(self):
+        return len(self.segments)
+
+    def aggregate_bounds(self, precinct_pops):
+        """
+        Bounds on the group's and everyone else's support over all the precincts together:
+        ``(b_low, b_high, w_low, w_high)``, each precinct's bounds weighted by its number of group
+        (or other) voters.
+        """
+        pops = np.asarray(precinct_pops, dtype=np.float64)
+        group = pops * self.group_fraction
+        others = pops - group
+        ok = np.isfinite(self.b_low)
+        group, others = group[ok], others[ok]
+        return (np.dot(group, self.b_low[ok]) / group.sum(),
+                np.dot(group, self.b_high[ok]) / group.sum(),
+                np.dot(others, self.w_low[ok]) / others.sum(),
+                np.dot(others, self.w_high[ok]) / others.sum())
+
+
+def tomography_lines(group_fraction, votes_fraction):
+    """The clipped tomography segment and Duncan-Davis bounds of every precinct."""
+    p = np.asarray(group_fraction, dtype=np.float64)
+    t = np.asarray(votes_fraction, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # A precinct with no group voters tells us nothing about b (and with only group voters,
+        # nothing about w): its line runs right across the square
+        b_low = np.where(p > 0, np.maximum(0.0, (t - (1 - p)) / p), 0.0)
+        b_high = np.where(p > 0, np.minimum(1.0, t / p), 1.0)
+        w_low = np.where(p < 1, np.maximum(0.0, (t - p) / (1 - p)), 0.0)
+        w_high = np.where(p < 1, np.minimum(1.0, t / (1 - p)), 1.0)
+        # w along the line at each end; for p = 1 the line is vertical, from w = 0 to 1
+        w_at_low = np.where(p < 1, (t - p * b_low) / (1 - p), 0.0)
+        w_at_high = np.where(p < 1, (t - p * b_high) / (1 - p), 1.0)
+    b_low = np.where(p >= 1, t, b_low)
+    b_high = np.where(p >= 1, t, b_high)
+    w_low = np.where(p <= 0, t, w_low)
+    w_high = np.where(p <= 0, t, w_high)
+    infeasible = (b_low > b_high) | (w_low > w_high) | ~np.isfinite(p) | ~np.isfinite(t)
+    for bound in [b_low, b_high, w_low, w_high, w_at_low, w_at_high]:
+        bound[infeasible] = np.nan
+    segments = np.stack([np.stack([b_low, w_at_low], axis=-1),
+                         np.stack([b_high, w_at_high], axis=-1)], axis=1)
+    return TomographyLines(p, t, segments, b_low, b_high, w_low, w_high)
+
+
+def density(lines, bins=400, samples=None):
+    """
+    A (bins x bins) image of how much tomography line passes through each cell of the unit
+    square (rows are w, columns b), from evenly spaced points along every segment.
+    """
+    segments = lines.segments[np.isfinite(lines.segments).all(axis=(1, 2))]
+    if samples is None:
+        samples = 2 * bins
+    steps = np.linspace(0.0, 1.0, samples)[None, :, None]
+    points = segments[:, :1, :] + steps * (segments[:, 1:, :] - segments[:, :1, :])
+    length = np.hypot(*(segments[:, 1, :] - segments[:, 0, :]).T)
+    weights = np.repeat(length / samples, samples)
+    image, _, _ = np.histogram2d(points[..., 1].ravel(), points[..., 0].ravel(), bins=bins,
+                                 range=[[0, 1], [0, 1]], weights=weights)
+    return image
+
+
+def plot_tomography(ax, lines, labels=None, raster=None, bins=400, cmap="viridis",
+                    linewidth=0.8, alpha=None):
+    """
+    Draw ``lines`` on ``ax``: one LineCollection, or (with ``raster``, which defaults to more than
+    RASTER_THRESHOLD lines) a density image. ``labels`` names each line in a legend, for a
+    handful of precincts. Returns the artist.
+    """
+    if raster is None:
+        raster = len(lines) > RASTER_THRESHOLD
+    if raster:
+        artist = ax.imshow(density(lines, bins), origin="lower", extent=[0, 1, 0, 1],
+                           aspect="auto", cmap=cmap, interpolation="nearest")
+    else:
+        if alpha is None:
+            alpha = 1.0 if len(lines) <= 50 else max(0.05, 50 / len(lines))
+        colors = [f"C{i % 10}" for i in range(len(lines))] if labels is not None else "C0"
+        artist = ax.add_collection(LineCollection(lines.segments, colors=colors,
+                                                  linewidths=linewidth, alpha=alpha))
+        if labels is not None:
+            ax.legend([Line2D([], [], color=f"C{i % 10}") for i in range(len(lines))], labels)
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    return artist
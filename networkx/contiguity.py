@@ -0,0 +1,286 @@
+"""
+Contiguity checks that don't rebuild the district subgraph every time.
+
+The template checks a district with ``nx.is_connected(nx.subgraph(grid, verts_in_dist))``, which
+looks at the whole district on every check. Here there are two faster ways to do it:
+
+* ContiguityTracker keeps track of which districts are connected while nodes change district
+  (single-node flips or recom's merge and split). When a node leaves a district, we run one
+  breadth-first search from each of its neighbours in that district, a step at a time each, and
+  union the searches whenever they meet. As soon as they have all joined, the district is still
+  connected; if one of them runs out of nodes first, it has found a piece that was cut off. Either
+  way the work is about the size of the smallest piece, which for a flip that keeps the district
+  connected is usually a few nodes. Big moves (like recom redrawing two districts) just recount
+  the districts involved.
+* contiguous_plans() checks a whole batch of assignment arrays at once, with one
+  scipy.sparse.csgraph.connected_components call over the disjoint union of the plans' district
+  subgraphs.
+"""
+from collections import deque
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+# Plans are checked this many at a time in contiguous_plans
+BATCH_SIZE = 1024
+
+
+def csr_adjacency(graph):
+    """``(nodes, indptr, indices)``: a graph's adjacency in CSR form, in its node order."""
+    nodes = list(graph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    pairs = np.array([(index[u], index[v]) for u, v in graph.edges], dtype=np.int64)
+    pairs = pairs.reshape(-1, 2)
+    src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    adjacency = sp.csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)),
+                              shape=(len(nodes), len(nodes)))
+    adjacency.sort_indices()
+    return nodes, adjacency.indptr, adjacency.indices
+
+
+class ContiguityTracker:
+    """
+    Which districts of a plan are connected, kept up to date as nodes move.
+
+    ``nodes``, ``indptr`` and ``indices`` are the graph in CSR form (see csr_adjacency, or a
+    graph_cache.CachedGraph), ``assignment`` maps each node to its district and ``parts`` lists
+    the district labels. Moves that touch more than ``recount_fraction`` of the affected districts'
+    nodes recount those districts from scratch instead of searching from each moved node.
+
+    A tracker can also be given to a MarkovChain as a constraint, e.g.
+    ``MarkovChain(..., constraints=[ContiguityTracker.from_partition(initial_partition)])``: it
+    checks each proposal from its flips and only commits the ones the chain goes on from.
+    """
+
+    def __init__(self, nodes, indptr, indices, assignment, parts=None, recount_fraction=0.1):
+        self.nodes = list(nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        indptr = np.asarray(indptr)
+        indices = np.asarray(indices)
+        # Python lists are much quicker than array slices for a node-at-a-time search
+        self.adjacency = [indices[indptr[i]:indptr[i + 1]].tolist()
+                          for i in range(len(self.nodes))]
+        if parts is None:
+            parts = sorted(set(assignment[node] for node in self.nodes))
+        self.parts = list(parts)
+        self.part_index = {part: k for k, part in enumerate(self.parts)}
+        self.recount_fraction = recount_fraction
+        self._last = None
+        self._proposal = None
+        self.reset(assignment)
+
+    @classmethod
+    def from_graph(cls, graph, assignment, parts=None, **kwargs):
+        return cls(*csr_adjacency(graph), assignment, parts, **kwargs)
+
+    @classmethod
+    def from_partition(cls, partition, **kwargs):
+        tracker = cls.from_graph(partition.graph, partition.assignment,
+                                 sorted(partition.parts), **kwargs)
+        tracker._last = partition
+        return tracker
+
+    def reset(self, assignment):
+        """Start over from a full node -> district assignment, checking every district."""
+        self.assignment = np.fromiter((self.part_index[assignment[node]] for node in self.nodes),
+                                      dtype=np.int64, count=len(self.nodes))
+        self.sizes = np.bincount(self.assignment, minlength=len(self.parts))
+        self.broken = {d for d in range(len(self.parts)) if not self._recount(d)}
+
+    def is_contiguous(self):
+        """Is every district connected?"""
+        return not self.broken
+
+    def district_connected(self, part):
+        return self.part_index[part] not in self.broken
+
+    def _recount(self, d):
+        """Is district ``d`` connected? A full search over its nodes."""
+        members = np.flatnonzero(self.assignment == d)
+        if len(members) <= 1:
+            return True
+        a, adjacency = self.assignment, self.adjacency
+        start = int(members[0])
+        seen = {start}
+        queue = deque([start])
+        while queue:
+            for w in adjacency[queue.popleft()]:
+                if a[w] == d and w not in seen:
+                    seen.add(w)
+                    queue.append(w)
+        return len(seen) == len(members)
+
+    def _connected_without(self, v, d):
+        """
+        Node ``v`` just left district ``d``, which was connected. Is it still? Searches out from
+        each of v's neighbours in ``d`` in turn, merging searches that meet.
+        """
+        a, adjacency = self.assignment, self.adjacency
+        starts = [w for w in adjacency[v] if a[w] == d]
+        if len(starts) <= 1:
+            return True
+        parent = list(range(len(starts)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        owner = {w: i for i, w in enumerate(starts)}
+        queues = [deque([w]) for w in starts]
+        groups = len(starts)
+        while True:
+            for i, queue in enumerate(queues):
+                if not queue:
+                    continue
+                for w in adjacency[queue.popleft()]:
+                    if a[w] != d:
+                        continue
+                    j = owner.get(w)
+                    if j is None:
+                        owner[w] = i
+                        queue.append(w)
+                    elif find(i) != find(j):
+                        parent[find(i)] = find(j)
+                        groups -= 1
+                        if groups == 1:
+                            return True
+                if not queue:
+                    # This search is finished; if every search it has joined up with is too, they
+                    # have found all of a piece that the other searches can't reach
+                    root = find(i)
+                    if not any(queues[j] for j in range(len(queues)) if find(j) == root):
+                        return False
+
+    def _apply(self, idx, new):
+        """Move nodes ``idx`` to districts ``new`` and update ``broken``; returns what to undo."""
+        a = self.assignment
+        old = a[idx]
+        moved = old != new
+        idx, old, new = idx[moved], old[moved], new[moved]
+        undo = (idx, old, set(self.broken))
+        touched = set(old.tolist()) | set(new.tolist())
+        if not touched:
+            return undo
+
+        if len(idx) > self.recount_fraction * self.sizes[list(touched)].sum():
+            a[idx] = new
+            np.subtract.at(self.sizes, old, 1)
+            np.add.at(self.sizes, new, 1)
+            for d in touched:
+                self._set_broken(d, not self._recount(d))
+            return undo
+
+        # Connected: True, disconnected: False, or None if we've lost track and must recount
+        status = {d: d not in self.broken for d in touched}
+        for v, source, target in zip(idx.tolist(), old.tolist(), new.tolist()):
+            joins = self.sizes[target] == 0 or any(a[w] == target for w in self.adjacency[v])
+            a[v] = target
+            self.sizes[source] -= 1
+            self.sizes[target] += 1
+            if status[source]:
+                status[source] = self._connected_without(v, source)
+            elif status[source] is False:
+                status[source] = None # removing a node could also leave a broken district whole
+            if status[target]:
+                status[target] = joins
+            elif status[target] is False:
+                status[target] = None if joins else False
+        for d, connected in status.items():
+            self._set_broken(d, not (self._recount(d) if connected is None else connected))
+        return undo
+
+    def _set_broken(self, d, broken):
+        if broken:
+            self.broken.add(d)
+        else:
+            self.broken.discard(d)
+
+    def _flip_arrays(self, flips):
+        idx = np.fromiter((self.node_index[node] for node in flips), dtype=np.int64,
+                          count=len(flips))
+        new = np.fromiter((self.part_index[part] for part in flips.values()), dtype=np.int64,
+                          count=len(flips))
+        return idx, new
+
+    def flip(self, flips):
+        """
+        Move the nodes in ``flips`` (node -> new district, like a gerrychain Partition's flips)
+        and return whether the plan is contiguous afterwards.
+        """
+        self._apply(*self._flip_arrays(flips))
+        return self.is_contiguous()
+
+    def test(self, flips):
+        """Would the plan be contiguous after ``flips``? Leaves the tracker as it was."""
+        idx, old, broken = self._apply(*self._flip_arrays(flips))
+        contiguous = self.is_contiguous()
+        np.subtract.at(self.sizes, self.assignment[idx], 1)
+        np.add.at(self.sizes, old, 1)
+        self.assignment[idx] = old
+        self.broken = broken
+        return contiguous
+
+    def follow(self, partition):
+        """
+        Bring the tracker in line with ``partition``, using its flips when it is a child of the
+        last state seen (see DistrictTally.follow).
+        """
+        if partition is self._last:
+            return
+        if partition.parent is not None and partition.parent is self._last:
+            self.flip(partition.flips)
+        else:
+            self.reset(partition.assignment)
+        self._last = partition
+
+    def __call__(self, partition):
+        """Constraint interface: is ``partition`` (usually a proposal) contiguous?"""
+        # A proposal that passed last time has become the chain's state if this one grew from it
+        if self._proposal is not None and partition.parent is self._proposal:
+            self.follow(self._proposal)
+        self._proposal = None
+        if partition.parent is not None and partition.parent is self._last:
+            self._proposal = partition
+            return self.test(partition.flips)
+        self.follow(partition)
+        return self.is_contiguous()
+
+
+def contiguous_plans(indptr, indices, plans, num_districts=None):
+    """
+    For a (plans x nodes) array of district indices, whether each plan's districts are all
+    connected, as a boolean array. Each batch of plans is one graph: plan p's copy of node i is
+    node ``p * n + i``, and an edge is kept when both ends are in the same district of that plan,
+    so each connected component is one connected piece of one district. A plan is contiguous when
+    it has exactly as many pieces as it has (non-empty) districts.
+    """
+    plans = np.atleast_2d(np.asarray(plans))
+    n = plans.shape[1]
+    if num_districts is None:
+        num_districts = int(plans.max()) + 1
+    indptr = np.asarray(indptr)
+    src = np.repeat(np.arange(n), np.diff(indptr))
+    keep = src < np.asarray(indices)
+    u, v = src[keep], np.asarray(indices)[keep]
+
+    result = np.empty(len(plans), dtype=bool)
+    for start in range(0, len(plans), BATCH_SIZE):
+        batch = plans[start:start + BATCH_SIZE]
+        rows, edges = np.nonzero(batch[:, u] == batch[:, v])
+        offsets = rows * n
+        size = len(batch) * n
+        union = sp.csr_matrix((np.ones(len(rows), dtype=np.int8),
+                               (offsets + u[edges], offsets + v[edges])), shape=(size, size))
+        _, labels = connected_components(union, directed=False)
+        # Pieces per plan: components, each counted at the plan of any one of its nodes
+        first = np.empty(labels.max() + 1, dtype=np.int64)
+        first[labels] = np.arange(size)
+        pieces = np.bincount(first // n, minlength=len(batch))
+        present = np.zeros((len(batch), num_districts), dtype=bool)
+        present[np.repeat(np.arange(len(batch)), n), batch.ravel()] = True
+        result[start:start + len(batch)] = pieces == present.sum(axis=1)
+    return result
@@ -0,0 +1,274 @@
+"""
+Every contiguous, population-balanced districting plan of a small graph (grids up to about 7x7).
+
+Sets of nodes are Python ints used as bitmasks (bit i is the i-th node), so a district, the nodes
+still to assign and each node's neighbourhood are single ints and set operations are one machine
+instruction instead of an nx.subgraph + nx.is_connected call.
+
+A plan is built one district at a time: the next district is a connected set containing the lowest
+numbered node that is still unassigned, so every plan is produced exactly once. Two things keep
+this fast:
+
+* Connected sets are grown from that node with an include/exclude search that produces each set
+  once and stops as soon as the population is over the limit.
+* What's left after carving out a district only depends on the set of unassigned nodes, so the
+  number of ways to finish a plan (and the distribution of cut edges and seats over those ways) is
+  memoized on that bitmask. Plans are streamed from a generator, and the memo means it never walks
+  into a dead end.
+
+Counting the 451,206 plans of a 6x6 grid into 6 districts takes a few seconds, and the 158,753,814
+plans of a 7x7 grid into 7 districts a few minutes, versus checking each candidate plan's districts
+with nx.subgraph + nx.is_connected, which is already minutes for a 4x4 grid.
+
+    >>> enum = PlanEnumerator(nx.grid_graph([5, 5]), 5)
+    >>> enum.count()
+    4006
+"""
+import math
+from collections import Counter
+
+# Masks are split into bytes to look up population sums in per-byte tables
+_BYTE = 8
+
+
+def _bits(mask):
+    """Indices of the bits set in ``mask``, lowest first."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class PlanEnumerator:
+    """
+    All plans of ``graph`` with ``num_districts`` connected districts whose populations (the
+    ``pop_col`` node attribute, or one per node by default) are within ``epsilon`` of ideal.
+    ``votes`` is an optional pair of vote columns ``(a, b)``; a district is a seat for ``a`` when
+    it has strictly more ``a`` votes.
+
+    Nodes are numbered in the graph's node order. For grids, row by row (nx.grid_graph's order)
+    keeps the searches small.
+    """
+
+    def __init__(self, graph, num_districts, pop_col=None, epsilon=0.0, votes=None):
+        self.graph = graph
+        self.nodes = list(graph.nodes)
+        self.num_districts = num_districts
+        index = {node: i for i, node in enumerate(self.nodes)}
+        self.neighbors = [0] * len(self.nodes)
+        for u, v in graph.edges:
+            self.neighbors[index[u]] |= 1 << index[v]
+            self.neighbors[index[v]] |= 1 << index[u]
+        self.all_nodes = (1 << len(self.nodes)) - 1
+        self._neighbor_table = self._tables(self.neighbors, combine=int.__or__)
+
+        pops = [1 if pop_col is None else graph.nodes[n][pop_col] for n in self.nodes]
+        self._pop_table = self._tables(pops)
+        ideal = sum(pops) / num_districts
+        self.min_pop = ideal * (1 - epsilon)
+        self.max_pop = ideal * (1 + epsilon)
+        if all(isinstance(p, int) for p in pops):
+            # Whole numbers: round the bounds inwards so comparisons are exact
+            self.min_pop = math.ceil(self.min_pop - 1e-9)
+            self.max_pop = math.floor(self.max_pop + 1e-9)
+        self._pops = pops
+
+        self._vote_tables = None
+        if votes is not None:
+            self._vote_tables = tuple(self._tables([graph.nodes[n][col] for n in self.nodes])
+                                      for col in votes)
+        self._memo = {}
+
+    def _tables(self, values, combine=int.__add__):
+        """
+        For each byte of a mask, ``values`` combined (summed by default) over the nodes of every
+        possible value of that byte.
+        """
+        tables = []
+        for start in range(0, len(values), _BYTE):
+            chunk = values[start:start + _BYTE]
+            table = [0] * (1 << len(chunk))
+            for byte in range(1, len(table)):
+                low = byte & -byte
+                table[byte] = combine(table[byte ^ low], chunk[low.bit_length() - 1])
+            tables.append(table)
+        return tables
+
+    def _sum(self, tables, mask):
+        total = 0
+        for table in tables:
+            total += table[mask & 0xFF]
+            mask >>= _BYTE
+        return total
+
+    def _reach(self, mask):
+        """Every node adjacent to a node of ``mask``."""
+        reached = 0
+        for table in self._neighbor_table:
+            reached |= table[mask & 0xFF]
+            mask >>= _BYTE
+        return reached
+
+    def population(self, mask):
+        """Total population of the nodes in ``mask``."""
+        return self._sum(self._pop_table, mask)
+
+    def seats(self, mask):
+        """1 if party ``a`` wins the district ``mask``, else 0 (always 0 without ``votes``)."""
+        if self._vote_tables is None:
+            return 0
+        a, b = self._vote_tables
+        return int(self._sum(a, mask) > self._sum(b, mask))
+
+    def components(self, mask):
+        """The connected components of the subgraph induced by ``mask``, as masks."""
+        while mask:
+            component = frontier = mask & -mask
+            while frontier:
+                frontier = self._reach(frontier) & mask & ~component
+                component |= frontier
+            yield component
+            mask &= ~component
+
+    def is_connected(self, mask):
+        return next(self.components(mask), 0) == mask
+
+    def _fillable(self, mask, parts):
+        """
+        Can the nodes in ``mask`` possibly be split into ``parts`` districts? Each connected piece
+        needs a whole number of districts' worth of population.
+        """
+        fewest = most = 0
+        for component in self.components(mask):
+            pop = self.population(component)
+            low = math.ceil(pop / self.max_pop - 1e-9)
+            high = math.floor(pop / self.min_pop + 1e-9) if self.min_pop > 0 else parts
+            if low > high:
+                return False
+            fewest += low
+            most += high
+            if fewest > parts:
+                return False
+        return fewest <= parts <= most
+
+    def districts(self, root, allowed):
+        """
+        Every connected set of nodes in ``allowed`` containing node ``root`` whose population is
+        within bounds, each once, as ``(mask, population)``.
+        """
+        neighbors, pops = self.neighbors, self._pops
+        min_pop, max_pop = self.min_pop, self.max_pop
+        # Each entry is a connected set still to report and extend: (set, population, nodes it
+        # may grow into, nodes it must leave out)
+        start = 1 << root
+        stack = [(start, pops[root], neighbors[root] & allowed, start)]
+        while stack:
+            district, pop, frontier, excluded = stack.pop()
+            if pop >= min_pop:
+                yield district, pop
+            while frontier:
+                low = frontier & -frontier
+                frontier ^= low
+                u = low.bit_length() - 1
+                if pop + pops[u] <= max_pop:
+                    new = neighbors[u] & allowed & ~district & ~excluded & ~frontier & ~low
+                    stack.append((district | low, pop + pops[u], frontier | new, excluded))
+                # Sets with u come from the entry just pushed; the rest of this one leave u out
+                excluded |= low
+
+    def _splits(self, remaining, parts):
+        """
+        The first district of each way to split ``remaining``, with its cut edges, seat and the
+        distribution of ways to split the rest.
+        """
+        root = (remaining & -remaining).bit_length() - 1
+        for district, _ in self.districts(root, remaining):
+            rest = remaining & ~district
+            if not rest:
+                continue
+            finish = self._distribution(rest, parts - 1)
+            if not finish:
+                continue
+            cut = sum((self.neighbors[u] & rest).bit_count() for u in _bits(district))
+            yield district, rest, cut, self.seats(district), finish
+
+    def _distribution(self, remaining, parts):
+        """
+        Counter of ``(cut edges, seats) -> number of ways`` to split ``remaining`` into ``parts``
+        districts, counting only edges inside ``remaining``.
+        """
+        key = (remaining, parts)
+        if key in self._memo:
+            return self._memo[key]
+        result = Counter()
+        if parts == 1:
+            if (self.min_pop <= self.population(remaining) <= self.max_pop
+                    and self.is_connected(remaining)):
+                result[(0, self.seats(remaining))] = 1
+        elif self._fillable(remaining, parts):
+            # Dead ends are memoized too (as empty Counters), so they are only checked once
+            for _, _, cut, seat, finish in self._splits(remaining, parts):
+                for (c, s), n in finish.items():
+                    result[(c + cut, s + seat)] += n
+        self._memo[key] = result
+        return result
+
+    def joint_distribution(self):
+        """Counter of ``(cut edges, seats for a) -> number of plans``, over all plans."""
+        return Counter(self._distribution(self.all_nodes, self.num_districts))
+
+    def count(self):
+        """The number of plans."""
+        return sum(self.joint_distribution().values())
+
+    def cut_edge_distribution(self):
+        """Counter of ``cut edges -> number of plans``."""
+        result = Counter()
+        for (cut, _), n in self.joint_distribution().items():
+            result[cut] += n
+        return result
+
+    def seat_distribution(self):
+        """Counter of ``seats for a -> number of plans`` (needs ``votes``)."""
+        if self._vote_tables is None:
+            raise ValueError("seat_distribution needs the votes=(a, b) columns")
+        result = Counter()
+        for (_, seats), n in self.joint_distribution().items():
+            result[seats] += n
+        return result
+
+    def _plans(self, remaining, parts):
+        if parts == 1:
+            yield (remaining,)
+            return
+        for district, rest, _, _, _ in self._splits(remaining, parts):
+            for tail in self._plans(rest, parts - 1):
+                yield (district,) + tail
+
+    def plan_masks(self):
+        """Stream every plan as a tuple of ``num_districts`` district bitmasks."""
+        if self._distribution(self.all_nodes, self.num_districts):
+            yield from self._plans(self.all_nodes, self.num_districts)
+
+    def to_plan(self, masks):
+        """A tuple of district masks as a ``{node: district}`` dictionary like ``distplan``."""
+        return {self.nodes[i]: d for d, mask in enumerate(masks) for i in _bits(mask)}
+
+    def plans(self):
+        """Stream every plan as a ``{node: district}`` dictionary."""
+        for masks in self.plan_masks():
+            yield self.to_plan(masks)
+
+
+if __name__ == "__main__":
+    import time
+
+    import networkx as nx
+
+    for size in range(3, 7):
+        start = time.perf_counter()
+        enum = PlanEnumerator(nx.grid_graph([size, size]), size)
+        cut_edges = enum.cut_edge_distribution()
+        print(f"{size}x{size} grid, {size} districts: {enum.count()} plans, "
+              f"cut edges {min(cut_edges)}-{max(cut_edges)} "
+              f"({time.perf_counter() - start:.2f}s)")
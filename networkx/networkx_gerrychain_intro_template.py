@@ -119,6 +119,21 @@ for i in range(4):
     print(f"Is district {i} connected? {nx.is_connected(district)}")
 # -
 
+# Checking plans one at a time like this is fine for a few plans. To get *every* connected,
+# population-balanced plan of a small grid (and the exact distribution of cut edges over them),
+# see enumerate_plans.py:
+# ```
+# from enumerate_plans import PlanEnumerator
+# PlanEnumerator(nx.grid_graph([4,4]), 4).cut_edge_distribution()
+# ```
+# And to check plans over and over as nodes change district (like in a chain), contiguity.py keeps
+# track of which districts are connected without rebuilding subgraphs:
+# ```
+# from contiguity import ContiguityTracker
+# tracker = ContiguityTracker.from_graph(grid, distplan)
+# tracker.test({(0,0): 2})  # would moving (0,0) to district 2 keep every district connected?
+# ```
+
 # ### Cut edges can be used as a compactness score.  
 # Below we count the cut edges.  Note that `e[0]` and `e[1]` access the endpoints of each edge.
 
@@ -176,6 +191,8 @@ print("Number of Nodes: ")
 print("Number of Edges: ")
 
 # Note that drawing the dual graph isn't that useful with this many nodes.  (It also takes a minute).
+# (alaska/render.py's PlanRenderer draws graphs this size in well under a second, and redraws other
+# plans on the same graph even faster.)
 
 plt.figure() 
 nx.draw(pa_graph, node_size = 10,  node_color = "pink")
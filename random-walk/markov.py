@@ -0,0 +1,227 @@
+"""
+Markov chains with large, sparse transition matrices.
+
+A transition matrix T is a scipy.sparse CSR matrix with T[i, j] the probability of going from state
+i to state j, and distributions are row vectors, so one step of the chain is ``x @ T`` like in
+random-walk.py. Nothing here makes a dense n x n matrix except for tiny chains, so chains with
+millions of states (for example every plan of a small graph, with recom or flip moves between them)
+can be analysed exactly: the distribution after k steps, the stationary distribution and how long
+the chain takes to mix.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import eigs
+
+# How far from 1 a row sum can be before we call it a mistake
+ROW_SUM_TOLERANCE = 1e-8
+# Largest residual |pi @ T - pi|_1 we accept from the Krylov solver
+RESIDUAL_TOLERANCE = 1e-8
+# Chains this small get dense eigendecompositions, which ARPACK can't do for k >= n - 1
+DENSE_STATES = 100
+
+
+def transition_matrix(T):
+    """
+    Check that ``T`` (a dense array or any scipy.sparse matrix) is a square, nonnegative matrix
+    whose rows sum to 1, and return it as CSR.
+    """
+    T = sp.csr_matrix(T, dtype=np.float64)
+    if T.shape[0] != T.shape[1]:
+        raise ValueError(f"Transition matrix must be square, not {T.shape}")
+    if T.nnz and T.data.min() < 0:
+        raise ValueError("Transition matrix has negative entries")
+    sums = np.asarray(T.sum(axis=1)).ravel()
+    bad = np.flatnonzero(np.abs(sums - 1) > ROW_SUM_TOLERANCE)
+    if len(bad):
+        raise ValueError(f"{len(bad)} rows do not sum to 1 (state {bad[0]} sums to {sums[bad[0]]})")
+    return T
+
+
+def from_transitions(src, dst, prob, num_states):
+    """
+    Build a transition matrix from three arrays listing each move ``src -> dst`` with probability
+    ``prob``. Repeated (src, dst) pairs are added together, so a chain's proposals can be listed
+    one at a time.
+    """
+    T = sp.coo_matrix((prob, (src, dst)), shape=(num_states, num_states)).tocsr()
+    T.sum_duplicates()
+    return transition_matrix(T)
+
+
+def point_mass(num_states, states):
+    """One distribution per state in ``states``, each with all its mass on that state."""
+    states = np.atleast_1d(states)
+    x = np.zeros((len(states), num_states))
+    x[np.arange(len(states)), states] = 1
+    return x
+
+
+def step(x, T):
+    """
+    One step of the chain for a distribution ``x`` or a batch of distributions (one per row).
+    """
+    # (x @ T) == (T^T @ x^T)^T, and sparse @ dense is the product scipy does fast
+    return np.asarray(T.T @ np.asarray(x, dtype=np.float64).T).T
+
+
+def evolve(x, T, steps):
+    """Distribution(s) after ``steps`` steps from ``x``: ``steps`` sparse matrix-vector products."""
+    Tt = T.T.tocsr()
+    x = np.asarray(x, dtype=np.float64)
+    for _ in range(steps):
+        x = np.asarray(Tt @ x.T).T
+    return x
+
+
+def matrix_power(T, k):
+    """
+    ``T**k`` by repeated squaring (about 2 log2(k) sparse products). Powers of a sparse matrix fill
+    in, so this is for chains small enough (or k small enough) that ``T**k`` fits in memory; use
+    evolve() to follow a few distributions instead.
+    """
+    result = sp.identity(T.shape[0], format="csr")
+    power = sp.csr_matrix(T)
+    while k:
+        if k & 1:
+            result = result @ power
+        k >>= 1
+        if k:
+            power = power @ power
+    return result.tocsr()
+
+
+def residual(pi, T):
+    """L1 distance between ``pi`` and ``pi @ T``: zero exactly when ``pi`` is stationary."""
+    return np.abs(step(pi, T) - np.asarray(pi)).sum(axis=-1)
+
+
+def is_stationary(pi, T, tol=1e-10):
+    """Is ``pi`` stationary for T, up to floating point error (``residual(pi, T) <= tol``)?"""
+    return bool(np.all(residual(pi, T) <= tol))
+
+
+@dataclass
+class StationaryResult:
+    """A stationary distribution and how the solver got there."""
+    pi: np.ndarray
+    method: str
+    iterations: int
+    residual: float
+    converged: bool
+
+
+def _normalize(x):
+    x = np.abs(np.real(x))
+    return x / x.sum()
+
+
+def stationary_distribution(T, method="power", tol=1e-12, max_iter=100000, x0=None,
+                            lazy=False):
+    """
+    Solve ``pi = pi @ T`` for an irreducible chain.
+
+    ``method="power"`` repeats ``x <- x @ T`` from ``x0`` (uniform by default) until the L1 change
+    in one step is below ``tol``. A periodic chain never converges this way; ``lazy=True`` iterates
+    the lazy chain (I + T)/2 instead, which has the same stationary distribution and is aperiodic.
+
+    ``method="krylov"`` asks ARPACK for the eigenvector of T^T with eigenvalue 1, which usually
+    takes far fewer matrix-vector products when the chain mixes slowly. Chains with at most
+    DENSE_STATES states (too small for ARPACK) are solved with a dense eigendecomposition instead.
+    """
+    T = sp.csr_matrix(T)
+    n = T.shape[0]
+    if method == "krylov":
+        if n <= DENSE_STATES:
+            values, vectors = np.linalg.eig(T.toarray().T)
+            pi = _normalize(vectors[:, np.argmin(np.abs(values - 1))])
+        else:
+            # The eigenvalue 1 has the largest real part of any eigenvalue of a stochastic matrix
+            _, vectors = eigs(T.T.tocsr(), k=1, which="LR", tol=tol, maxiter=max_iter, v0=x0)
+            pi = _normalize(vectors[:, 0])
+        r = float(residual(pi, T))
+        return StationaryResult(pi, method, 0, r, r <= RESIDUAL_TOLERANCE)
+    if method != "power":
+        raise ValueError(f"Unknown method {method!r}: use 'power' or 'krylov'")
+
+    Tt = T.T.tocsr()
+    x = np.full(n, 1 / n) if x0 is None else _normalize(x0)
+    change = np.inf
+    for iteration in range(1, max_iter + 1):
+        y = Tt @ x
+        if lazy:
+            y = (x + y) / 2
+        y /= y.sum() # keep rounding error from building up
+        change = np.abs(y - x).sum()
+        x = y
+        if change <= tol:
+            break
+    return StationaryResult(x, method, iteration, float(residual(x, T)), change <= tol)
+
+
+def total_variation(p, q):
+    """Total variation distance between distributions (row by row for 2-D arrays)."""
+    return 0.5 * np.abs(np.asarray(p) - np.asarray(q)).sum(axis=-1)
+
+
+@dataclass
+class MixingResult:
+    """
+    ``time`` is the first step at which every starting state in ``starts`` is within ``eps`` of
+    ``pi`` in total variation (None if that did not happen within max_steps), and ``distances[t]``
+    the worst distance after t steps. (Batches stop being evolved once they are within eps, so at
+    ``time`` itself the recorded worst distance is only known to be below eps.)
+    """
+    time: int
+    eps: float
+    starts: np.ndarray
+    distances: np.ndarray
+
+
+def mixing_time(T, eps=0.25, pi=None, starts=None, max_steps=10000, batch_size=64):
+    """
+    Estimate the mixing time ``t_mix(eps) = min{t : max_x TV(x @ T**t, pi) <= eps}`` by evolving
+    point masses on the states in ``starts`` exactly. The default is every state, which gives the
+    true mixing time; on big chains pass a sample of states (e.g. the ones a sampled chain visits
+    most, or the extremes of some score), which gives a lower bound. Starting states are evolved
+    ``batch_size`` at a time as one (states x batch) sparse-dense product per step.
+    """
+    T = sp.csr_matrix(T)
+    n = T.shape[0]
+    if pi is None:
+        pi = stationary_distribution(T, method="krylov").pi
+    starts = np.arange(n) if starts is None else np.atleast_1d(starts)
+    Tt = T.T.tocsr()
+
+    worst = np.zeros(max_steps + 1)
+    for begin in range(0, len(starts), batch_size):
+        x = point_mass(n, starts[begin:begin + batch_size])
+        worst[0] = max(worst[0], total_variation(x, pi).max())
+        for t in range(1, max_steps + 1):
+            x = np.asarray(Tt @ x.T).T
+            d = total_variation(x, pi).max()
+            worst[t] = max(worst[t], d)
+            # Distance to stationarity never increases with t, so this batch stays within eps
+            if d <= eps:
+                break
+    below = np.flatnonzero(worst <= eps)
+    if not len(below):
+        return MixingResult(None, eps, starts, worst)
+    return MixingResult(int(below[0]), eps, starts, worst[:below[0] + 1])
+
+
+def relaxation_time(T, tol=1e-10):
+    """
+    ``1 / (1 - |lambda_2|)`` for the second largest eigenvalue modulus of T. For a reversible
+    chain, ``t_mix(eps) <= t_rel * log(1 / (eps * min(pi)))`` and ``t_mix(eps) >= (t_rel - 1) *
+    log(1 / (2 eps))``, which brackets the mixing time without evolving any distributions.
+    """
+    T = sp.csr_matrix(T)
+    if T.shape[0] <= DENSE_STATES:
+        values = np.linalg.eigvals(T.toarray())
+    else:
+        values = eigs(T.T.tocsr(), k=2, which="LM", tol=tol, return_eigenvectors=False)
+    moduli = np.sort(np.abs(values))[::-1]
+    second = moduli[1]
+    return np.inf if second >= 1 - tol else 1 / (1 - second)
@@ -17,6 +17,7 @@
 # +
 import numpy as np
 import matplotlib.pyplot as plt 
+import markov
 T = np.array([[ 0 , 0.6 , 0.4], 
               [0.5, 0.1 , 0.4],
               [0.8,  0 ,  0.2]])
@@ -52,4 +53,11 @@ print(f"DEBUG: pi: {pi}")
 pi_prime = np.matmul(pi,T)
 print(f"DEBUG: pi_prime: {pi_prime}")
 
-print(f"Stationary distribution? {pi == pi_prime}")
+# Compare up to floating point error: pi @ T is rounded differently from pi itself, so comparing
+# the floats with == can say no even for the true stationary distribution
+print(f"Stationary distribution? {markov.is_stationary(pi, T)}")
+
+# Or solve for it directly; markov works the same way for sparse matrices with millions of states
+result = markov.stationary_distribution(markov.transition_matrix(T))
+print(f"Stationary distribution: {result.pi} ({result.iterations} iterations)")
+print(f"Mixing time: {markov.mixing_time(T).time} steps")
@@ -0,0 +1,325 @@
+"""
+Ensemble statistics computed as the chain runs, in a fixed amount of memory however long it runs.
+
+Every step's district totals (the DistrictTally array, or a block of them read back from a store)
+are turned into, for each election, the number of Republican seats, the mean-median score and the
+efficiency gap, using gerrychain's conventions: positive means an advantage for the first column
+of the pair (the Republican one in ensemble.ELECTIONS). Each metric feeds
+
+* a histogram with fixed-width bins that are only created when a value lands in them (seats get
+  one bin per whole number, so the bins fit whatever range the chain explores),
+* running mean, variance, min and max (Welford's algorithm),
+* P-squared estimators (Jain and Chlamtac, 1985) for a few quantiles, five numbers each.
+
+An enacted plan (like PA's CD_2011) can then be placed in the ensemble as a percentile.
+"""
+import math
+from collections import Counter
+
+import numpy as np
+
+from tally import DistrictTally
+
+METRICS = ["seats", "mean_median", "efficiency_gap"]
+
+# Histogram bin widths; seats bins are centred on whole numbers
+BIN_WIDTHS = {"seats": 1.0, "mean_median": 0.0025, "efficiency_gap": 0.0025}
+BIN_ORIGINS = {"seats": -0.5, "mean_median": 0.0, "efficiency_gap": 0.0}
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def election_scores(first, second):
+    """
+    Seats, mean-median and efficiency gap for the first party, from its votes ``first`` and the
+    other party's ``second`` in each district. Both are (..., districts) arrays, so a whole block
+    of steps is scored at once; each score has shape (...).
+    """
+    first = np.asarray(first, dtype=np.float64)
+    second = np.asarray(second, dtype=np.float64)
+    total = first + second
+    wins = first > second
+    share = first / total
+    # Wasted votes: all of the loser's, and the winner's beyond half of the district's votes
+    first_waste = np.where(wins, first - total / 2, first)
+    second_waste = np.where(wins, second, second - total / 2)
+    return {
+        "seats": wins.sum(axis=-1),
+        "mean_median": np.median(share, axis=-1) - share.mean(axis=-1),
+        "efficiency_gap": (second_waste - first_waste).sum(axis=-1) / total.sum(axis=-1),
+    }
+
+
+class Histogram:
+    """
+    Counts of values in bins ``[origin + i * width, origin + (i + 1) * width)``, stored only for
+    the bins that have been hit.
+    """
+
+    def __init__(self, width=1.0, origin=0.0):
+        self.width = width
+        self.origin = origin
+        self.counts = Counter()
+        self.total = 0
+
+    def _bins(self, values):
+        return np.floor((np.asarray(values, dtype=np.float64) - self.origin) / self.width)
+
+    def add(self, values):
+        values = np.atleast_1d(values)
+        values = values[np.isfinite(values)]
+        bins, counts = np.unique(self._bins(values).astype(np.int64), return_counts=True)
+        for b, n in zip(bins.tolist(), counts.tolist()):
+            self.counts[b] += n
+        self.total += len(values)
+
+    def merge(self, other):
+        if (other.width, other.origin) != (self.width, self.origin):
+            raise ValueError("Can only merge histograms with the same bins")
+        self.counts.update(other.counts)
+        self.total += other.total
+
+    def edges_and_counts(self):
+        """``(edges, counts)`` like np.histogram's, from the lowest bin hit to the highest."""
+        if not self.counts:
+            return np.array([self.origin, self.origin + self.width]), np.zeros(1, dtype=np.int64)
+        low, high = min(self.counts), max(self.counts)
+        edges = self.origin + self.width * np.arange(low, high + 2)
+        counts = np.array([self.counts.get(b, 0) for b in range(low, high + 1)], dtype=np.int64)
+        return edges, counts
+
+    def percentile(self, value):
+        """
+        Percentage of values below ``value``, counting the values in its own bin as half below
+        (the mid-rank, so a value in the middle of a tie is at 50). Exact for seats.
+        """
+        if not self.total:
+            return math.nan
+        b = int(self._bins(value))
+        below = sum(n for k, n in self.counts.items() if k < b)
+        return 100 * (below + self.counts.get(b, 0) / 2) / self.total
+
+    def quantile(self, q):
+        """The centre of the bin holding the q-th quantile."""
+        if not self.total:
+            return math.nan
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= q * self.total:
+                return self.origin + (b + 0.5) * self.width
+        return self.origin + (max(self.counts) + 0.5) * self.width
+
+
+class RunningStats:
+    """Count, mean, variance, min and max of a stream (Welford), mergeable across chains."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        values = values[np.isfinite(values)]
+        if len(values):
+            batch = RunningStats()
+            batch.count = len(values)
+            batch.mean = float(values.mean())
+            batch.m2 = float(((values - batch.mean) ** 2).sum())
+            batch.min = float(values.min())
+            batch.max = float(values.max())
+            self.merge(batch)
+
+    def merge(self, other):
+        """Chan et al.'s pairwise update, so chains (or batches of steps) combine exactly."""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class P2Quantile:
+    """
+    Streaming estimate of the ``p`` quantile from five markers (the P-squared algorithm): the
+    minimum, the p/2, p and (1+p)/2 quantiles and the maximum, nudged with a parabolic fit as
+    values arrive.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        h, n = self.heights, self.positions
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if h[i] <= x < h[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = self._parabolic(i, d)
+                if not h[i - 1] < candidate < h[i + 1]:
+                    candidate = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                h[i] = candidate
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        h, n = self.heights, self.positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+
+    @property
+    def value(self):
+        if not self.heights:
+            return math.nan
+        if len(self.heights) < 5:
+            # Too few values for the markers yet: the exact quantile of what we have
+            return float(np.quantile(self.heights, self.p))
+        return self.heights[2]
+
+
+class MetricSummary:
+    """Histogram, running statistics and quantile estimates of one metric of one election."""
+
+    def __init__(self, width=1.0, origin=0.0, quantiles=QUANTILES):
+        self.histogram = Histogram(width, origin)
+        self.stats = RunningStats()
+        self.quantiles = {q: P2Quantile(q) for q in quantiles}
+
+    def add(self, values):
+        values = np.atleast_1d(values)
+        self.histogram.add(values)
+        self.stats.add(values)
+        if self.quantiles is not None:
+            for x in values[np.isfinite(values)].tolist():
+                for estimator in self.quantiles.values():
+                    estimator.add(x)
+
+    def merge(self, other):
+        """
+        Fold another chain's summary into this one. P-squared estimates can't be combined, so a
+        merged summary takes its quantiles from the merged histogram instead.
+        """
+        self.histogram.merge(other.histogram)
+        self.stats.merge(other.stats)
+        self.quantiles = None
+
+    def quantile(self, q):
+        if self.quantiles is not None and q in self.quantiles:
+            return self.quantiles[q].value
+        return self.histogram.quantile(q)
+
+
+class EnsembleAnalytics:
+    """
+    Streaming seats / mean-median / efficiency gap summaries for every election in ``elections``
+    (name -> (first column, second column)). ``columns`` is the column order of the totals arrays
+    that will be passed in, e.g. ``DistrictTally.columns`` or ``EnsembleReader.columns``.
+    """
+
+    def __init__(self, elections, columns, bin_widths=None, quantiles=QUANTILES):
+        self.elections = dict(elections)
+        self.columns = list(columns)
+        column_index = {name: j for j, name in enumerate(self.columns)}
+        self._pairs = {name: (column_index[a], column_index[b])
+                       for name, (a, b) in self.elections.items()}
+        widths = dict(BIN_WIDTHS, **(bin_widths or {}))
+        self.summaries = {name: {metric: MetricSummary(widths[metric], BIN_ORIGINS[metric],
+                                                       quantiles)
+                                 for metric in METRICS}
+                          for name in self.elections}
+        self.steps = 0
+
+    def scores(self, totals):
+        """``{election: {metric: values}}`` for a (districts x columns) or (steps x ...) array."""
+        totals = np.asarray(totals)
+        return {name: election_scores(totals[..., a], totals[..., b])
+                for name, (a, b) in self._pairs.items()}
+
+    def update(self, totals):
+        """Add one step's (districts x columns) totals, or a (steps x districts x columns) block."""
+        totals = np.asarray(totals)
+        for name, scores in self.scores(totals).items():
+            for metric, values in scores.items():
+                self.summaries[name][metric].add(values)
+        self.steps += 1 if totals.ndim == 2 else len(totals)
+
+    def update_from_store(self, reader):
+        """Add every step of an EnsembleReader, a shard at a time."""
+        if list(reader.columns) != self.columns:
+            raise ValueError(f"Store columns {reader.columns} don't match {self.columns}")
+        for _, totals in reader.shards():
+            self.update(totals)
+
+    def merge(self, other):
+        for name, metrics in other.summaries.items():
+            for metric, summary in metrics.items():
+                self.summaries[name][metric].merge(summary)
+        self.steps += other.steps
+
+    def __getitem__(self, key):
+        """``analytics["Pres", "seats"]`` is the MetricSummary of that election and metric."""
+        name, metric = key
+        return self.summaries[name][metric]
+
+    def plan_scores(self, graph, assignment):
+        """Scores of one plan (e.g. the enacted one) given as a node -> district mapping."""
+        tally = DistrictTally(graph, self.columns, assignment)
+        return {name: {metric: float(v) for metric, v in scores.items()}
+                for name, scores in self.scores(tally.totals).items()}
+
+    def percentiles(self, scores):
+        """Where each of ``scores`` (as returned by plan_scores) falls in the ensemble."""
+        return {name: {metric: self.summaries[name][metric].histogram.percentile(value)
+                       for metric, value in metrics.items()}
+                for name, metrics in scores.items()}
+
+    def report(self, enacted=None):
+        """A text table of every summary, with the enacted plan's scores if given."""
+        lines = [f"{self.steps} plans"]
+        percentiles = None if enacted is None else self.percentiles(enacted)
+        for name, metrics in self.summaries.items():
+            for metric, summary in metrics.items():
+                s = summary.stats
+                line = (f"{name:>6} {metric:<15} mean {s.mean:8.4f}  sd {s.std:7.4f}  "
+                        f"5-50-95% {summary.quantile(0.05):8.4f} {summary.quantile(0.5):8.4f} "
+                        f"{summary.quantile(0.95):8.4f}")
+                if enacted is not None:
+                    line += (f"  enacted {enacted[name][metric]:8.4f} "
+                             f"(percentile {percentiles[name][metric]:5.1f})")
+                lines.append(line)
+        return "\n".join(lines)
@@ -0,0 +1,445 @@
+"""
+Time the work the scripts in this repo actually spend their time on, with fixed seeds and repeated
+trials, and save the timings as JSON so two commits can be compared.
+
+Workloads (each one is skipped, with the reason recorded, when its data or packages are missing):
+
+* load      Graph.from_file("PA/PA.shp") / Graph.from_json("ak-bg-connected.json"), or building
+            a synthetic grid
+* cached    graph_cache.load_graph(...).to_graph() on a warm cache
+* seed      recursive_tree_part for PA into 18 districts, AK into 20, a grid into --grid-districts
+* recom     recom steps per second with the five Tally updaters of recombination/main.py
+            (population, and R and D votes for the 2016 Presidential and Senate elections)
+* cut_edges counting the cut edges of a plan with gerrychain's updater
+* cut_edges_np  the same with NumPy edge arrays (alaska/metrics.py)
+* ei_fit    the TwoByTwoEI fit of ecological-inference/main.py on the Waterbury data
+
+Synthetic n x n grid graphs (random populations and votes from --seed) chart how the graph
+workloads scale:
+
+    $ python benchmark.py --output before.json
+    $ python benchmark.py --datasets grid --grid 10 20 40 80 --workloads seed recom cut_edges
+    $ python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timezone
+from functools import partial
+
+import networkx as nx
+import numpy as np
+from gerrychain import Graph, Partition, MarkovChain, constraints
+from gerrychain.accept import always_accept
+from gerrychain.proposals import recom
+from gerrychain.tree import recursive_tree_part, BalanceError, PopulationBalanceError
+from gerrychain.updaters import Tally, cut_edges
+
+from graph_cache import load_graph
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.join(HERE, "..")
+
+# What recursive_tree_part raises when it gives up on a plan
+SEED_ERRORS = (RuntimeError, BalanceError, PopulationBalanceError)
+
+WORKLOADS = ["load", "cached", "seed", "recom", "cut_edges", "cut_edges_np", "ei_fit"]
+
+# Seeds tried, one after another, for the seed plan the recom and cut edge workloads start from
+PLAN_ATTEMPTS = 20
+
+
+@dataclass
+class Dataset:
+    """A graph (or table) the workloads run on, and the settings main.py uses for it."""
+    name: str
+    path: str = None
+    pop_col: str = "TOTPOP"
+    num_dist: int = 18
+    pop_tolerance: float = 0.02
+    tally_cols: list = field(default_factory=list)
+    grid_size: int = None
+
+
+# The five Tally updaters of recombination/main.py
+PA_TALLIES = ["TOTPOP", "T16PRESR", "T16PRESD", "T16SENR", "T16SEND"]
+
+DATASETS = {
+    "pa": Dataset("pa", os.path.join(HERE, "PA", "PA.shp"), "TOTPOP", 18, 0.02, PA_TALLIES),
+    "ak": Dataset("ak", os.path.join(REPO, "alaska", "ak-bg-connected.json"), "TOTPOP20", 20,
+                  0.02, ["TOTPOP20", "AMINPOP20"]),
+    "waterbury": Dataset("waterbury",
+                         os.path.join(REPO, "ecological-inference", "WaterburySampleData.csv")),
+}
+
+
+class Skipped(Exception):
+    """A workload can't run here (missing data file or package); the message says why."""
+
+
+@dataclass
+class BenchmarkResult:
+    """Timings of one workload on one dataset. ``times`` are seconds, one per trial."""
+    dataset: str
+    workload: str
+    times: list = field(default_factory=list)
+    # Work done per trial, for rates: e.g. 100 recom steps
+    per_trial: float = None
+    unit: str = None
+    status: str = "ok"
+    reason: str = None
+    extra: dict = field(default_factory=dict)
+
+    def summary(self):
+        if not self.times:
+            return {}
+        times = sorted(self.times)
+        summary = {"min": times[0],
+                   "median": statistics.median(times),
+                   "mean": statistics.fmean(times),
+                   "std": statistics.stdev(times) if len(times) > 1 else 0.0,
+                   "max": times[-1]}
+        if self.per_trial:
+            summary[f"{self.unit}_per_second"] = self.per_trial / summary["median"]
+        return summary
+
+    def to_dict(self):
+        return dict(asdict(self), **self.summary())
+
+    def line(self):
+        name = f"{self.dataset:>12} {self.workload:<12}"
+        if self.status != "ok":
+            return f"{name} {self.status}: {self.reason}"
+        s = self.summary()
+        line = (f"{name} median {s['median']:9.4f}s  min {s['min']:9.4f}s  "
+                f"sd {s['std']:8.4f}s  ({len(self.times)} trials)")
+        if self.per_trial:
+            line += f"  {s[f'{self.unit}_per_second']:10.1f} {self.unit}/s"
+        return line
+
+
+def time_trials(run, trials, warmup=0, seed=0):
+    """
+    Call ``run()`` ``warmup`` times untimed, then ``trials`` times timed. The random modules are
+    seeded with ``seed + trial`` before every call, so each trial does the same work on every
+    commit.
+    """
+    times = []
+    for trial in range(-warmup, trials):
+        random.seed(seed + max(trial, 0))
+        np.random.seed((seed + max(trial, 0)) % 2**32)
+        start = time.perf_counter()
+        run()
+        if trial >= 0:
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def grid_dataset(n, num_dist):
+    return Dataset(f"grid-{n}x{n}", None, "TOTPOP", num_dist, 0.05, PA_TALLIES, grid_size=n)
+
+
+def make_grid(n, seed=0):
+    """
+    An n x n grid dual graph with nodes 0..n^2-1 and PA's columns: TOTPOP between 80 and 120 and
+    random vote counts for the 2016 elections.
+    """
+    rng = np.random.default_rng(seed)
+    graph = nx.convert_node_labels_to_integers(nx.grid_graph([n, n]))
+    pops = rng.integers(80, 121, n * n).tolist()
+    votes = rng.integers(0, 61, (n * n, 4)).tolist()
+    for v in graph.nodes:
+        graph.nodes[v]["TOTPOP"] = pops[v]
+        for col, count in zip(PA_TALLIES[1:], votes[v]):
+            graph.nodes[v][col] = count
+    return Graph.from_networkx(graph)
+
+
+def read_graph(dataset, seed=0):
+    """Load a dataset's graph the way the scripts do (without the cache)."""
+    if dataset.grid_size is not None:
+        return make_grid(dataset.grid_size, seed)
+    if dataset.path is None or not os.path.exists(dataset.path):
+        raise Skipped(f"{dataset.path} not found")
+    if dataset.path.endswith(".json"):
+        return Graph.from_json(dataset.path)
+    return Graph.from_file(dataset.path)
+
+
+def seed_plan(graph, dataset):
+    """One recursive_tree_part plan with the dataset's settings, as in main.py."""
+    ideal_pop = sum(graph.nodes[v][dataset.pop_col] for v in graph.nodes) / dataset.num_dist
+    return recursive_tree_part(graph, range(dataset.num_dist), ideal_pop, dataset.pop_col,
+                               dataset.pop_tolerance, 10)
+
+
+def seed_attempt(graph, dataset, failures):
+    """seed_plan, counting (rather than raising) the failures recursive_tree_part gives up with."""
+    try:
+        seed_plan(graph, dataset)
+    except SEED_ERRORS:
+        failures.append(1)
+
+
+def recom_chain(graph, dataset, plan, steps):
+    """
+    The chain of recombination/main.py starting from ``plan``: recom, the population constraint
+    and one Tally updater per tally column.
+    """
+    ideal_pop = sum(graph.nodes[v][dataset.pop_col] for v in graph.nodes) / dataset.num_dist
+    updaters = {col: Tally(col, alias = col) for col in dataset.tally_cols}
+    partition = Partition(graph, assignment = plan, updaters = updaters)
+    proposal = partial(recom,
+                       pop_col = dataset.pop_col,
+                       pop_target = ideal_pop,
+                       epsilon = dataset.pop_tolerance,
+                       node_repeats = 1)
+    population_constraint = constraints.within_percent_of_ideal_population(
+        partition, dataset.pop_tolerance, pop_key = dataset.pop_col)
+    return MarkovChain(proposal = proposal,
+                       constraints = [population_constraint],
+                       accept = always_accept,
+                       initial_state = partition,
+                       total_steps = steps)
+
+
+def run_recom(graph, dataset, plan, steps):
+    """Run the chain, reading every tally at every step like main.py's seat counts do."""
+    for part in recom_chain(graph, dataset, plan, steps):
+        for col in dataset.tally_cols:
+            part[col] # pylint: disable=pointless-statement
+
+
+class Benchmark:
+    """Runs the chosen workloads on each dataset, reusing its graph and seed plan between them."""
+
+    def __init__(self, workloads=None, trials=5, warmup=1, seed=0, steps=100, ei_draws=1200,
+                 ei_tune=3000):
+        self.workloads = list(workloads or WORKLOADS)
+        self.trials = trials
+        self.warmup = warmup
+        self.seed = seed
+        self.steps = steps
+        self.ei_draws = ei_draws
+        self.ei_tune = ei_tune
+
+    def run(self, datasets, report=print):
+        results = []
+        for dataset in datasets:
+            state = {}
+            for workload in self.workloads:
+                result = self.run_workload(workload, dataset, state)
+                if result is None:
+                    continue
+                if report is not None:
+                    report(result.line())
+                results.append(result)
+        return results
+
+    def run_workload(self, workload, dataset, state):
+        """Time one workload, or record why it was skipped. None if it doesn't apply."""
+        is_table = dataset.path is not None and dataset.path.endswith(".csv")
+        if (workload == "ei_fit") != is_table:
+            return None
+        if workload == "cached" and dataset.grid_size is not None:
+            return None
+        result = BenchmarkResult(dataset.name, workload)
+        try:
+            getattr(self, f"_time_{workload}")(dataset, state, result)
+        except Skipped as e:
+            result.status, result.reason = "skipped", str(e)
+        return result
+
+    def _graph(self, dataset, state):
+        if "graph" not in state:
+            state["graph"] = read_graph(dataset, self.seed)
+        return state["graph"]
+
+    def _plan(self, dataset, state):
+        """
+        A seed plan shared by the recom and cut edge workloads, from the first of seeds ``seed,
+        seed + 1, ...`` that recursive_tree_part succeeds with.
+        """
+        if "plan" not in state:
+            graph = self._graph(dataset, state)
+            for seed in range(self.seed, self.seed + PLAN_ATTEMPTS):
+                random.seed(seed)
+                try:
+                    state["plan"] = seed_plan(graph, dataset)
+                    state["plan_seed"] = seed
+                    break
+                except SEED_ERRORS:
+                    continue
+            else:
+                raise Skipped(f"recursive_tree_part found no seed plan in {PLAN_ATTEMPTS} tries")
+        return state["plan"]
+
+    def _time(self, run, trials=None, warmup=None):
+        return time_trials(run, self.trials if trials is None else trials,
+                           self.warmup if warmup is None else warmup, self.seed)
+
+    def _time_load(self, dataset, state, result):
+        # No warmup: reading PA's shapefile takes long enough already, and the graph from the
+        # last trial is kept for the other workloads
+        result.times = self._time(lambda: state.update(graph = read_graph(dataset, self.seed)),
+                                  warmup=0)
+        result.extra = {"nodes": state["graph"].number_of_nodes(),
+                        "edges": state["graph"].number_of_edges()}
+
+    def _time_cached(self, dataset, state, result):
+        if dataset.path is None or not os.path.exists(dataset.path):
+            raise Skipped(f"{dataset.path} not found")
+        columns = list(dict.fromkeys([dataset.pop_col] + dataset.tally_cols))
+        load_graph(dataset.path, columns = columns) # builds the cache if it isn't there yet
+        result.times = self._time(lambda: load_graph(dataset.path, columns = columns)
+                                  .to_graph(columns))
+
+    def _time_seed(self, dataset, state, result):
+        graph = self._graph(dataset, state)
+        failures = []
+        result.times = self._time(lambda: seed_attempt(graph, dataset, failures))
+        result.extra = {"districts": dataset.num_dist, "failures": len(failures)}
+
+    def _time_recom(self, dataset, state, result):
+        graph = self._graph(dataset, state)
+        plan = self._plan(dataset, state)
+        result.times = self._time(lambda: run_recom(graph, dataset, plan, self.steps))
+        result.per_trial, result.unit = self.steps, "steps"
+        result.extra = {"tallies": list(dataset.tally_cols), "plan_seed": state["plan_seed"]}
+
+    def _time_cut_edges(self, dataset, state, result):
+        graph = self._graph(dataset, state)
+        plan = self._plan(dataset, state)
+        count = []
+
+        def count_cut_edges():
+            count.append(len(Partition(graph, plan, {"cut_edges": cut_edges})["cut_edges"]))
+
+        result.times = self._time(count_cut_edges)
+        result.extra = {"cut_edges": count[-1], "plan_seed": state["plan_seed"]}
+
+    def _time_cut_edges_np(self, dataset, state, result):
+        sys.path.append(os.path.join(REPO, "alaska"))
+        from metrics import EdgeMetrics # pylint: disable=import-outside-toplevel
+
+        graph = self._graph(dataset, state)
+        plan = self._plan(dataset, state)
+        # Setting up the edge arrays happens once per graph, so it isn't timed
+        edge_metrics = EdgeMetrics.from_graph(graph)
+        result.times = self._time(lambda: edge_metrics.cut_edges(plan))
+        result.extra = {"cut_edges": int(edge_metrics.cut_edges(plan)),
+                        "plan_seed": state["plan_seed"]}
+
+    def _time_ei_fit(self, dataset, state, result):
+        if not os.path.exists(dataset.path):
+            raise Skipped(f"{dataset.path} not found")
+        sys.path.append(os.path.join(REPO, "ecological-inference"))
+        # pylint: disable=import-outside-toplevel
+        try:
+            import pyei # pylint: disable=unused-import
+        except ImportError as e:
+            raise Skipped(f"pyei is not installed ({e})") from e
+        import pandas as pd
+        from batch_ei import FitSettings, fit_pair
+
+        data = pd.read_csv(dataset.path)
+        # main.py's fit, sampled every time rather than loaded from the trace cache
+        settings = FitSettings(draws = self.ei_draws, tune = self.ei_tune,
+                               random_seed = self.seed, cache_dir = None)
+        result.times = self._time(lambda: fit_pair(np.asarray(data["Black.Pct"]),
+                                                   np.asarray(data["Dan.Malloy"]),
+                                                   np.asarray(data["Total.Votes"]),
+                                                   "Black", "Malloy", settings,
+                                                   precinct_names = data["Precinct"]),
+                                  warmup = 0)
+        result.extra = {"draws": self.ei_draws, "tune": self.ei_tune, "chains": settings.chains}
+
+
+def environment():
+    """Where the timings come from: commit, Python, machine and package versions."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd = HERE, capture_output = True,
+                                text = True, check = True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    cwd = HERE, capture_output = True, text = True,
+                                    check = True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    versions = {}
+    for package in ["gerrychain", "networkx", "numpy", "scipy", "geopandas", "pyei"]:
+        try:
+            versions[package] = __import__(package).__version__
+        except (ImportError, AttributeError):
+            versions[package] = None
+    return {"commit": commit,
+            "dirty": dirty,
+            "time": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "versions": versions}
+
+
+def compare(old, new):
+    """Lines comparing the median times of two saved runs, workload by workload."""
+    before = {(r["dataset"], r["workload"]): r for r in old["results"] if r["status"] == "ok"}
+    lines = [f"{old['environment']['commit']} -> {new['environment']['commit']}"]
+    for r in new["results"]:
+        key = (r["dataset"], r["workload"])
+        if r["status"] != "ok" or key not in before:
+            continue
+        ratio = r["median"] / before[key]["median"]
+        lines.append(f"{r['dataset']:>12} {r['workload']:<12} {before[key]['median']:9.4f}s -> "
+                     f"{r['median']:9.4f}s  ({ratio:5.2f}x time)")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time this repo's workloads")
+    parser.add_argument("--datasets", nargs="+", default=["pa", "ak", "waterbury"],
+                        choices=list(DATASETS) + ["grid"],
+                        help="real datasets to run on; 'grid' runs the --grid sizes")
+    parser.add_argument("--grid", type=int, nargs="+", default=[],
+                        help="also run on synthetic n x n grids of these sizes")
+    parser.add_argument("--grid-districts", type=int, default=8,
+                        help="districts for the grid graphs")
+    parser.add_argument("--workloads", nargs="+", default=WORKLOADS, choices=WORKLOADS,
+                        help="workloads to time (default: all)")
+    parser.add_argument("--trials", type=int, default=5, help="timed trials per workload")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs before the trials")
+    parser.add_argument("--seed", type=int, default=0, help="trial i is seeded with seed + i")
+    parser.add_argument("--steps", type=int, default=100, help="recom steps per trial")
+    parser.add_argument("--ei-draws", type=int, default=1200, help="TwoByTwoEI draws per chain")
+    parser.add_argument("--ei-tune", type=int, default=3000, help="TwoByTwoEI tuning steps")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--compare", default=None,
+                        help="earlier JSON output to compare the median times with")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore") # BipartitionWarnings would drown out the report
+
+    datasets = [DATASETS[name] for name in args.datasets if name != "grid"]
+    grid_sizes = args.grid or ([10, 20, 40] if "grid" in args.datasets else [])
+    datasets += [grid_dataset(n, args.grid_districts) for n in grid_sizes]
+
+    bench = Benchmark(args.workloads, args.trials, args.warmup, args.seed, args.steps,
+                      args.ei_draws, args.ei_tune)
+    output = {"environment": environment(),
+              "settings": vars(args),
+              "results": [r.to_dict() for r in bench.run(datasets)]}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Saved {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(compare(json.load(f), output))
@@ -0,0 +1,247 @@
+"""
+gerrychain's bipartition_tree, on arrays.
+
+recom and recursive_tree_part spend nearly all their time splitting a region in two: draw a random
+spanning tree (random edge weights, then Kruskal), pick a root, add up the population below every
+node, and collect the edges whose removal leaves a piece within epsilon of the target. gerrychain
+does each of those on networkx dictionaries. bipartition_tree_csr does the same steps on NumPy
+arrays:
+
+* The whole graph's adjacency (CSR) and population column are built once per graph and kept; the
+  region being split is picked out of them with a few array operations.
+* The spanning tree is scipy.sparse.csgraph.minimum_spanning_tree over uniform random edge weights
+  drawn with NumPy, which is the same distribution of trees as gerrychain's random_spanning_tree.
+* The subtree populations come from one pass over the nodes in reverse depth-first order, and the
+  balanced edges are found with one vectorized comparison over all the tree's edges.
+* A depth-first order lists every subtree as one contiguous slice, so only the chosen cut's nodes
+  are ever collected.
+
+It takes the same arguments as bipartition_tree and returns the same set of nodes, so it can be
+passed to anything with a ``method`` argument:
+
+    proposal = partial(recom, pop_col="TOTPOP", pop_target=ideal_pop, epsilon=0.02,
+                       method=bipartition_tree_csr)
+    plan = recursive_tree_part(graph, range(18), ideal_pop, "TOTPOP", 0.02, 10,
+                               method=partial(bipartition_tree_csr, max_attempts=10000))
+
+Its random numbers come from a NumPy generator seeded from the random module, so random.seed
+still makes a run reproducible.
+"""
+import random
+import warnings
+import weakref
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import depth_first_order, minimum_spanning_tree
+from gerrychain.tree import BipartitionWarning, ReselectException
+
+# Adjacency and column arrays of each full graph that regions have been cut out of
+_ARRAYS = weakref.WeakKeyDictionary()
+
+
+class GraphArrays:
+    """
+    A graph's adjacency in CSR form and node attribute columns as arrays, in the graph's node
+    order. ``region(graph)`` gives the edge list of the subgraph a view like
+    ``graph.subgraph(nodes)`` shows, in local indices.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.nodes = list(graph.nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        pairs = np.array([(self.index[u], self.index[v]) for u, v in graph.edges],
+                         dtype=np.int64).reshape(-1, 2)
+        src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        adjacency = sp.csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)),
+                                  shape=(len(self.nodes), len(self.nodes)))
+        self.indptr = adjacency.indptr.astype(np.int64)
+        self.indices = adjacency.indices.astype(np.int64)
+        self.columns = {}
+        # Local index of each node in the region being cut; -1 outside it
+        self._local = np.full(len(self.nodes), -1, dtype=np.int64)
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = np.array([self.graph.nodes[n][name] for n in self.nodes])
+        return self.columns[name]
+
+    def node_ids(self, nodes):
+        return np.fromiter((self.index[n] for n in nodes), dtype=np.int64, count=len(nodes))
+
+    def region(self, ids):
+        """Edges ``(u, v)`` (local indices, u < v) of the subgraph induced by the nodes ``ids``."""
+        local = self._local
+        local[ids] = np.arange(len(ids))
+        starts = self.indptr[ids]
+        counts = self.indptr[ids + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        neighbors = local[self.indices[np.arange(counts.sum()) + offsets]]
+        rows = np.repeat(np.arange(len(ids)), counts)
+        local[ids] = -1
+        keep = rows < neighbors
+        return rows[keep], neighbors[keep]
+
+
+def graph_arrays(graph):
+    """
+    The GraphArrays of the full graph behind ``graph`` (which may be a subgraph view, or a view of
+    a view) and the nodes ``graph`` shows, as indices into it, sorted. Subgraph views list their
+    nodes in the order of a set built from the chain's history, so sorting keeps the trees drawn
+    from a given random state the same for a chain resumed from a checkpoint.
+    """
+    root = graph
+    while hasattr(root, "_graph"):
+        root = root._graph
+    if root not in _ARRAYS:
+        _ARRAYS[root] = GraphArrays(root)
+    arrays = _ARRAYS[root]
+    if root is graph:
+        return arrays, np.arange(len(arrays.nodes))
+    shown = getattr(graph._NODE_OK, "nodes", None)
+    nodes = list(graph.nodes) if shown is None else [n for n in shown if n in arrays.index]
+    return arrays, np.sort(arrays.node_ids(nodes))
+
+
+class RegionTree:
+    """
+    A spanning tree of a region (``n`` nodes) with populations ``pops``, given as its edges in
+    local indices. ``balanced_cuts`` finds the balanced edges for a root, and ``side`` the nodes
+    on either side of one.
+    """
+
+    def __init__(self, n, u, v, pops):
+        self.n = n
+        self.pops = np.asarray(pops, dtype=np.float64)
+        tree = sp.csr_matrix((np.ones(len(u)), (u, v)), shape=(n, n))
+        self.tree = (tree + tree.T).tocsr()
+        self.degree = np.diff(self.tree.indptr)
+        self.total = self.pops.sum()
+
+    @classmethod
+    def random(cls, n, u, v, pops, rng, surcharge=None):
+        """A random spanning tree: the minimum spanning tree for uniform random edge weights."""
+        # Weights must be positive for csgraph; shifting them all by one keeps the same tree
+        weights = 1.0 + rng.random(len(u))
+        if surcharge is not None:
+            weights += surcharge
+        mst = minimum_spanning_tree(sp.csr_matrix((weights, (u, v)), shape=(n, n))).tocoo()
+        return cls(n, mst.row, mst.col, pops)
+
+    def rooted(self, root):
+        """
+        Depth-first ``order``, each node's ``position`` in it, ``parent`` (-9999 at the root),
+        subtree ``size`` and subtree population ``below`` for the tree hung from ``root``.
+        """
+        order, parent = depth_first_order(self.tree, root, directed=False,
+                                          return_predecessors=True)
+        if len(order) != self.n:
+            raise ValueError("The region is not connected")
+        below = self.pops.tolist()
+        size = [1] * self.n
+        parent_list = parent.tolist()
+        # Children come after their parents in a depth-first order, so going backwards every
+        # subtree is complete before it is added to its parent
+        for v in order[:0:-1].tolist():
+            p = parent_list[v]
+            below[p] += below[v]
+            size[p] += size[v]
+        position = np.empty(self.n, dtype=np.int64)
+        position[order] = np.arange(self.n)
+        return order, position, parent, np.array(size), np.array(below)
+
+    def balanced_cuts(self, below, parent, pop_target, epsilon, one_sided_cut=False):
+        """
+        Nodes whose edge to their parent is a balanced cut, and for each whether the piece to
+        keep is the subtree below it (rather than the rest of the tree). Like gerrychain, a
+        two-sided cut keeps the rest and a one-sided cut keeps whichever side is balanced,
+        preferring the subtree.
+        """
+        has_parent = parent >= 0
+        bound = pop_target * epsilon
+        inside = np.abs(below - pop_target) <= bound
+        outside = np.abs((self.total - below) - pop_target) <= bound
+        if one_sided_cut:
+            nodes = np.flatnonzero(has_parent & (inside | outside))
+            return nodes, inside[nodes]
+        nodes = np.flatnonzero(has_parent & inside & outside)
+        return nodes, np.zeros(len(nodes), dtype=bool)
+
+    def side(self, node, keep_subtree, order, position, size):
+        """Local indices of the subtree below ``node``, or of everything else."""
+        subtree = order[position[node]:position[node] + size[node]]
+        if keep_subtree:
+            return subtree
+        mask = np.ones(self.n, dtype=bool)
+        mask[subtree] = False
+        return np.flatnonzero(mask)
+
+
+def _surcharge(arrays, ids, u, v, region_surcharge):
+    """gerrychain's region surcharge: extra weight on edges that cross regions or leave them."""
+    if not region_surcharge:
+        return None
+    extra = np.zeros(len(u))
+    for key, value in region_surcharge.items():
+        labels = np.asarray(arrays.column(key), dtype=object)[ids]
+        missing = np.array([label is None for label in labels])
+        extra += value * ((labels[u] != labels[v]) | missing[u] | missing[v])
+    return extra
+
+
+def bipartition_tree_csr(graph, pop_col, pop_target, epsilon, node_repeats=1,
+                         spanning_tree=None, region_surcharge=None, one_sided_cut=False,
+                         choice=random.choice, max_attempts=100000, warn_attempts=1000,
+                         allow_pair_reselection=False):
+    """
+    Drop-in replacement for gerrychain.tree.bipartition_tree (with its default spanning tree,
+    balanced-cut and cut-choice functions): the set of nodes of ``graph`` on one side of a
+    balanced cut of a random spanning tree. A tree is reused for ``node_repeats`` roots before a
+    new one is drawn. Warns with BipartitionWarning after ``warn_attempts`` failed attempts and
+    raises RuntimeError (or ReselectException with ``allow_pair_reselection``) after
+    ``max_attempts``.
+    """
+    arrays, ids = graph_arrays(graph)
+    n = len(ids)
+    u, v = arrays.region(ids)
+    pops = arrays.column(pop_col)[ids]
+    rng = np.random.default_rng(random.getrandbits(64))
+    surcharge = _surcharge(arrays, ids, u, v, region_surcharge)
+
+    if spanning_tree is not None:
+        local = {node: i for i, node in enumerate(arrays.nodes[j] for j in ids.tolist())}
+        edges = np.array([(local[a], local[b]) for a, b in spanning_tree.edges]).reshape(-1, 2)
+        tree = RegionTree(n, edges[:, 0], edges[:, 1], pops)
+    else:
+        tree = RegionTree.random(n, u, v, pops, rng, surcharge)
+
+    restarts = 0
+    attempts = 0
+    while max_attempts is None or attempts < max_attempts:
+        if restarts == node_repeats:
+            tree = RegionTree.random(n, u, v, pops, rng, surcharge)
+            restarts = 0
+        root = choice(np.flatnonzero(tree.degree > 1).tolist())
+        order, position, parent, size, below = tree.rooted(root)
+        nodes, keep_subtree = tree.balanced_cuts(below, parent, pop_target, epsilon,
+                                                 one_sided_cut)
+        if len(nodes):
+            k = random.randrange(len(nodes))
+            side = tree.side(nodes[k], keep_subtree[k], order, position, size)
+            return {arrays.nodes[j] for j in ids[side].tolist()}
+
+        restarts += 1
+        attempts += 1
+        if attempts == warn_attempts and not allow_pair_reselection:
+            warnings.warn(f"\nFailed to find a balanced cut after {warn_attempts} attempts.\n"
+                          "If possible, consider enabling pair reselection within your\n"
+                          "MarkovChain proposal method to allow the algorithm to select\n"
+                          "a different pair of districts for recombination.",
+                          BipartitionWarning)
+
+    if allow_pair_reselection:
+        raise ReselectException(f"Failed to find a balanced cut after {max_attempts} attempts.\n"
+                                "Selecting a new district pair.")
+    raise RuntimeError(f"Could not find a possible cut after {max_attempts} attempts.")
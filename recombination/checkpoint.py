@@ -0,0 +1,51 @@
+"""
+Checkpoints for long chain runs: the current plan, the state of the random number generators, the
+step counter and whatever statistics the run has accumulated, pickled to disk so a preempted run can
+pick up where it left off.
+
+For a resumed chain to repeat the original one exactly, every proposal has to depend only on the
+current plan and the generator state. recom picks its pair of districts with
+``random.choice(tuple(partition["cut_edges"]))``, and the iteration order of gerrychain's cut edge
+set depends on the history of flips that built it, so chains that can be resumed replace the
+"cut_edges" updater with ``canonical_cut_edges``, whose set is always built in sorted order.
+"""
+import os
+import pickle
+import random
+
+import numpy as np
+from gerrychain.updaters import cut_edges
+
+
+def canonical_cut_edges(partition):
+    """gerrychain's cut_edges updater, returned as a set whose order depends only on its edges."""
+    return set(sorted(cut_edges(partition)))
+
+
+def capture_rng():
+    """State of the random modules gerrychain and numpy draw from."""
+    return {"random": random.getstate(), "numpy": np.random.get_state()}
+
+
+def restore_rng(state):
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+
+
+def save_checkpoint(path, state):
+    """Pickle ``state`` to ``path`` atomically; a crash mid-write keeps the previous checkpoint."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path):
+    """The state saved at ``path``, or None if there is no checkpoint yet."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,243 @@
+"""
+Convergence diagnostics for recom ensembles, computed while the chains run.
+
+Each chain keeps a ChainTrace of a few statistics of every plan (Republican seats for each
+election, the number of cut edges, and the largest district population deviation): running sums
+of the values and of the products of values ``lag`` steps apart, for every lag up to ``max_lag``,
+which give the chain's mean, variance and autocovariances exactly in a fixed amount of memory.
+ConvergenceMonitor combines the traces of several chains into
+
+* R-hat (Gelman and Rubin): how much the chains' means disagree compared with the variation within
+  each chain; close to 1 once the chains are sampling the same distribution,
+* effective sample size, from the autocorrelations of all chains combined (Geyer's initial positive
+  sequence, as in Stan), i.e. how many independent plans the ensemble is worth. It is NaN while
+  the autocorrelations are still positive at ``max_lag``, since the sum that far would overstate
+  it,
+* each statistic's autocorrelation by lag.
+
+run_ensemble (with ``ChainConfig.diagnostics``) has every chain send its trace to the main process
+every ``check_every`` steps, and with ``auto_stop`` tells the chains to stop as soon as every
+statistic has R-hat under ``rhat_target`` and an effective sample size over ``ess_target``,
+instead of running all ``total_steps``.
+"""
+import copy
+
+import numpy as np
+
+MAX_LAG = 200
+
+
+def statistic_names(elections):
+    """The statistics ChainTrace records for ``elections`` (see ensemble.ELECTIONS)."""
+    return [f"{name}_seats" for name in elections] + ["cut_edges", "pop_deviation"]
+
+
+def plan_statistics(seats, partition, populations, ideal_pop):
+    """The values of statistic_names for one plan, given its seats for each election."""
+    deviation = np.abs(np.asarray(populations) - ideal_pop).max() / ideal_pop
+    return np.concatenate([np.asarray(seats, dtype=np.float64),
+                           [len(partition["cut_edges"]), deviation]])
+
+
+class ChainTrace:
+    """
+    Running sums over one chain's statistics, from which its mean, variance and autocovariances up
+    to ``max_lag`` follow exactly. Values are shifted by the chain's first value before summing, so
+    large, slowly varying statistics (like cut edges) don't lose precision.
+    """
+
+    def __init__(self, names, max_lag=MAX_LAG):
+        self.names = list(names)
+        self.max_lag = max_lag
+        k = len(self.names)
+        self.n = 0
+        self.shift = np.zeros(k)
+        self.total = np.zeros(k)
+        # lagged[j] is the sum of x[t] * x[t - j] over t, for j = 0..max_lag
+        self.lagged = np.zeros((max_lag + 1, k))
+        # The first max_lag values, and the last max_lag in a ring buffer
+        self.head = np.zeros((max_lag, k))
+        self.recent = np.zeros((max_lag, k))
+
+    def add(self, values):
+        if self.n == 0:
+            self.shift = np.asarray(values, dtype=np.float64).copy()
+        x = np.asarray(values, dtype=np.float64) - self.shift
+        n, lags = self.n, self.max_lag
+        m = min(n, lags)
+        if m:
+            previous = self.recent[(n - 1 - np.arange(m)) % lags]
+            self.lagged[1:m + 1] += x * previous
+        self.lagged[0] += x * x
+        if n < lags:
+            self.head[n] = x
+        if lags:
+            self.recent[n % lags] = x
+        self.total += x
+        self.n += 1
+
+    def snapshot(self):
+        return copy.deepcopy(self)
+
+    @property
+    def mean(self):
+        return self.shift + self.total / max(self.n, 1)
+
+    @property
+    def variance(self):
+        """Sample variance (n - 1 denominator) of each statistic."""
+        if self.n < 2:
+            return np.full(len(self.names), np.nan)
+        return np.maximum(self.lagged[0] - self.total**2 / self.n, 0.0) / (self.n - 1)
+
+    def autocovariance(self):
+        """
+        (lags x statistics) autocovariances for lags 0..min(max_lag, n - 1), centred at the chain
+        mean and divided by n.
+        """
+        n = self.n
+        lags = min(self.max_lag, n - 1)
+        if lags < 0:
+            return np.zeros((0, len(self.names)))
+        mu = self.total / n
+        j = np.arange(lags + 1)[:, None]
+        # Sums of the first j and the last j values
+        first = np.vstack([np.zeros(len(self.names)), np.cumsum(self.head[:lags], axis=0)])
+        last_values = self.recent[(n - 1 - np.arange(lags)) % self.max_lag]
+        last = np.vstack([np.zeros(len(self.names)), np.cumsum(last_values, axis=0)])
+        # x[t] for t >= j, and x[t - j] for t >= j, i.e. x[s] for s <= n - 1 - j
+        later = self.total - first
+        earlier = self.total - last
+        return (self.lagged[:lags + 1] - mu * (later + earlier) + (n - j) * mu**2) / n
+
+    def autocorrelation(self):
+        acov = self.autocovariance()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return acov / acov[:1]
+
+
+class ConvergenceMonitor:
+    """
+    The latest ChainTrace of each chain, and the diagnostics across all of them. Statistics that
+    never change in any chain count as converged.
+    """
+
+    def __init__(self, names=None):
+        self.names = names
+        self.traces = {}
+
+    def update(self, chain_id, trace):
+        self.traces[chain_id] = trace
+        if self.names is None:
+            self.names = trace.names
+
+    def _chains(self):
+        return [self.traces[i] for i in sorted(self.traces) if self.traces[i].n > 1]
+
+    def _variances(self, chains):
+        """Mean within-chain variance W, and the pooled estimate var+ of the target variance."""
+        n = np.mean([c.n for c in chains])
+        within = np.mean([c.variance for c in chains], axis=0)
+        means = np.array([c.mean for c in chains])
+        between = means.var(axis=0, ddof=1) if len(chains) > 1 else np.zeros(len(self.names))
+        return within, (n - 1) / n * within + between
+
+    def rhat(self):
+        """Gelman-Rubin R-hat of each statistic (NaN with fewer than two chains)."""
+        chains = self._chains()
+        if len(chains) < 2:
+            return np.full(len(self.names or []), np.nan)
+        within, pooled = self._variances(chains)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rhat = np.sqrt(pooled / within)
+        # No variation anywhere is as converged as it gets; variation only between chains isn't
+        rhat[(within == 0) & (pooled == 0)] = 1.0
+        rhat[(within == 0) & (pooled > 0)] = np.inf
+        return rhat
+
+    def ess(self):
+        """
+        Effective sample size of each statistic, over all chains together; NaN where the
+        autocorrelations haven't died out by the last lag the traces keep.
+        """
+        chains = self._chains()
+        if not chains:
+            return np.zeros(len(self.names or []))
+        total = sum(c.n for c in chains)
+        within, pooled = self._variances(chains)
+        lags = min(len(c.autocovariance()) for c in chains)
+        acov = np.mean([c.autocovariance()[:lags] for c in chains], axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rho = 1 - (within - acov) / pooled
+        ess = np.empty(len(self.names))
+        for k in range(len(self.names)):
+            if pooled[k] == 0:
+                ess[k] = total
+            else:
+                ess[k] = total / _autocorrelation_time(rho[:, k], total)
+        return ess
+
+    def autocorrelation(self):
+        """(lags x statistics) autocorrelations, averaged over the chains."""
+        chains = self._chains()
+        if not chains:
+            return np.zeros((0, len(self.names or [])))
+        lags = min(len(c.autocovariance()) for c in chains)
+        acov = np.mean([c.autocovariance()[:lags] for c in chains], axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return acov / acov[:1]
+
+    def steps(self):
+        return {i: trace.n for i, trace in self.traces.items()}
+
+    def converged(self, rhat_target, ess_target, num_chains, min_steps=0):
+        """
+        Whether all ``num_chains`` chains have reported at least ``min_steps`` steps and every
+        statistic has R-hat below ``rhat_target`` and an effective sample size above
+        ``ess_target`` (never for an unknown, NaN, sample size).
+        """
+        if len(self.traces) < num_chains:
+            return False
+        if min(trace.n for trace in self.traces.values()) < min_steps:
+            return False
+        ess = self.ess()
+        if np.isnan(ess).any():
+            return False
+        return bool((self.rhat() < rhat_target).all() and (ess > ess_target).all())
+
+    def summary(self):
+        rhat, ess, acf = self.rhat(), self.ess(), self.autocorrelation()
+        return {name: {"rhat": float(rhat[k]),
+                       "ess": float(ess[k]),
+                       "lag1_autocorrelation": float(acf[1, k]) if len(acf) > 1 else float("nan")}
+                for k, name in enumerate(self.names or [])}
+
+    def report(self):
+        """A few lines with each statistic's diagnostics."""
+        steps = self.steps()
+        lines = [f"{len(steps)} chains, {sum(steps.values())} steps "
+                 f"({min(steps.values(), default=0)}-{max(steps.values(), default=0)} per chain)"]
+        lines.append(f"  {'statistic':<16} {'R-hat':>8} {'ESS':>10} {'lag-1 acf':>10}")
+        for name, values in self.summary().items():
+            lines.append(f"  {name:<16} {values['rhat']:8.3f} {values['ess']:10.1f} "
+                         f"{values['lag1_autocorrelation']:10.3f}")
+        return "\n".join(lines)
+
+
+def _autocorrelation_time(rho, total):
+    """
+    Integrated autocorrelation time -1 + 2 * (sum of pairs of autocorrelations at lags 2k, 2k + 1)
+    over Geyer's initial positive sequence of pairs, made monotone. Like Stan, it is kept above
+    1 / log10(total) so antithetic chains don't get an absurd sample size. NaN if the sequence is
+    still positive at the last lag in ``rho``: the autocorrelations beyond it are unknown, and
+    leaving them out would underestimate the time.
+    """
+    pairs = rho[:len(rho) - len(rho) % 2].reshape(-1, 2).sum(axis=1)
+    if not len(pairs):
+        return 1.0
+    negative = np.flatnonzero(pairs <= 0)
+    if not len(negative):
+        return np.nan
+    pairs = pairs[:negative[0]]
+    pairs = np.minimum.accumulate(pairs)
+    return max(-1.0 + 2.0 * pairs.sum(), 1.0 / np.log10(max(total, 10)))
@@ -0,0 +1,444 @@
+"""
+Run many independent recom chains over one dual graph in a pool of worker processes and merge
+their ensembles into a single result that remembers which chain produced each plan.
+"""
+import multiprocessing as mp
+import os
+import queue
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+
+import numpy as np
+from gerrychain import Partition, constraints, MarkovChain
+from gerrychain.updaters import Tally
+from gerrychain.tree import recursive_tree_part, bipartition_tree
+from gerrychain.proposals import recom
+from gerrychain.accept import always_accept
+
+from bipartition import bipartition_tree_csr
+from tally import DistrictTally
+from analytics import EnsembleAnalytics
+from instrument import InstrumentedChain
+from multi_proposal import REVERSIBLE_M, MultiProposalChain
+from store import EnsembleWriter
+from diagnostics import ChainTrace, ConvergenceMonitor, plan_statistics, statistic_names
+from checkpoint import (canonical_cut_edges, capture_rng, restore_rng, save_checkpoint,
+                        load_checkpoint)
+
+# Elections we score every plan on: name -> (Republican votes column, Democratic votes column)
+ELECTIONS = {
+    "Pres": ("T16PRESR", "T16PRESD"),
+    "Sen": ("T16SENR", "T16SEND"),
+}
+
+
+@dataclass
+class ChainConfig:
+    """Everything a worker needs to build and run one chain, apart from the graph."""
+    num_dist: int
+    pop_col: str = "TOTPOP"
+    pop_tolerance: float = 0.02
+    total_steps: int = 100
+    node_repeats: int = 1
+    elections: dict = field(default_factory=lambda: dict(ELECTIONS))
+    # If set, every step's plan and district tallies are streamed to output_dir/chain-<i>
+    output_dir: str = None
+    chunk_size: int = 1000
+    # If set, the chain's state is saved to checkpoint_dir/chain-<i>.pkl every checkpoint_every
+    # steps
+    checkpoint_dir: str = None
+    checkpoint_every: int = 1000
+    # Keep streaming seats / mean-median / efficiency gap summaries (see analytics.py)
+    analytics: bool = False
+    # Keep every step's seat counts in memory; very long runs can turn this off and use analytics
+    keep_seats: bool = True
+    # If set, a per-step timing profile (see instrument.py) is saved to profile_dir/chain-<i>.csv
+    # and .json
+    profile_dir: str = None
+    # Print a progress line with steps per second while the chain runs
+    progress: bool = False
+    # Proposals drawn at once by a MultiProposalChain (see multi_proposal.py) on
+    # proposal_processes worker processes; "reversible" uses reversible recom with bound M
+    batch_size: int = 1
+    proposal: str = "recom"
+    proposal_processes: int = None
+    reversible_M: int = REVERSIBLE_M
+    # Split districts with bipartition.py's array kernel instead of gerrychain's networkx one
+    fast_bipartition: bool = False
+    # Track R-hat, effective sample size and autocorrelation of each chain's statistics (see
+    # diagnostics.py), reported to run_ensemble every check_every steps. With auto_stop the chains
+    # stop once every statistic has R-hat below rhat_target and ESS above ess_target, and every
+    # chain has run min_steps steps
+    diagnostics: bool = False
+    check_every: int = 100
+    auto_stop: bool = False
+    rhat_target: float = 1.05
+    ess_target: float = 400
+    min_steps: int = 1000
+    max_lag: int = 200
+
+    def bipartition_method(self, max_attempts = None):
+        """The bipartition function recom and recursive_tree_part should use."""
+        method = bipartition_tree_csr if self.fast_bipartition else bipartition_tree
+        return method if max_attempts is None else partial(method, max_attempts = max_attempts)
+
+
+@dataclass
+class EnsembleResult:
+    """
+    Merged output of several chains. ``seats[name][j]`` is the number of Republican majority
+    districts in the j-th plan for election ``name``; ``chain[j]`` and ``step[j]`` say which chain
+    and which step of that chain the plan came from.
+    """
+    seats: dict
+    chain: np.ndarray
+    step: np.ndarray
+    seeds: list
+    elapsed: list
+    analytics: EnsembleAnalytics = None
+    # Each chain's ChainProfile summary, if the chains were profiled
+    profiles: list = None
+    # Convergence diagnostics over the chains' final traces, if config.diagnostics was set
+    diagnostics: ConvergenceMonitor = None
+
+    def __len__(self):
+        return len(self.chain)
+
+    def for_chain(self, i):
+        """Seats ensembles of chain ``i`` alone."""
+        mask = self.chain == i
+        return {name: values[mask] for name, values in self.seats.items()}
+
+
+def make_seed_plan(graph, config, ideal_pop):
+    """Random starting plan from recursive_tree_part with the config's districts and tolerance."""
+    return recursive_tree_part(graph,
+                               range(config.num_dist),
+                               ideal_pop,
+                               config.pop_col,
+                               config.pop_tolerance,
+                               10,
+                               method = config.bipartition_method(max_attempts = 10000))
+
+
+def chain_store_path(config, chain_id):
+    return os.path.join(config.output_dir, f"chain-{chain_id:03d}")
+
+
+def checkpoint_path(config, chain_id):
+    return os.path.join(config.checkpoint_dir, f"chain-{chain_id:03d}.pkl")
+
+
+def run_chain(graph, config, seed, initial_plan=None, chain_id=0, resume=False):
+    """
+    Run one recom chain and return the number of Republican majority districts at every step for
+    each election in ``config.elections``. If no ``initial_plan`` is given, one is drawn with
+    recursive_tree_part using ``seed``. With ``config.output_dir`` set, the chain's plans and
+    tallies are also written to its store as it runs, and with ``config.analytics`` every step
+    also goes into a streaming EnsembleAnalytics summary. ``config.profile_dir`` and
+    ``config.progress`` run it as an InstrumentedChain that times each step, and
+    ``config.batch_size`` / ``config.proposal`` as a MultiProposalChain.
+
+    With ``config.checkpoint_dir`` set the chain is checkpointed periodically, and ``resume``
+    continues from the last checkpoint (if there is one) exactly as the interrupted run would have.
+
+    ``config.diagnostics`` records a ChainTrace of the chain's statistics. In a worker started by
+    run_ensemble the trace is sent back every ``config.check_every`` steps, and the chain stops
+    early if run_ensemble decides the ensemble has converged.
+    """
+    checkpoint = None
+    if resume and config.checkpoint_dir is not None:
+        checkpoint = load_checkpoint(checkpoint_path(config, chain_id))
+    if checkpoint is not None and checkpoint["seed"] != seed:
+        raise ValueError(f"Checkpoint for chain {chain_id} was made with seed "
+                         f"{checkpoint['seed']}, not {seed}")
+
+    # gerrychain draws everything from the random module, so this pins the whole chain
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+
+    tot_pop = sum(graph.nodes()[v][config.pop_col] for v in graph.nodes())
+    ideal_pop = tot_pop/config.num_dist
+    if checkpoint is not None:
+        initial_plan = checkpoint["assignment"]
+    elif initial_plan is None:
+        initial_plan = make_seed_plan(graph, config, ideal_pop)
+
+    updaters = {"district population": Tally(config.pop_col, alias = "district population"),
+                "cut_edges": canonical_cut_edges}
+    initial_partition = Partition(graph, assignment = initial_plan, updaters = updaters)
+
+    # Population and vote totals for every election live in one array that is updated from the
+    # flipped nodes only
+    names = list(config.elections)
+    pairs = [config.elections[name] for name in names]
+    tally = DistrictTally.from_partition(initial_partition,
+                                         [config.pop_col] + [col for pair in pairs for col in pair])
+
+    rw_proposal = partial(recom,
+                          pop_col = config.pop_col,
+                          pop_target = ideal_pop,
+                          epsilon = config.pop_tolerance,
+                          node_repeats = config.node_repeats,
+                          method = config.bipartition_method())
+
+    population_constraint = constraints.within_percent_of_ideal_population(
+        initial_partition,
+        config.pop_tolerance,
+        pop_key = "district population"
+        )
+
+    # A resumed chain starts at the checkpointed plan, which was already recorded, so it runs one
+    # state longer and skips its first state below
+    done = 0 if checkpoint is None else checkpoint["step"]
+    chain_args = {"proposal": rw_proposal,
+                  "constraints": [population_constraint],
+                  "accept": always_accept,
+                  "initial_state": initial_partition,
+                  "total_steps": config.total_steps - done + (done > 0)}
+    instrumented = config.profile_dir is not None or config.progress
+    batched = config.batch_size > 1 or config.proposal != "recom"
+    if batched:
+        if instrumented:
+            raise ValueError("Profiling is only available for one-proposal recom chains")
+        chain = MultiProposalChain(config.pop_col, ideal_pop, config.pop_tolerance,
+                                   chain_args["constraints"], chain_args["accept"],
+                                   initial_partition, chain_args["total_steps"],
+                                   batch_size = config.batch_size,
+                                   processes = config.proposal_processes,
+                                   node_repeats = config.node_repeats,
+                                   proposal = config.proposal,
+                                   M = config.reversible_M,
+                                   method = config.bipartition_method())
+    elif instrumented:
+        chain = InstrumentedChain(**chain_args,
+                                  progress = config.progress,
+                                  label = f"chain {chain_id}",
+                                  first_step = max(done - 1, 0))
+    else:
+        chain = MarkovChain(**chain_args)
+
+    writer = None
+    if config.output_dir is not None and checkpoint is not None:
+        writer = EnsembleWriter.reopen(chain_store_path(config, chain_id), done)
+    elif config.output_dir is not None:
+        writer = EnsembleWriter(chain_store_path(config, chain_id),
+                                nodes = tally.nodes,
+                                parts = tally.parts,
+                                columns = tally.columns,
+                                chunk_size = config.chunk_size,
+                                metadata = {"seed": seed, "chain": chain_id})
+
+    analytics = None
+    trace = None
+    if checkpoint is None:
+        seats = {name: [] for name in config.elections}
+        elapsed = 0.0
+        if config.analytics:
+            analytics = EnsembleAnalytics(config.elections, tally.columns)
+        if config.diagnostics:
+            trace = ChainTrace(statistic_names(names), config.max_lag)
+    else:
+        seats = checkpoint["seats"]
+        elapsed = checkpoint["elapsed"]
+        analytics = checkpoint.get("analytics")
+        trace = checkpoint.get("trace")
+        if config.diagnostics and trace is None:
+            trace = ChainTrace(statistic_names(names), config.max_lag)
+        restore_rng(checkpoint["rng"])
+
+    start = time.perf_counter()
+    try:
+        for step, part in enumerate(chain, start = max(done - 1, 0)):
+            if step < done:
+                continue
+            tally.follow(part)
+            won = tally.seats_won(pairs)
+            if config.keep_seats:
+                for name, r_seats in zip(names, won.tolist()):
+                    seats[name].append(r_seats)
+            if trace is not None:
+                trace.add(plan_statistics(won, part, tally[config.pop_col], ideal_pop))
+            if analytics is not None:
+                analytics.update(tally.totals)
+            if writer is not None:
+                writer.append(tally.assignment, tally.totals)
+
+            if config.checkpoint_dir is not None and (step + 1) % config.checkpoint_every == 0:
+                # Flush first so the store ends exactly where the checkpoint does
+                if writer is not None:
+                    writer.flush()
+                # Leftover batched proposals aren't checkpointed, so every run drops them here
+                if batched:
+                    chain.discard_pending()
+                save_checkpoint(checkpoint_path(config, chain_id),
+                                {"seed": seed,
+                                 "step": step + 1,
+                                 "assignment": dict(part.assignment),
+                                 "rng": capture_rng(),
+                                 "seats": seats,
+                                 "analytics": analytics,
+                                 "trace": trace,
+                                 "elapsed": elapsed + time.perf_counter() - start})
+
+            if trace is not None and _CHANNEL is not None and (step + 1) % config.check_every == 0:
+                updates, stop = _CHANNEL
+                updates.put((chain_id, trace.snapshot()))
+                if stop.is_set():
+                    break
+    finally:
+        if writer is not None:
+            writer.close()
+        if batched:
+            chain.close()
+
+    profile = None
+    if instrumented:
+        profile = chain.profile.summary()
+        if config.profile_dir is not None:
+            os.makedirs(config.profile_dir, exist_ok = True)
+            # A resumed chain's profile goes next to the earlier one rather than over it
+            name = f"chain-{chain_id:03d}" + (f"-from-{done}" if done else "")
+            chain.profile.to_csv(os.path.join(config.profile_dir, name + ".csv"))
+            chain.profile.to_json(os.path.join(config.profile_dir, name + ".json"))
+
+    return {"seed": seed, "seats": seats, "analytics": analytics, "profile": profile,
+            "trace": trace, "elapsed": elapsed + time.perf_counter() - start}
+
+
+# The dual graph each worker process runs its chains on. It is handed over once per worker by
+# the pool initializer (and simply inherited when processes are forked), so workers never re-read
+# the shapefile and tasks only carry a seed.
+_GRAPH = None
+# With diagnostics, the (queue, event) pair chains send their traces on and are told to stop by
+_CHANNEL = None
+
+
+def _init_worker(graph, channel=None):
+    global _GRAPH, _CHANNEL
+    _GRAPH = graph
+    _CHANNEL = channel
+    if channel is not None:
+        # Traces still buffered when the worker exits aren't needed (the final one comes back with
+        # the chain's result), so exiting mustn't wait for the main process to read them
+        channel[0].cancel_join_thread()
+
+
+def _run_chain_in_worker(config, seed, initial_plan, chain_id, resume):
+    return run_chain(_GRAPH, config, seed, initial_plan, chain_id, resume)
+
+
+def _pool_context():
+    # Forking shares the parent's graph copy-on-write instead of pickling it to every worker
+    if "fork" in mp.get_all_start_methods():
+        return mp.get_context("fork")
+    return mp.get_context()
+
+
+def merge_chains(chain_results):
+    """Concatenate per-chain outputs of run_chain into one EnsembleResult."""
+    names = list(chain_results[0]["seats"]) if chain_results else []
+    seats = {name: np.concatenate([np.asarray(r["seats"][name], dtype=np.int64)
+                                   for r in chain_results])
+             for name in names}
+    lengths = [len(r["seats"][names[0]]) if names else 0 for r in chain_results]
+    chain = np.repeat(np.arange(len(chain_results)), lengths)
+    step = np.concatenate([np.arange(n) for n in lengths]) if lengths else np.zeros(0, int)
+    analytics = None
+    for r in chain_results:
+        if r.get("analytics") is None:
+            continue
+        if analytics is None:
+            analytics = r["analytics"]
+        else:
+            analytics.merge(r["analytics"])
+    diagnostics = None
+    traces = [r.get("trace") for r in chain_results]
+    if traces and all(trace is not None for trace in traces):
+        diagnostics = ConvergenceMonitor()
+        for i, trace in enumerate(traces):
+            diagnostics.update(i, trace)
+    return EnsembleResult(seats = seats,
+                          chain = chain,
+                          step = step,
+                          seeds = [r["seed"] for r in chain_results],
+                          elapsed = [r["elapsed"] for r in chain_results],
+                          analytics = analytics,
+                          profiles = [r.get("profile") for r in chain_results],
+                          diagnostics = diagnostics)
+
+
+def run_ensemble(graph, config, num_chains, seed = 0, processes = None,
+                 distinct_seed_plans = True, initial_plan = None, resume = False):
+    """
+    Run ``num_chains`` independent chains with seeds ``seed, seed + 1, ...`` across ``processes``
+    worker processes (default: one per core) and merge them.
+
+    With ``distinct_seed_plans`` every chain draws its own recursive_tree_part starting plan from
+    its seed; otherwise all chains start from ``initial_plan`` (drawn once here if not given).
+    ``resume`` continues each chain from its checkpoint in ``config.checkpoint_dir``, if any.
+
+    With ``config.diagnostics`` and more than one process, the chains' traces are collected in a
+    ConvergenceMonitor as they run, and ``config.auto_stop`` stops every chain once it reports
+    convergence. Chains run one after another can't be compared until they have all finished, so
+    ``auto_stop`` needs at least two chains and a process for each; otherwise it raises
+    ValueError. Without it, diagnostics are worked out from the finished chains.
+    """
+    seeds = [seed + i for i in range(num_chains)]
+    if not distinct_seed_plans and initial_plan is None:
+        random.seed(seed)
+        tot_pop = sum(graph.nodes()[v][config.pop_col] for v in graph.nodes())
+        initial_plan = make_seed_plan(graph, config, tot_pop/config.num_dist)
+    plan = None if distinct_seed_plans else initial_plan
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, num_chains))
+    if config.auto_stop and (num_chains < 2 or processes < num_chains):
+        raise ValueError(f"auto_stop compares chains as they run, so it needs at least two chains "
+                         f"and a process for each, not {num_chains} chains on {processes} "
+                         "processes")
+
+    if processes == 1:
+        return merge_chains([run_chain(graph, config, s, plan, i, resume)
+                             for i, s in enumerate(seeds)])
+
+    context = _pool_context()
+    channel = (context.Queue(), context.Event()) if config.diagnostics else None
+    with ProcessPoolExecutor(max_workers = processes,
+                             mp_context = context,
+                             initializer = _init_worker,
+                             initargs = (graph, channel)) as pool:
+        futures = [pool.submit(_run_chain_in_worker, config, s, plan, i, resume)
+                   for i, s in enumerate(seeds)]
+        if channel is not None:
+            _monitor_chains(futures, channel, config, num_chains)
+        return merge_chains([f.result() for f in futures])
+
+
+def _monitor_chains(futures, channel, config, num_chains):
+    """
+    Collect the traces the chains send until they have all finished, setting the stop event once
+    they have converged if ``config.auto_stop``.
+    """
+    updates, stop = channel
+    monitor = ConvergenceMonitor()
+    while not all(f.done() for f in futures):
+        try:
+            chain_id, trace = updates.get(timeout = 0.5)
+        except queue.Empty:
+            continue
+        monitor.update(chain_id, trace)
+        if (config.auto_stop and not stop.is_set()
+                and monitor.converged(config.rhat_target, config.ess_target, num_chains,
+                                      config.min_steps)):
+            stop.set()
+    # Leftover traces would otherwise sit in the pipe
+    while True:
+        try:
+            updates.get_nowait()
+        except queue.Empty:
+            break
@@ -0,0 +1,267 @@
+"""
+On-disk cache for dual graphs. The first time a shapefile or JSON dual graph is loaded we build its
+adjacency and the node attribute columns we need and save them as NumPy arrays: the adjacency in
+CSR form (indptr/indices) and one array per column. Later runs memory-map those arrays instead of
+redoing the shapefile adjacency computation or JSON parsing. Cache entries are keyed on a hash of
+the source file(s), so editing the data invalidates them.
+"""
+import importlib.util
+import json
+import os
+
+import numpy as np
+from gerrychain import Graph
+
+# File handling shared with ecological-inference/ei_inputs.py, loaded from ../common by its path
+_spec = importlib.util.spec_from_file_location(
+    "cache_files", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common",
+                                "cache_files.py"))
+cache_files = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(cache_files)
+building = cache_files.building
+hash_files = cache_files.hash_files
+new_column_file = cache_files.new_column_file
+write_meta = cache_files.write_meta
+
+CACHE_DIR = ".graph_cache"
+
+# A shapefile is really several files; the adjacency depends on the geometry (.shp/.shx) and the
+# attributes on the table (.dbf)
+SHAPEFILE_PARTS = [".shp", ".shx", ".dbf", ".prj"]
+
+
+def source_files(path):
+    """The files whose contents determine the graph loaded from ``path``."""
+    stem, ext = os.path.splitext(path)
+    if ext.lower() != ".shp":
+        return [path]
+    return [stem + part for part in SHAPEFILE_PARTS if os.path.exists(stem + part)]
+
+
+def read_source_graph(path):
+    """Load the dual graph the slow way, with gerrychain."""
+    if path.lower().endswith(".json"):
+        return Graph.from_json(path)
+    return Graph.from_file(path)
+
+
+def _column_array(values):
+    """Turn a list of node attribute values into an array np.load can memory-map."""
+    if all(isinstance(x, (bool, int, np.integer)) for x in values):
+        return np.asarray(values, dtype=np.int64)
+    if all(x is None or isinstance(x, (bool, int, float, np.number)) for x in values):
+        return np.asarray([np.nan if x is None else x for x in values], dtype=np.float64)
+    # Strings (like INTPTLAT20) and anything else are stored as fixed-width text
+    return np.asarray(["" if x is None else str(x) for x in values], dtype=np.str_)
+
+
+def _csr(num_nodes, src, dst):
+    """CSR adjacency from directed edge lists, neighbours sorted within each row."""
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32)
+
+
+class CachedGraph:
+    """
+    A dual graph as memory-mapped arrays. Node ``i`` is the i-th node of the source graph and has
+    label ``nodes[i]``; its neighbours are ``indices[indptr[i]:indptr[i+1]]``. Node attribute
+    columns are available as ``cached[name]``, edge attribute columns (aligned with ``indices``)
+    as ``cached.edge_column(name)``.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.nodes = self._load("nodes.npy")
+        self.indptr = self._load("indptr.npy")
+        self.indices = self._load("indices.npy")
+        self._columns = {}
+
+    def _load(self, name):
+        return np.load(os.path.join(self.directory, name), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return (f"<CachedGraph [{len(self)} nodes, {self.num_edges} edges] "
+                f"from {self.meta['source']}>")
+
+    @property
+    def num_edges(self):
+        return len(self.indices) // 2
+
+    @property
+    def columns(self):
+        return list(self.meta["columns"])
+
+    @property
+    def edge_columns(self):
+        return list(self.meta["edge_columns"])
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            if name not in self.meta["columns"]:
+                raise KeyError(f"Column {name!r} is not cached for {self.meta['source']}")
+            self._columns[name] = self._load(self.meta["columns"][name])
+        return self._columns[name]
+
+    def edge_column(self, name):
+        key = ("edge", name)
+        if key not in self._columns:
+            if name not in self.meta["edge_columns"]:
+                raise KeyError(f"Edge column {name!r} is not cached for {self.meta['source']}")
+            self._columns[key] = self._load(self.meta["edge_columns"][name])
+        return self._columns[key]
+
+    def _upper(self):
+        src = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.indptr))
+        return src, src < self.indices
+
+    def edges(self):
+        """Each undirected edge once, as two int32 arrays of node indices with u < v."""
+        src, keep = self._upper()
+        return src[keep], np.asarray(self.indices[keep])
+
+    def edge_values(self, name):
+        """An edge column in the order of ``edges()``."""
+        _, keep = self._upper()
+        return np.asarray(self.edge_column(name))[keep]
+
+    def to_graph(self, columns=None, edge_columns=()):
+        """
+        Build a gerrychain Graph with only the requested node (and edge) attributes, for use with
+        Partition and MarkovChain. Defaults to every cached node column.
+        """
+        if columns is None:
+            columns = self.columns
+        data = {name: self[name].tolist() for name in columns}
+        labels = self.nodes.tolist()
+        graph = Graph()
+        graph.add_nodes_from(
+            (label, {name: data[name][i] for name in columns}) for i, label in enumerate(labels)
+        )
+        src, keep = self._upper()
+        u, v = src[keep], np.asarray(self.indices[keep])
+        edge_data = {name: np.asarray(self.edge_column(name))[keep].tolist()
+                     for name in edge_columns}
+        graph.add_edges_from(
+            (labels[a], labels[b], {name: edge_data[name][j] for name in edge_columns})
+            for j, (a, b) in enumerate(zip(u.tolist(), v.tolist()))
+        )
+        return graph
+
+
+def _check_columns(graph, columns, edge_columns):
+    """
+    Raise KeyError for a requested column no node (or edge) of ``graph`` has, which is almost
+    always a typo, rather than caching it as a column of missing values.
+    """
+    missing = [name for name in columns if not any(name in graph.nodes[n] for n in graph.nodes)]
+    missing += [f"{name} (edge)" for name in edge_columns
+                if not any(name in graph.edges[e] for e in graph.edges)]
+    if missing:
+        raise KeyError(f"The graph has no attribute {', '.join(missing)}")
+
+
+def _write_columns(directory, meta, graph, columns, edge_columns, node_order):
+    """Add node and edge columns of ``graph`` to a cache directory's arrays and meta."""
+    for name in columns:
+        values = [graph.nodes[n].get(name) for n in node_order]
+        filename = new_column_file(directory)
+        np.save(os.path.join(directory, filename), _column_array(values))
+        meta["columns"][name] = filename
+    if edge_columns:
+        labels = np.load(os.path.join(directory, "nodes.npy")).tolist()
+        indptr = np.load(os.path.join(directory, "indptr.npy"))
+        indices = np.load(os.path.join(directory, "indices.npy"))
+        for name in edge_columns:
+            values = []
+            for i, label in enumerate(labels):
+                for j in indices[indptr[i]:indptr[i + 1]]:
+                    values.append(graph.edges[label, labels[j]].get(name))
+            filename = new_column_file(directory, "edge-")
+            np.save(os.path.join(directory, filename), _column_array(values))
+            meta["edge_columns"][name] = filename
+
+
+def add_node_columns(cached, values):
+    """
+    Save node columns computed elsewhere (``values`` maps name -> one value per node, in the order
+    of ``cached.nodes``) into a cache entry, replacing columns of the same name, and return the
+    updated CachedGraph. Like any cached column they are lost if the source file changes.
+    """
+    directory = cached.directory
+    meta = dict(cached.meta)
+    meta["columns"] = dict(meta["columns"])
+    for name, column in values.items():
+        array = _column_array(list(column))
+        if len(array) != len(cached):
+            raise ValueError(f"Column {name!r} has {len(array)} values for {len(cached)} nodes")
+        # A new file even when replacing a column, since readers may have the old one mapped
+        filename = new_column_file(directory)
+        np.save(os.path.join(directory, filename), array)
+        meta["columns"][name] = filename
+    write_meta(directory, meta)
+    return CachedGraph(directory)
+
+
+def build_cache(graph, directory, source, digest, columns=None, edge_columns=()):
+    """Write ``graph``'s adjacency and columns into a fresh cache ``directory``."""
+    node_order = list(graph.nodes)
+    if columns is None:
+        columns = sorted({k for n in node_order for k in graph.nodes[n] if k != "geometry"})
+    _check_columns(graph, columns, edge_columns)
+    index = {n: i for i, n in enumerate(node_order)}
+    pairs = np.array([(index[u], index[v]) for u, v in graph.edges], dtype=np.int64)
+    pairs = pairs.reshape(-1, 2)
+    src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    indptr, indices = _csr(len(node_order), src, dst)
+
+    labels = np.asarray(node_order)
+    if labels.dtype == object:
+        raise ValueError("Only graphs with integer or string node labels can be cached")
+    with building(directory) as tmp:
+        np.save(os.path.join(tmp, "nodes.npy"), labels)
+        np.save(os.path.join(tmp, "indptr.npy"), indptr)
+        np.save(os.path.join(tmp, "indices.npy"), indices)
+        meta = {"source": source, "hash": digest, "columns": {}, "edge_columns": {}}
+        _write_columns(tmp, meta, graph, columns, edge_columns, node_order)
+        write_meta(tmp, meta)
+    return CachedGraph(directory)
+
+
+def load_graph(path, columns=None, edge_columns=(), cache_dir=None):
+    """
+    Load the dual graph at ``path`` (a shapefile or a gerrychain JSON file) through the cache.
+
+    ``columns`` lists the node attributes we need (default: all of them, minus geometry) and
+    ``edge_columns`` the edge attributes (e.g. ``shared_perim``). On a cache hit this only
+    memory-maps arrays; if the source changed, or a requested column was never cached, the graph is
+    read from the source once and the cache entry rebuilt or extended.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR)
+    digest = hash_files(source_files(path))
+    stem = os.path.splitext(os.path.basename(path))[0]
+    directory = os.path.join(cache_dir, f"{stem}-{digest[:16]}")
+
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        return build_cache(read_source_graph(path), directory, path, digest,
+                           columns, edge_columns)
+
+    cached = CachedGraph(directory)
+    missing = [] if columns is None else [c for c in columns if c not in cached.meta["columns"]]
+    missing_edges = [c for c in edge_columns if c not in cached.meta["edge_columns"]]
+    if missing or missing_edges:
+        graph = read_source_graph(path)
+        _check_columns(graph, missing, missing_edges)
+        meta = dict(cached.meta)
+        _write_columns(directory, meta, graph, missing, missing_edges, cached.nodes.tolist())
+        write_meta(directory, meta)
+        cached = CachedGraph(directory)
+    return cached
@@ -0,0 +1,324 @@
+"""
+Find out where a chain's time goes. InstrumentedChain is a drop-in MarkovChain that times every
+step, split into
+
+* proposal:    recom (merging two districts, the spanning trees, finding a balanced cut),
+* constraints: the constraints, e.g. within_percent_of_ideal_population,
+* accept:      the acceptance function,
+* updaters:    the partition's updaters (the Tally updaters, cut_edges, ...), wherever they are
+               computed: gerrychain computes them lazily, mostly inside the constraints and in
+               our own loop, so their time is taken out of those,
+* callbacks:   functions given to the chain to run on every state,
+* loop:        everything the ``for part in chain`` loop body does with the state,
+
+and counts rejected proposals, spanning trees drawn and balanced-cut searches by recom (more
+searches than bipartitions means ``node_repeats`` retries) and BipartitionWarnings. The steps are
+kept as a time series that can be saved as CSV or JSON, and a progress line with steps per second
+can be printed as the chain runs.
+
+The timing is a few perf_counter calls per step and per updater call, which is small next to a
+recom step, so it can be left on for real runs.
+
+    chain = InstrumentedChain(proposal, constraints, accept, initial_partition, 10000,
+                              progress=True)
+    for part in chain:
+        ...
+    chain.profile.to_csv("profile.csv")
+    print(chain.profile.report())
+"""
+import csv
+import inspect
+import json
+import sys
+import time
+import warnings
+from functools import partial
+
+from gerrychain import MarkovChain
+from gerrychain.tree import (BipartitionWarning, bipartition_tree, random_spanning_tree,
+                             find_balanced_edge_cuts_memoization)
+
+# Phases each step's wall time is split into
+PHASES = ["proposal", "constraints", "accept", "updaters", "callbacks", "loop"]
+# Counts kept for each step
+COUNTS = ["rejected", "not_accepted", "trees", "cut_searches", "bipartition_warnings"]
+
+
+class ChainProfile:
+    """
+    The per-step time series of an InstrumentedChain. ``series[name]`` is a list with one entry
+    per step for ``step``, ``time`` (seconds since the chain started), ``wall`` (seconds for the
+    step), each of PHASES and each of COUNTS. ``updater_times`` and ``constraint_times`` total the
+    time of each updater and constraint by name.
+    """
+
+    def __init__(self, first_step=0):
+        self.first_step = first_step
+        self.columns = ["step", "time", "wall"] + PHASES + COUNTS
+        self.series = {name: [] for name in self.columns}
+        self.updater_times = {}
+        self.constraint_times = {}
+
+    def __len__(self):
+        return len(self.series["step"])
+
+    def append(self, row):
+        for name in self.columns:
+            self.series[name].append(row[name])
+
+    def totals(self):
+        """Total seconds in each phase and total of each count, over all steps."""
+        return {name: sum(self.series[name]) for name in ["wall"] + PHASES + COUNTS}
+
+    def summary(self):
+        totals = self.totals()
+        elapsed = self.series["time"][-1] if len(self) else 0.0
+        return {"steps": len(self),
+                "first_step": self.first_step,
+                "elapsed": elapsed,
+                "steps_per_second": len(self) / elapsed if elapsed else 0.0,
+                "totals": totals,
+                "shares": {phase: totals[phase] / totals["wall"] if totals["wall"] else 0.0
+                           for phase in PHASES},
+                "updaters": dict(self.updater_times),
+                "constraints": dict(self.constraint_times)}
+
+    def report(self):
+        """A few lines saying where the time went."""
+        s = self.summary()
+        lines = [f"{s['steps']} steps in {s['elapsed']:.1f}s "
+                 f"({s['steps_per_second']:.1f} steps/s)"]
+        for phase in PHASES:
+            lines.append(f"  {phase:<12} {s['totals'][phase]:9.2f}s  "
+                         f"{100 * s['shares'][phase]:5.1f}%")
+        for kind in ["updaters", "constraints"]:
+            for name, seconds in sorted(s[kind].items(), key=lambda item: -item[1]):
+                lines.append(f"    {name:<30} {seconds:9.2f}s")
+        lines.append("  " + ", ".join(f"{name} {s['totals'][name]}" for name in COUNTS))
+        return "\n".join(lines)
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(zip(*(self.series[name] for name in self.columns)))
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "series": self.series}, f)
+
+
+class _Timer:
+    """
+    Adds up time per phase, exclusive of nested timed calls: an updater computed inside a
+    constraint counts as updater time only.
+    """
+
+    def __init__(self):
+        self.row = None
+        # Time of nested calls, one entry per call in progress
+        self._inner = []
+        # Time of timed calls made outside the chain's own code (i.e. from the loop body)
+        self.outside = 0.0
+
+    def call(self, phase, fn, *args, name=None, totals=None):
+        self._inner.append(0.0)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            exclusive = elapsed - self._inner.pop()
+            if self.row is not None:
+                self.row[phase] += exclusive
+            if totals is not None:
+                totals[name] = totals.get(name, 0.0) + exclusive
+            if self._inner:
+                self._inner[-1] += elapsed
+            else:
+                self.outside += elapsed
+
+
+class _TimedUpdater:
+    """An updater that reports its time to a chain's timer."""
+
+    def __init__(self, name, updater, timer, totals):
+        self.name = name
+        self.updater = updater
+        self.timer = timer
+        self.totals = totals
+
+    def __call__(self, partition):
+        return self.timer.call("updaters", self.updater, partition, name=self.name,
+                               totals=self.totals)
+
+
+def _name(fn):
+    return getattr(fn, "__name__", None) or type(fn).__name__
+
+
+class InstrumentedChain(MarkovChain):
+    """
+    A MarkovChain that records a ChainProfile of its run in ``self.profile``.
+
+    ``callbacks`` are called with every state the chain yields (their time is counted
+    separately). With ``progress`` a status line is written to stderr every ``progress_every``
+    seconds, prefixed with ``label``. ``first_step`` numbers the steps, e.g. for a resumed chain.
+
+    If the proposal is a functools.partial of recom (or of anything else taking a bipartition
+    ``method``) using gerrychain's bipartition_tree, the bipartitions it makes are counted too.
+    """
+
+    def __init__(self, proposal, constraints, accept, initial_state, total_steps, callbacks=(),
+                 progress=False, progress_every=1.0, label="", first_step=0):
+        super().__init__(proposal, constraints, accept, initial_state, total_steps)
+        self.callbacks = list(callbacks)
+        self.progress = progress
+        self.progress_every = progress_every
+        self.label = label
+        self.first_step = first_step
+        self._timer = _Timer()
+        self.profile = ChainProfile(first_step)
+        self._constraints = list(self.is_valid.constraints)
+        self.proposal = self._counting_proposal(proposal)
+        self._wrap_updaters(initial_state)
+        self._wrap_constraints()
+
+    def _counting_proposal(self, proposal):
+        if not isinstance(proposal, partial):
+            return proposal
+        try:
+            takes_method = "method" in inspect.signature(proposal.func).parameters
+        except (TypeError, ValueError):
+            takes_method = False
+        if not takes_method:
+            return proposal
+        method = proposal.keywords.get("method", bipartition_tree)
+        keywords = method.keywords if isinstance(method, partial) else {}
+        base = method.func if isinstance(method, partial) else method
+        if base is not bipartition_tree:
+            return proposal
+        counted = partial(base, **dict(keywords,
+                                       spanning_tree_fn = self._count("trees", keywords.get(
+                                           "spanning_tree_fn", random_spanning_tree)),
+                                       balance_edge_fn = self._count("cut_searches", keywords.get(
+                                           "balance_edge_fn",
+                                           find_balanced_edge_cuts_memoization))))
+        return partial(proposal.func, *proposal.args, **dict(proposal.keywords, method = counted))
+
+    def _count(self, name, fn):
+        timer = self._timer
+
+        def counted(*args, **kwargs):
+            if timer.row is not None:
+                timer.row[name] += 1
+            return fn(*args, **kwargs)
+        # bipartition_tree looks for keyword arguments of these functions by name
+        counted.__signature__ = inspect.signature(fn)
+        return counted
+
+    def _wrap_updaters(self, state):
+        # Every partition in the chain shares the initial state's updaters dictionary
+        updaters = state.updaters
+        for name, updater in list(updaters.items()):
+            if isinstance(updater, _TimedUpdater):
+                updater = updater.updater
+            updaters[name] = _TimedUpdater(name, updater, self._timer, self.profile.updater_times)
+
+    def _wrap_constraints(self):
+        timer, totals = self._timer, self.profile.constraint_times
+        self.is_valid.constraints = [
+            partial(timer.call, "constraints", constraint, name=_name(constraint), totals=totals)
+            for constraint in self._constraints]
+
+    def __iter__(self):
+        super().__iter__()
+        self.profile = ChainProfile(self.first_step)
+        self._wrap_updaters(self.initial_state)
+        self._wrap_constraints()
+        self._timer.row = None
+        self._start = self._last_print = self._returned = time.perf_counter()
+        return self
+
+    def _new_row(self):
+        row = {name: 0.0 for name in PHASES}
+        row.update(dict.fromkeys(COUNTS, 0))
+        return row
+
+    def _close_row(self, now):
+        """Finish the last step's row with the time the loop body spent on its state."""
+        row = self._timer.row
+        if row is None:
+            return
+        row["loop"] = now - self._returned - self._timer.outside
+        row["wall"] = now - self._row_start
+        row["time"] = now - self._start
+        self.profile.append(row)
+        self._timer.row = None
+
+    def _propose(self):
+        """Run the proposal, counting (and passing on) the BipartitionWarnings it raises."""
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            proposed = self.proposal(self.state)
+        for w in caught:
+            if issubclass(w.category, BipartitionWarning):
+                self._timer.row["bipartition_warnings"] += 1
+            warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+        return proposed
+
+    def __next__(self):
+        now = time.perf_counter()
+        self._close_row(now)
+        if self.counter >= self.total_steps:
+            self._finish()
+            raise StopIteration
+        timer = self._timer
+        timer.row = self._new_row()
+        timer.row["step"] = self.first_step + self.counter
+        self._row_start = now
+        if self.counter == 0:
+            self.counter += 1
+        else:
+            while True:
+                proposed = timer.call("proposal", self._propose)
+                # Erase the parent of the parent, to avoid memory leak
+                if self.state is not None:
+                    self.state.parent = None
+                if timer.call("constraints", self.is_valid, proposed):
+                    if timer.call("accept", self.accept, proposed):
+                        self.state = proposed
+                    else:
+                        timer.row["not_accepted"] += 1
+                    self.counter += 1
+                    break
+                timer.row["rejected"] += 1
+        for callback in self.callbacks:
+            timer.call("callbacks", callback, self.state)
+        if self.progress and time.perf_counter() - self._last_print >= self.progress_every:
+            self._print_progress()
+        timer.outside = 0.0
+        self._returned = time.perf_counter()
+        return self.state
+
+    def _finish(self):
+        if self.progress:
+            self._print_progress()
+            sys.stderr.write("\n")
+            sys.stderr.flush()
+
+    def _print_progress(self):
+        now = time.perf_counter()
+        self._last_print = now
+        done = len(self.profile)
+        rate = done / (now - self._start) if now > self._start else 0.0
+        totals = self.profile.totals()
+        wall = totals["wall"] or 1.0
+        shares = " ".join(f"{phase} {100 * totals[phase] / wall:.0f}%" for phase in PHASES)
+        remaining = (self.total_steps - done) / rate if rate else 0.0
+        prefix = f"{self.label}: " if self.label else ""
+        sys.stderr.write(f"\r{prefix}step {done}/{self.total_steps}  {rate:.1f} steps/s  "
+                         f"{shares}  rejected {totals['rejected']}  "
+                         f"warnings {totals['bipartition_warnings']}  "
+                         f"{remaining:.0f}s left ")
+        sys.stderr.flush()
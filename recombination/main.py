@@ -1,119 +1,161 @@
-#Needed for gerrychain
-from functools import partial
+import argparse
 # For making plots
 import matplotlib.pyplot as plt
-# Needed for gerrychain
-from gerrychain import Graph, Partition, constraints, MarkovChain
-from gerrychain.updaters import Tally
-from gerrychain.tree import recursive_tree_part
-from gerrychain.proposals import recom
-from gerrychain.accept import always_accept
-import geopandas as gpd
-
-# Read shapefile data into a geo data frame, rather than creating a graph
-pa_gdf = gpd.read_file("PA/PA.shp")
-pa_graph = Graph.from_file("PA/PA.shp")
+# Loads the dual graph from an on-disk cache after the first run
+from graph_cache import load_graph
+# Node attributes as read-only views of shared arrays, so workers don't each copy them
+from shared_attrs import shared_graph
+# Runs the recom chains, possibly several at once in worker processes
+from ensemble import ELECTIONS, ChainConfig, run_ensemble
 
 NUM_DIST = 18 # Number of Congressional Districts in PA (when redistricting lawsuit happened)
-tot_pop = sum(pa_graph.nodes()[v]['TOTPOP'] for v in pa_graph.nodes())
-ideal_pop = tot_pop/NUM_DIST
 POP_TOLERANCE = 0.02
-initial_plan = recursive_tree_part(pa_graph,
-                                   range(NUM_DIST),
-                                   ideal_pop,
-                                   'TOTPOP',
-                                   POP_TOLERANCE,
-                                   10)
-
-# Set up random walk
-
-# Set up partition object
-initial_partition = Partition(
-    pa_graph, # dual graph
-    assignment = initial_plan, # initial districting plan
-    updaters = {
-        "district population": Tally("TOTPOP", alias = "district population"), 
-        "Pres R Votes": Tally("T16PRESR", alias = "Pres R Votes"), 
-        "Pres D Votes": Tally("T16PRESD", alias = "Pres D Votes"),
-        "Sen R Votes": Tally("T16SENR", alias = "Sen R Votes"), 
-        "Sen D Votes": Tally("T16SEND", alias = "Sen D Votes")
-    }
-)
-
-rw_proposal = partial(recom,                   # How you choose a next districting plan
-                      pop_col = "TOTPOP",      # What data describes population
-                      pop_target = ideal_pop,  # Target/ideal population is for each district
-                                               # (we calculated ideal pop above)
-                      epsilon = POP_TOLERANCE, # How far from ideal population you can deviate
-                                               # (we set POP_TOLERANCE above)
-                      node_repeats = 1         # Number of times to repeat bipartition.
-                                               # Can increase if you get a BipartitionWarning
-                      )
-
-# Constraint on population: stay within POP_TOLERANCE of ideal
-
-population_constraint = constraints.within_percent_of_ideal_population(
-    initial_partition,
-    POP_TOLERANCE,
-    pop_key = "district population"
-    )
-
-# Creating the chain
-
-# The following sets up the chain, but doesn't run it
-our_random_walk = MarkovChain(
-    proposal = rw_proposal,
-    constraints = [population_constraint],
-    accept = always_accept, # accepts every proposed plan that meets population criteria
-    initial_state = initial_partition,
-    total_steps = 100
-)
-
-# What ensembles we want to build:  We'll calculate number of R majority districts in the
-# 2016 Presidential and Senate elections
-
-# This actually runs the random walk
-r_pres_ensemble = []
-r_sen_ensemble = []
-
-for part in our_random_walk:
-    # Calculate number of districts with more Republican votes than Democratic votes in the 2016
-    # Presidential election
-    r_pres = 0
-    for i in range(NUM_DIST):
-        if part["Pres R Votes"][i] > part["Pres D Votes"][i]:
-            r_pres = r_pres + 1
-    r_pres_ensemble.append(r_pres)
-
-    # Calculate number of districts with more Republican votes than Democratic votes in the 2016
-    # Senate election
-    r_sen = 0
-    for i in range(NUM_DIST):
-        if part["Sen R Votes"][i] > part["Sen D Votes"][i]:
-            r_sen = r_sen + 1
-    r_sen_ensemble.append(r_sen)
-
-# Histogram of number of Republican Districts from the 2016 Presidential Election
-plt.figure()
-plt.hist(r_pres_ensemble)
-plt.savefig("histogram-presidential-republicans.jpg")
-
-# Can specify boundaries between bins to make your plot look a bit nicer
-plt.figure()
-plt.hist(r_pres_ensemble, bins=[9.5, 10.5, 11.5, 12.5, 13.5], edgecolor='black', color='red')
-plt.xticks([10, 11, 12, 13])
-plt.xlabel("Republican majority districts", fontsize=12)
-plt.ylabel("Ensembles", fontsize=12)
-plt.title("Histogram of Republican Districts by Votes in the 2016 Presidential Election",
-          fontsize=14)
-plt.savefig("histogram-presidential-republicans-clean.jpg", bbox_inches='tight')
 
-# And now a Histogram of number of Republican Districts from the 2016 Presidential Election
-plt.figure()
-plt.hist(r_sen_ensemble, bins=[9.5, 10.5, 11.5, 12.5, 13.5], edgecolor='black', color='red')
-plt.xticks([10, 11, 12, 13])
-plt.xlabel("Republican majority districts", fontsize=12)
-plt.ylabel("Ensembles", fontsize=12)
-plt.title("Histogram of Republican Districts by Votes in the 2016 Senate Election",
-          fontsize=14)
-plt.savefig("histogram-senate-republicans-clean.jpg", bbox_inches='tight')
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a recom ensemble for Pennsylvania")
+    parser.add_argument("--chains", type=int, default=1,
+                        help="number of independent chains to run")
+    parser.add_argument("--steps", type=int, default=100,
+                        help="steps per chain")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first chain; chain i uses seed + i")
+    parser.add_argument("--shared-seed-plan", action="store_true",
+                        help="start every chain from the same recursive_tree_part plan")
+    parser.add_argument("--output", default=None,
+                        help="directory to stream every step's plan and district tallies to")
+    parser.add_argument("--checkpoint-dir", default=None,
+                        help="directory to checkpoint each chain's state to")
+    parser.add_argument("--checkpoint-every", type=int, default=1000,
+                        help="steps between checkpoints")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue each chain from its last checkpoint")
+    parser.add_argument("--enacted-col", default="CD_2011",
+                        help="node attribute with the enacted plan to compare to the ensemble")
+    parser.add_argument("--summaries-only", action="store_true",
+                        help="keep only streaming summaries, not every step's seat counts")
+    parser.add_argument("--profile-dir", default=None,
+                        help="directory to save each chain's per-step timing profile to")
+    parser.add_argument("--progress", action="store_true",
+                        help="print each chain's steps per second while it runs")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="recom proposals drawn at once in worker processes for each chain")
+    parser.add_argument("--proposal", default="recom", choices=["recom", "reversible"],
+                        help="recom, or reversible recom (which needs --reversible-m)")
+    parser.add_argument("--reversible-m", type=int, default=30,
+                        help="reversible recom's bound on balanced cuts per spanning tree; must "
+                             "be at least the most any tree has, or the chain stops with an error")
+    parser.add_argument("--networkx-bipartition", action="store_true",
+                        help="split districts with gerrychain's bipartition_tree rather than "
+                             "bipartition.py's array version")
+    parser.add_argument("--diagnostics", action="store_true",
+                        help="report R-hat, effective sample size and autocorrelation of each "
+                             "chain's statistics")
+    parser.add_argument("--auto-stop", action="store_true",
+                        help="stop the chains once they have converged (implies --diagnostics); "
+                             "--steps is then the most each chain runs. Needs --chains of at "
+                             "least 2 and at least as many --processes")
+    parser.add_argument("--check-every", type=int, default=100,
+                        help="steps between convergence checks")
+    parser.add_argument("--rhat-target", type=float, default=1.05,
+                        help="--auto-stop once every statistic's R-hat is below this")
+    parser.add_argument("--ess-target", type=float, default=400,
+                        help="--auto-stop once every statistic's effective sample size is above "
+                             "this")
+    parser.add_argument("--min-steps", type=int, default=1000,
+                        help="steps every chain runs before --auto-stop can stop it")
+    args = parser.parse_args()
+
+    # Build the dual graph from the shapefile once; later runs memory-map the cached adjacency and
+    # the columns we use (population, the election results and the enacted plan) from
+    # PA/.graph_cache. The graph's node attributes read straight from those memory-mapped columns,
+    # which every chain's worker process shares
+    columns = ["TOTPOP"] + [col for cols in ELECTIONS.values() for col in cols]
+    columns.append(args.enacted_col)
+    pa_graph = shared_graph(load_graph("PA/PA.shp", columns = columns), columns)
+
+    # Set up random walk: population is balanced on TOTPOP, and every plan is scored on the 2016
+    # Presidential and Senate elections (see ensemble.ELECTIONS)
+    config = ChainConfig(num_dist = NUM_DIST,
+                         pop_col = "TOTPOP",
+                         pop_tolerance = POP_TOLERANCE, # How far from ideal population you can
+                                                        # deviate
+                         total_steps = args.steps,
+                         output_dir = args.output,
+                         checkpoint_dir = args.checkpoint_dir,
+                         checkpoint_every = args.checkpoint_every,
+                         analytics = True, # Seats, mean-median and efficiency gap summaries
+                         keep_seats = not args.summaries_only,
+                         profile_dir = args.profile_dir, # Where each step's time goes
+                         progress = args.progress,
+                         batch_size = args.batch_size, # Proposals drawn in parallel per step
+                         proposal = args.proposal,
+                         reversible_M = args.reversible_m,
+                         # Spanning trees and balanced cuts on arrays (see bipartition.py)
+                         fast_bipartition = not args.networkx_bipartition,
+                         # R-hat, ESS and autocorrelation of seats, cut edges and population
+                         # deviation, checked as the chains run (see diagnostics.py)
+                         diagnostics = args.diagnostics or args.auto_stop,
+                         auto_stop = args.auto_stop,
+                         check_every = args.check_every,
+                         rhat_target = args.rhat_target,
+                         ess_target = args.ess_target,
+                         min_steps = args.min_steps,
+                         node_repeats = 1) # Number of times to repeat bipartition.
+                                           # Can increase if you get a BipartitionWarning
+
+    # What ensembles we want to build:  We'll calculate number of R majority districts in the
+    # 2016 Presidential and Senate elections
+
+    # This actually runs the random walks. Each chain runs in its own process with its own seed;
+    # the results are merged, and result.chain records which chain each plan came from.
+    result = run_ensemble(pa_graph,
+                          config,
+                          num_chains = args.chains,
+                          seed = args.seed,
+                          processes = args.processes,
+                          distinct_seed_plans = not args.shared_seed_plan,
+                          resume = args.resume)
+    # With --auto-stop the chains may have run fewer than --steps steps
+    steps = result.diagnostics.steps() if result.diagnostics is not None else {}
+    for i, (seed, elapsed) in enumerate(zip(result.seeds, result.elapsed)):
+        print(f"Chain {i} (seed {seed}): {steps.get(i, args.steps)} steps in {elapsed:.1f}s")
+        profile = result.profiles[i]
+        if profile is not None:
+            print("    " + ", ".join(f"{phase} {100 * share:.0f}%"
+                                     for phase, share in profile["shares"].items()))
+
+    if result.diagnostics is not None:
+        print(result.diagnostics.report())
+
+    # Where the enacted plan falls in the ensemble for each election and metric
+    analytics = result.analytics
+    enacted_plan = {v: pa_graph.nodes[v][args.enacted_col] for v in pa_graph.nodes}
+    enacted = analytics.plan_scores(pa_graph, enacted_plan)
+    print(analytics.report(enacted))
+
+    if not args.summaries_only:
+        r_pres_ensemble = result.seats["Pres"]
+
+        # Histogram of number of Republican Districts from the 2016 Presidential Election
+        plt.figure()
+        plt.hist(r_pres_ensemble)
+        plt.savefig("histogram-presidential-republicans.jpg")
+
+    # The streaming histograms have one bin per number of seats the chain actually reached, so
+    # the bins no longer have to be picked by hand
+    for name, title in [("Pres", "Presidential"), ("Sen", "Senate")]:
+        edges, counts = analytics[name, "seats"].histogram.edges_and_counts()
+        centers = (edges[:-1] + edges[1:]) / 2
+        plt.figure()
+        plt.hist(centers, bins=edges, weights=counts, edgecolor='black', color='red')
+        plt.axvline(enacted[name]["seats"], color='black', linestyle='--',
+                    label=f"{args.enacted_col}")
+        plt.xticks(centers)
+        plt.xlabel("Republican majority districts", fontsize=12)
+        plt.ylabel("Ensembles", fontsize=12)
+        plt.title(f"Histogram of Republican Districts by Votes in the 2016 {title} Election",
+                  fontsize=14)
+        plt.legend()
+        plt.savefig(f"histogram-{title.lower()}-republicans-clean.jpg", bbox_inches='tight')
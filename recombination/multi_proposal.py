@@ -0,0 +1,336 @@
+"""
+A recom chain that draws several proposals at once in worker processes.
+
+Almost all of a recom step is drawing spanning trees of the two merged districts and looking for a
+balanced cut, and MarkovChain does that one proposal at a time, throwing the work away whenever the
+population constraint rejects the result. MultiProposalChain instead picks ``batch_size`` district
+pairs from the current plan and has a pool of workers split them all at once, then goes through
+the candidates in order: the first one that passes the constraints is the proposal. Taking the
+first valid one of a batch of independent proposals is the same as proposing again until one is
+valid, so the chain moves exactly like the one-proposal chain (with the same constraints and
+acceptance function), just with the trees drawn in parallel.
+
+When the chain stays where it is (the acceptance function turned a proposal down, or reversible
+recom proposed staying put), the candidates left over from the batch are still proposals from the
+current plan, so the next steps use them before drawing a new batch.
+
+Two proposals are supported:
+
+* ``"recom"``: gerrychain's recom (a random cut edge picks the districts to merge).
+* ``"reversible"``: gerrychain's reversible_recom (Cannon, Duchin, Randall and Rule), which is
+  reversible with a known stationary distribution. It often proposes staying put, so more of each
+  batch gets used. Its bound ``M`` has to be at least the number of balanced cuts any spanning tree
+  of two merged districts can have; a tree with more raises CutBoundError, since the chain's
+  distribution would no longer be the one promised. Tens (REVERSIBLE_M) is usually enough.
+
+With reversible recom, metropolis_accept weights the stationary distribution by a score. recom
+isn't reversible and its proposal probabilities aren't known, so with recom metropolis_accept only
+pushes the chain towards higher scores; it doesn't sample any known distribution.
+
+    chain = MultiProposalChain("TOTPOP", ideal_pop, 0.02, [population_constraint],
+                               metropolis_accept(compactness, beta=2), initial_partition,
+                               total_steps=10000, batch_size=8, proposal="reversible")
+    with chain:
+        for part in chain:
+            ...
+"""
+import math
+import multiprocessing as mp
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+from gerrychain import MarkovChain
+from gerrychain.tree import (bipartition_tree, epsilon_tree_bipartition,
+                             find_balanced_edge_cuts_memoization, uniform_spanning_tree,
+                             _bipartition_tree_random_all)
+from gerrychain.proposals.tree_proposals import ReversibilityError
+
+PROPOSALS = ["recom", "reversible"]
+# Default bound on balanced cuts per spanning tree for reversible recom
+REVERSIBLE_M = 30
+
+
+class CutBoundError(ReversibilityError):
+    """
+    A spanning tree had more balanced cuts than reversible recom's bound ``M``. Unlike gerrychain's
+    ReversibilityError it has a message, and can be sent back from a worker process.
+    """
+
+    def __init__(self, cuts, M):
+        super().__init__(f"Found {cuts} balanced cuts of one spanning tree, but reversible recom's "
+                         f"bound M is {M}. M must be at least the most balanced cuts a tree can "
+                         "have; rerun with a larger M (--reversible-m in main.py).")
+        self.cuts = cuts
+        self.M = M
+
+    def __str__(self):
+        return self.message
+
+
+def metropolis_accept(score, beta=1.0):
+    """
+    Metropolis acceptance weighting plans by exp(beta * score): a proposal is always accepted when
+    it scores at least as well as the current plan, and otherwise with probability
+    exp(beta * (new - current)). ``score`` maps a partition to a number, higher being better.
+    Works with MarkovChain as well.
+
+    There is no Hastings correction, so the chain targets (the proposal's stationary
+    distribution) x exp(beta * score) only for a reversible proposal such as reversible recom.
+    With plain recom it just favours higher scores, without a known target distribution.
+    """
+    last = {"partition": None, "score": None}
+
+    def current_score(partition):
+        if partition is not last["partition"]:
+            last["partition"], last["score"] = partition, score(partition)
+        return last["score"]
+
+    def accept(partition):
+        if partition.parent is None:
+            return True
+        new = score(partition)
+        delta = beta * (new - current_score(partition.parent))
+        if delta >= 0 or random.random() < math.exp(delta):
+            last["partition"], last["score"] = partition, new
+            return True
+        return False
+
+    return accept
+
+
+@dataclass
+class BatchStats:
+    """What the chain did with its proposals."""
+    batches: int = 0
+    proposals: int = 0
+    # Proposals that failed the constraints, or where no balanced cut was found
+    invalid: int = 0
+    failed: int = 0
+    # Steps that stayed put: reversible recom's self-loops and proposals the acceptance turned down
+    stayed: int = 0
+    accepted: int = 0
+    # Candidates thrown away because the plan they were drawn from had changed
+    unused: int = 0
+
+
+_GRAPH = None
+
+
+def _init_worker(graph):
+    global _GRAPH
+    _GRAPH = graph
+
+
+def _split(task):
+    """
+    Split the union of two districts like recom does, in a worker. Returns the nodes that go to
+    the first district (recom), every balanced cut of one uniform spanning tree (reversible), or
+    None if there was no balanced cut.
+    """
+    kind, seed, nodes, parts, pop_col, pop_target, epsilon, option, method = task
+    random.seed(seed)
+    subgraph = _GRAPH.subgraph(nodes)
+    if kind == "recom":
+        try:
+            flips = epsilon_tree_bipartition(subgraph, parts, pop_target = pop_target,
+                                             pop_col = pop_col, epsilon = epsilon,
+                                             node_repeats = option, method = method)
+        except RuntimeError:
+            return None
+        return [node for node, part in flips.items() if part == parts[0]]
+
+    def bounded(*args, **kwargs):
+        cuts = find_balanced_edge_cuts_memoization(*args, **kwargs)
+        if len(cuts) > option:
+            raise CutBoundError(len(cuts), option)
+        return cuts
+
+    cuts = _bipartition_tree_random_all(subgraph, pop_col = pop_col, pop_target = pop_target,
+                                        epsilon = epsilon, repeat_until_valid = False,
+                                        spanning_tree_fn = uniform_spanning_tree,
+                                        balance_edge_fn = bounded)
+    return [list(cut.subset) for cut in cuts] or None
+
+
+def _pair_edges(partition, a, b):
+    """Edges between districts ``a`` and ``b`` (found among the cut edges, not every edge)."""
+    mapping = partition.assignment.mapping
+    return [e for e in partition["cut_edges"] if {mapping[e[0]], mapping[e[1]]} == {a, b}]
+
+
+class MultiProposalChain(MarkovChain):
+    """
+    A MarkovChain over recom (or reversible recom, with ``proposal="reversible"``) that draws
+    ``batch_size`` proposals at a time on ``processes`` worker processes (default: one per
+    proposal, at most one per core). ``pop_col``, ``pop_target``, ``epsilon`` and ``node_repeats``
+    and ``method`` (e.g. bipartition.bipartition_tree_csr) are recom's arguments; ``M`` is
+    reversible_recom's bound on balanced cuts per tree (see CutBoundError).
+
+    Each proposal's random choices are seeded from the ``random`` module of the process running the
+    chain, so a seeded chain makes the same plans whatever the number of processes. The workers
+    are started on the first step; use the chain as a context manager (or call close()) to stop
+    them.
+    """
+
+    def __init__(self, pop_col, pop_target, epsilon, constraints, accept, initial_state,
+                 total_steps, batch_size=4, processes=None, node_repeats=1, proposal="recom",
+                 M=REVERSIBLE_M, method=bipartition_tree):
+        if proposal not in PROPOSALS:
+            raise ValueError(f"proposal must be one of {PROPOSALS}, not {proposal!r}")
+        super().__init__(None, constraints, accept, initial_state, total_steps)
+        self.pop_col = pop_col
+        self.pop_target = pop_target
+        self.epsilon = epsilon
+        self.batch_size = batch_size
+        self.node_repeats = node_repeats
+        self.kind = proposal
+        self.M = M
+        self.method = method
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.processes = max(1, min(processes, batch_size))
+        self.stats = BatchStats()
+        self._pool = None
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def discard_pending(self):
+        """
+        Forget the candidates left over from the last batch. They are still valid proposals, but
+        a chain that is checkpointed (see ensemble.run_chain) drops them at each checkpoint so a
+        resumed chain and an uninterrupted one make the same plans.
+        """
+        self.stats.unused += len(self._pending)
+        self._pending = []
+
+    def __iter__(self):
+        super().__iter__()
+        self._pending = []
+        return self
+
+    def _tasks(self, partition):
+        """
+        Make the random choices of ``batch_size`` proposals from ``partition``: which districts to
+        merge and the worker's seed. Returns (task or None for a self-loop, extra) pairs.
+        """
+        tasks = []
+        cut_edges = None
+        parts = sorted(partition.parts)
+        for _ in range(self.batch_size):
+            if self.kind == "recom":
+                if cut_edges is None:
+                    cut_edges = tuple(partition["cut_edges"])
+                edge = random.choice(cut_edges)
+                pair = sorted([partition.assignment.mapping[edge[0]],
+                               partition.assignment.mapping[edge[1]]])
+                option = self.node_repeats
+            else:
+                # reversible_recom: an ordered pair of districts, uniformly, and then one of the
+                # edges between them; unequal but not adjacent districts are a self-loop too
+                pair = [random.choice(parts), random.choice(parts)]
+                edges = _pair_edges(partition, *pair) if pair[0] != pair[1] else []
+                if not edges:
+                    tasks.append((None, pair))
+                    continue
+                edge = random.choice(edges)
+                pair = [partition.assignment.mapping[edge[0]],
+                        partition.assignment.mapping[edge[1]]]
+                option = self.M
+            nodes = list(partition.parts[pair[0]] | partition.parts[pair[1]])
+            tasks.append(((self.kind, random.getrandbits(64), nodes, pair, self.pop_col,
+                           self.pop_target, self.epsilon, option, self.method), pair))
+        return tasks
+
+    def _run(self, tasks):
+        work = [task for task, _ in tasks if task is not None]
+        if self.processes == 1:
+            # _split seeds the random module, which here is the chain's own
+            state = random.getstate()
+            _init_worker(self.state.graph.graph)
+            results = iter([_split(task) for task in work])
+            random.setstate(state)
+        else:
+            if self._pool is None:
+                context = (mp.get_context("fork") if "fork" in mp.get_all_start_methods()
+                           else mp.get_context())
+                self._pool = ProcessPoolExecutor(max_workers = self.processes,
+                                                 mp_context = context,
+                                                 initializer = _init_worker,
+                                                 initargs = (self.state.graph.graph,))
+            results = self._pool.map(_split, work)
+        return [(None if task is None else next(results), pair) for task, pair in tasks]
+
+    def _candidate(self, partition, result, pair):
+        """
+        Turn a worker's result into the proposed partition (``partition`` itself for a
+        self-loop), or None when there is no proposal.
+        """
+        if result is None:
+            # No edge between the districts (reversible) is a self-loop; no balanced cut is a
+            # self-loop for reversible recom and a failed proposal for recom
+            return partition if self.kind == "reversible" else None
+        if self.kind == "recom":
+            first = set(result)
+        else:
+            first = set(random.choice(result))
+        merged = partition.parts[pair[0]] | partition.parts[pair[1]]
+        flips = {node: pair[0] if node in first else pair[1] for node in merged}
+        proposed = partition.flip(flips)
+        if self.kind == "reversible":
+            seam = len(_pair_edges(proposed, *pair))
+            prob = len(result) / (self.M * seam)
+            if prob > 1:
+                raise CutBoundError(len(result), self.M * seam)
+            if random.random() >= prob:
+                return partition
+        return proposed
+
+    def _next_proposal(self):
+        """The next candidate proposal from the current state, drawing a new batch if needed."""
+        if not self._pending:
+            self._pending = self._run(self._tasks(self.state))
+            self.stats.batches += 1
+        result, pair = self._pending.pop(0)
+        self.stats.proposals += 1
+        return self._candidate(self.state, result, pair)
+
+    def __next__(self):
+        if self.counter == 0:
+            self.counter += 1
+            return self.state
+        while self.counter < self.total_steps:
+            proposed = self._next_proposal()
+            if proposed is None:
+                self.stats.failed += 1
+                continue
+            if proposed is self.state:
+                self.stats.stayed += 1
+                self.counter += 1
+                return self.state
+            if not self.is_valid(proposed):
+                self.stats.invalid += 1
+                continue
+            if self.accept(proposed):
+                self.stats.accepted += 1
+                # Erase the parent of the parent, to avoid memory leak
+                self.state.parent = None
+                self.state = proposed
+                self.stats.unused += len(self._pending)
+                self._pending = []
+            else:
+                self.stats.stayed += 1
+            self.counter += 1
+            return self.state
+        raise StopIteration
@@ -0,0 +1,176 @@
+"""
+Node attributes kept in shared memory instead of in every worker's copy of the graph.
+
+A networkx graph stores each node's attributes as a dict of Python objects, so a graph with dozens
+of attributes per node is hundreds of MB, and forked workers end up copying it: just reading an
+attribute updates the object's reference count, which writes to the page it lives on. SharedColumns
+keeps only the columns a chain needs (population, vote counts, coordinates, ...) as typed NumPy
+arrays in one block of ``multiprocessing.shared_memory``, or memory-mapped from the graph_cache
+files, and shared_graph builds a graph whose node attribute dicts are small read-only views into
+those arrays. Every worker then reads the same physical pages, and gerrychain's Tally and anything
+else that does ``graph.nodes[node][column]`` works unchanged.
+
+    graph = shared_graph(load_graph("PA/PA.shp", columns = columns), columns)
+    run_ensemble(graph, config, num_chains = 64)
+
+The views can't be written to; attributes a script adds later need a graph of its own.
+"""
+import atexit
+import os
+from collections.abc import Mapping
+from multiprocessing import shared_memory
+
+import numpy as np
+from gerrychain import Graph
+
+from graph_cache import CachedGraph, _column_array
+
+# Column offsets in the shared block are rounded up to this many bytes
+ALIGNMENT = 64
+
+
+class NodeAttributes(Mapping):
+    """The attributes of node ``i`` of a SharedColumns, as a read-only dict."""
+    __slots__ = ["store", "i"]
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    def __getitem__(self, name):
+        return self.store[name][self.i].item()
+
+    def __iter__(self):
+        return iter(self.store.names)
+
+    def __len__(self):
+        return len(self.store.names)
+
+    def __contains__(self, name):
+        return name in self.store.arrays
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return NodeAttributes, (self.store, self.i)
+
+
+class SharedColumns:
+    """
+    Node attribute columns as arrays, one entry per node of ``nodes`` (in that order), either in a
+    shared memory block (``create``) or memory-mapped from a graph_cache entry (``from_cache``).
+    ``store[name]`` is a column, ``store.node(i)`` a node's attributes.
+
+    Pickling sends only where the arrays are, so a spawned worker attaches to the same memory.
+    The process that created a shared block should ``unlink()`` it when done (it is also unlinked
+    when that process exits).
+    """
+
+    def __init__(self, nodes, arrays, spec, shm=None, owner=False):
+        self.nodes = nodes
+        self.arrays = arrays
+        self.names = list(arrays)
+        self.spec = spec
+        self._shm = shm
+        # Forked workers inherit the creator's object (and its atexit hook) but don't own the block
+        self._owner = os.getpid() if owner else None
+
+    @classmethod
+    def create(cls, graph, columns):
+        """Copy ``columns`` of every node of ``graph`` into a new shared memory block."""
+        nodes = list(graph.nodes)
+        values = {name: _column_array([graph.nodes[n].get(name) for n in nodes])
+                  for name in columns}
+        layout = []
+        size = 0
+        for name, array in values.items():
+            layout.append((name, array.dtype.str, size))
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        spec = ("shm", shm.name, len(nodes), layout)
+        arrays = cls._map(shm.buf, len(nodes), layout)
+        for name, array in values.items():
+            arrays[name][:] = array
+            arrays[name].flags.writeable = False
+        store = cls(nodes, arrays, spec, shm, owner=True)
+        atexit.register(store.unlink)
+        return store
+
+    @classmethod
+    def from_cache(cls, cached, columns):
+        """Memory-map ``columns`` of a graph_cache.CachedGraph, which are already files on disk."""
+        spec = ("cache", cached.directory, list(columns))
+        return cls(cached.nodes.tolist(), {name: cached[name] for name in columns}, spec)
+
+    @staticmethod
+    def _map(buf, n, layout):
+        return {name: np.ndarray((n,), dtype=np.dtype(dtype), buffer=buf, offset=offset)
+                for name, dtype, offset in layout}
+
+    @classmethod
+    def _attach(cls, nodes, spec):
+        if spec[0] == "cache":
+            return cls.from_cache(CachedGraph(spec[1]), spec[2])
+        _, name, n, layout = spec
+        # Worker processes share their parent's resource tracker, so attaching here doesn't make
+        # the block outlive (or die with) this process
+        shm = shared_memory.SharedMemory(name=name)
+        arrays = cls._map(shm.buf, n, layout)
+        for array in arrays.values():
+            array.flags.writeable = False
+        return cls(nodes, arrays, spec, shm)
+
+    def __reduce__(self):
+        return SharedColumns._attach, (self.nodes, self.spec)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def node(self, i):
+        return NodeAttributes(self, i)
+
+    def unlink(self):
+        """Free the shared block (creator only). Views already handed out must not be used."""
+        if self._shm is None or self._owner != os.getpid():
+            return
+        self.arrays = {}
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+        self._shm = None
+
+
+def shared_graph(source, columns):
+    """
+    A gerrychain Graph with the nodes and edges of ``source`` (a Graph, or a graph_cache
+    CachedGraph) whose node attributes are ``columns`` only, read from shared arrays: the
+    CachedGraph's memory-mapped files, or a new shared memory block for a Graph. Edge attributes
+    are dropped. ``graph.graph["shared_columns"]`` is the SharedColumns behind it.
+    """
+    if isinstance(source, CachedGraph):
+        store = SharedColumns.from_cache(source, columns)
+    else:
+        store = SharedColumns.create(source, columns)
+    graph = Graph()
+    graph.add_nodes_from(store.nodes)
+    # networkx hands out these mappings as the node attribute dicts
+    for i, node in enumerate(store.nodes):
+        graph._node[node] = store.node(i) # pylint: disable=protected-access
+    if isinstance(source, CachedGraph):
+        u, v = source.edges()
+        graph.add_edges_from((store.nodes[a], store.nodes[b])
+                             for a, b in zip(u.tolist(), v.tolist()))
+    else:
+        graph.add_edges_from(source.edges)
+    graph.graph["shared_columns"] = store
+    return graph
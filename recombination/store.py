@@ -0,0 +1,197 @@
+"""
+Streaming on-disk store for chain runs. Every step's district assignment (as a small integer vector)
+and per-district tallies are buffered and written out in chunks as compressed .npz shards, so memory
+stays bounded and a killed run keeps everything up to its last shard. EnsembleReader iterates over
+or random-accesses steps one shard at a time, which is enough to compute new metrics and their
+histograms long after the chain has finished.
+"""
+import glob
+import json
+import os
+
+import numpy as np
+
+
+def _assignment_dtype(num_parts):
+    return np.int8 if num_parts <= np.iinfo(np.int8).max else np.int16
+
+
+def _write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+class EnsembleWriter:
+    """
+    Append-only writer for one chain's steps. ``nodes`` fixes the order of the assignment vectors,
+    ``parts`` the district labels they index into and ``columns`` the names of the tally columns.
+
+    Use as a context manager (or call ``close``) so the last partial shard gets written.
+    """
+
+    def __init__(self, directory, nodes, parts, columns, chunk_size=1000, metadata=None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.dtype = _assignment_dtype(len(parts))
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "nodes.npy"), np.asarray(nodes))
+        self.meta = {"parts": list(parts),
+                     "columns": list(columns),
+                     "chunk_size": chunk_size,
+                     "num_steps": 0,
+                     "shards": [],
+                     "metadata": metadata or {}}
+        self._assignments = []
+        self._totals = []
+        _write_json(self._meta_path, self.meta)
+
+    @classmethod
+    def reopen(cls, directory, num_steps):
+        """
+        Continue writing a store after its first ``num_steps`` steps, dropping any shards written
+        past that point (e.g. after the checkpoint a resumed chain restarts from).
+        """
+        writer = cls.__new__(cls)
+        writer.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            writer.meta = json.load(f)
+        writer.chunk_size = writer.meta["chunk_size"]
+        writer.dtype = _assignment_dtype(len(writer.meta["parts"]))
+        kept = [s for s in writer.meta["shards"] if s["start"] + s["count"] <= num_steps]
+        if sum(s["count"] for s in kept) != num_steps:
+            raise ValueError(f"{directory} has no shard boundary at step {num_steps}")
+        dropped = writer.meta["shards"][len(kept):]
+        writer.meta["shards"] = kept
+        writer.meta["num_steps"] = num_steps
+        _write_json(writer._meta_path, writer.meta)
+        for shard in dropped:
+            os.remove(os.path.join(directory, shard["file"]))
+        writer._assignments = []
+        writer._totals = []
+        return writer
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.directory, "meta.json")
+
+    def __len__(self):
+        return self.meta["num_steps"] + len(self._assignments)
+
+    def append(self, assignment, totals):
+        """
+        Record one step: ``assignment[i]`` is the index (into ``parts``) of node i's district and
+        ``totals`` the (districts x columns) tally array.
+        """
+        self._assignments.append(np.asarray(assignment, dtype=self.dtype))
+        self._totals.append(np.array(totals, dtype=np.float64))
+        if len(self._assignments) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered steps out as a new shard."""
+        if not self._assignments:
+            return
+        start = self.meta["num_steps"]
+        name = f"shard-{len(self.meta['shards']):06d}.npz"
+        tmp = os.path.join(self.directory, name + ".tmp.npz")
+        np.savez_compressed(tmp,
+                            assignment=np.stack(self._assignments),
+                            totals=np.stack(self._totals))
+        os.replace(tmp, os.path.join(self.directory, name))
+        self.meta["shards"].append({"file": name, "start": start,
+                                    "count": len(self._assignments)})
+        self.meta["num_steps"] = start + len(self._assignments)
+        # The shard is only part of the store once meta.json lists it
+        _write_json(self._meta_path, self.meta)
+        self._assignments = []
+        self._totals = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EnsembleReader:
+    """
+    Read-only view of a store written by EnsembleWriter. Only one shard is held in memory at a time.
+
+    ``reader[i]`` is ``(assignment, totals)`` for step i; iterating yields the same for every step.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.nodes = np.load(os.path.join(directory, "nodes.npy"))
+        self.parts = self.meta["parts"]
+        self.columns = self.meta["columns"]
+        self.column_index = {name: j for j, name in enumerate(self.columns)}
+        self._starts = np.array([s["start"] for s in self.meta["shards"]], dtype=np.int64)
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.meta["num_steps"]
+
+    def _shard(self, k):
+        if self._cached[0] != k:
+            with np.load(os.path.join(self.directory, self.meta["shards"][k]["file"])) as data:
+                self._cached = (k, (data["assignment"], data["totals"]))
+        return self._cached[1]
+
+    def __getitem__(self, step):
+        if step < 0:
+            step += len(self)
+        if not 0 <= step < len(self):
+            raise IndexError(f"step {step} out of range for a store of {len(self)} steps")
+        k = int(np.searchsorted(self._starts, step, side="right")) - 1
+        assignment, totals = self._shard(k)
+        i = step - self._starts[k]
+        return assignment[i], totals[i]
+
+    def shards(self):
+        """Yield ``(assignments, totals)`` blocks, one per shard, in step order."""
+        for k in range(len(self.meta["shards"])):
+            yield self._shard(k)
+
+    def __iter__(self):
+        for assignments, totals in self.shards():
+            yield from zip(assignments, totals)
+
+    def assignment_dict(self, step):
+        """The plan at ``step`` as a node -> district label dictionary, e.g. for a Partition."""
+        assignment, _ = self[step]
+        return dict(zip(self.nodes.tolist(), np.asarray(self.parts)[assignment].tolist()))
+
+    def metric(self, fn):
+        """
+        Evaluate a per-step metric over the whole run, a shard at a time. ``fn`` gets a
+        ``(steps x districts x columns)`` block of totals plus the column index and returns one
+        value per step.
+        """
+        values = [np.asarray(fn(totals, self.column_index)) for _, totals in self.shards()]
+        return np.concatenate(values) if values else np.zeros(0)
+
+    def seats_won(self, a, b):
+        """Per-step number of districts where column ``a`` beats column ``b``."""
+        return self.metric(lambda totals, col: (totals[:, :, col[a]] > totals[:, :, col[b]])
+                           .sum(axis=1))
+
+    def histogram(self, fn, bins):
+        """np.histogram of ``fn`` (see ``metric``), summed shard by shard over fixed bin edges."""
+        edges = np.asarray(bins, dtype=np.float64)
+        counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        for _, totals in self.shards():
+            counts += np.histogram(fn(totals, self.column_index), bins=edges)[0]
+        return counts, edges
+
+
+def open_chains(directory):
+    """Readers for every per-chain store (``chain-*``) under an ensemble output directory."""
+    return [EnsembleReader(path) for path in sorted(glob.glob(os.path.join(directory, "chain-*")))]
@@ -0,0 +1,86 @@
+"""
+Vectorized district tallies. Node attributes (population, votes, ...) are held as one
+(nodes x columns) NumPy array and district totals as a (districts x columns) array, which is updated
+from just the nodes that changed district at each chain step. Counting seats for any number of
+elections is then a single comparison over the totals array.
+"""
+import numpy as np
+
+
+class DistrictTally:
+    """
+    Running per-district sums of node attribute ``columns`` for a districting plan.
+
+    ``tally[column]`` is the vector of district totals for one column, in the order of
+    ``tally.parts`` (the district labels).
+    """
+
+    def __init__(self, graph, columns, assignment, parts=None):
+        self.nodes = list(graph.nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        self.columns = list(columns)
+        self.column_index = {name: j for j, name in enumerate(self.columns)}
+        self.values = np.array([[graph.nodes[node][name] for name in self.columns]
+                                for node in self.nodes], dtype=np.float64)
+        self.values = self.values.reshape(len(self.nodes), len(self.columns))
+
+        if parts is None:
+            parts = sorted(set(assignment[node] for node in self.nodes))
+        self.parts = list(parts)
+        self.part_index = {part: k for k, part in enumerate(self.parts)}
+        self._last = None
+        self.reset(assignment)
+
+    @classmethod
+    def from_partition(cls, partition, columns):
+        """Tally ``columns`` over the districts of a gerrychain Partition."""
+        tally = cls(partition.graph, columns, partition.assignment, parts=sorted(partition.parts))
+        tally._last = partition
+        return tally
+
+    def reset(self, assignment):
+        """Recompute every district total from a full node -> district assignment."""
+        self.assignment = np.fromiter((self.part_index[assignment[node]] for node in self.nodes),
+                                      dtype=np.int64, count=len(self.nodes))
+        self.totals = np.zeros((len(self.parts), len(self.columns)))
+        np.add.at(self.totals, self.assignment, self.values)
+
+    def update(self, flips):
+        """Move the nodes in ``flips`` (node -> new district) and adjust the totals they touch."""
+        idx = np.fromiter((self.node_index[node] for node in flips), dtype=np.int64,
+                          count=len(flips))
+        new = np.fromiter((self.part_index[part] for part in flips.values()), dtype=np.int64,
+                          count=len(flips))
+        old = self.assignment[idx]
+        # recom reports every node of the two merged districts; most of them stay put
+        moved = old != new
+        idx, old, new = idx[moved], old[moved], new[moved]
+        np.subtract.at(self.totals, old, self.values[idx])
+        np.add.at(self.totals, new, self.values[idx])
+        self.assignment[idx] = new
+
+    def follow(self, partition):
+        """
+        Bring the tally in line with ``partition``, the state a MarkovChain just yielded. Uses the
+        partition's flips when it is a child of the last state seen, and is a no-op when the chain
+        yields the same state twice (a rejected proposal).
+        """
+        if partition is self._last:
+            return
+        if partition.parent is not None and partition.parent is self._last:
+            self.update(partition.flips)
+        else:
+            self.reset(partition.assignment)
+        self._last = partition
+
+    def __getitem__(self, column):
+        return self.totals[:, self.column_index[column]]
+
+    def seats_won(self, elections):
+        """
+        Number of districts where the first column beats the second, for each ``(a, b)`` pair of
+        columns in ``elections`` (e.g. ``[("T16PRESR", "T16PRESD"), ("T16SENR", "T16SEND")]``).
+        """
+        a = [self.column_index[a] for a, _ in elections]
+        b = [self.column_index[b] for _, b in elections]
+        return (self.totals[:, a] > self.totals[:, b]).sum(axis=0)
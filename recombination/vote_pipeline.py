@@ -0,0 +1,248 @@
+"""
+Put precinct election results onto the nodes of a dual graph.
+
+Election results come by precinct, and the dual graph's nodes (VTDs, block groups, ...) don't line
+up with the precincts. Each precinct's votes are split among the nodes it overlaps, either by area
+(the share of the precinct's area inside each node) or by population (the share of its residents,
+from a finer layer such as census blocks, living in each node). Those shares only depend on the
+geometry, so they are worked out once, with a shapely STRtree to find the overlapping pairs, and
+saved as a sparse (nodes x precincts) matrix next to the dual graph cache. Putting any number of
+elections on the graph is then one sparse matrix product:
+
+    weights = precinct_weights("precincts.shp", "PA/PA.shp", precinct_key = "PRECINCT")
+    results = read_results("results.csv", "PRECINCT")
+    node_votes = weights.apply(results, ["G20PRER", "G20PRED", "G20USSR", "G20USSD"])
+
+From the command line, the new columns go straight into PA/PA.shp's graph_cache entry, so
+main.py's load_graph(..., columns = [...]) picks them up like any other attribute:
+
+    $ python vote_pipeline.py --precincts precincts.shp --precinct-key PRECINCT \\
+          --results results.csv --columns G20PRER G20PRED --units PA/PA.shp
+"""
+import argparse
+import hashlib
+import json
+import os
+import warnings
+from dataclasses import dataclass
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import shapely
+
+from graph_cache import CACHE_DIR, add_node_columns, hash_files, load_graph, source_files
+
+METHODS = ["area", "population"]
+
+
+def _projected(frame):
+    """``frame`` in a projected CRS, so areas are in square metres rather than degrees."""
+    if frame.crs is not None and frame.crs.is_geographic:
+        return frame.to_crs(frame.estimate_utm_crs())
+    return frame
+
+
+def _normalize(matrix):
+    """Scale each precinct's column to sum to one (columns with nothing in them stay zero)."""
+    matrix = matrix.tocsc()
+    sums = np.asarray(matrix.sum(axis=0)).ravel()
+    scale = np.divide(1.0, sums, out=np.zeros_like(sums), where=sums > 0)
+    return (matrix @ sp.diags(scale)).tocsr()
+
+
+def areal_weights(precincts, units):
+    """
+    (units x precincts) sparse matrix of the share of each precinct's area inside each unit.
+    ``precincts`` and ``units`` are GeoSeries in the same projected CRS.
+    """
+    tree = shapely.STRtree(precincts.values)
+    unit_idx, precinct_idx = tree.query(units.values, predicate="intersects")
+    areas = shapely.area(shapely.intersection(units.values[unit_idx],
+                                              precincts.values[precinct_idx]))
+    matrix = sp.coo_matrix((areas, (unit_idx, precinct_idx)),
+                           shape=(len(units), len(precincts)))
+    matrix.eliminate_zeros()
+    return _normalize(matrix)
+
+
+def _locate(points, regions):
+    """Index of the region each point is in (the first one, on a shared border), or -1."""
+    tree = shapely.STRtree(regions.values)
+    point_idx, region_idx = tree.query(points.values, predicate="within")
+    # One match per point, for the rare point on the border of two regions
+    points_found, first = np.unique(point_idx, return_index=True)
+    located = np.full(len(points), -1, dtype=np.int64)
+    located[points_found] = region_idx[first]
+    return located
+
+
+def population_weights(precincts, units, blocks, populations):
+    """
+    (units x precincts) sparse matrix of the share of each precinct's population living in each
+    unit, placing each of ``blocks`` (with ``populations``) by a point inside it. Precincts with
+    no population in ``blocks`` are split by area instead.
+    """
+    points = blocks.representative_point()
+    in_precinct = _locate(points, precincts)
+    in_unit = _locate(points, units)
+    placed = (in_precinct >= 0) & (in_unit >= 0)
+    matrix = sp.coo_matrix((np.asarray(populations, dtype=np.float64)[placed],
+                            (in_unit[placed], in_precinct[placed])),
+                           shape=(len(units), len(precincts)))
+    matrix = _normalize(matrix)
+    empty = np.flatnonzero(np.asarray(matrix.sum(axis=0)).ravel() == 0)
+    if len(empty):
+        # The area weights of the empty precincts, moved to their columns
+        spread = sp.csr_matrix((np.ones(len(empty)), (np.arange(len(empty)), empty)),
+                               shape=(len(empty), len(precincts)))
+        matrix = matrix + areal_weights(precincts.iloc[empty], units) @ spread
+    return matrix.tocsr()
+
+
+@dataclass
+class PrecinctWeights:
+    """
+    ``matrix[i, j]`` is the share of precinct ``precincts[j]``'s votes that goes to dual graph node
+    ``units[i]``. Each column sums to one, except for precincts that overlap no node at all.
+    """
+    matrix: sp.csr_matrix
+    precincts: list
+    units: list
+
+    def unplaced(self):
+        """Precincts whose votes go to no node."""
+        sums = np.asarray(self.matrix.sum(axis=0)).ravel()
+        return [p for p, total in zip(self.precincts, sums) if total == 0]
+
+    def apply(self, results, columns):
+        """
+        Node totals (a DataFrame indexed by ``units``) of ``columns`` of ``results``, a DataFrame
+        indexed by precinct, as one sparse product for all the columns at once.
+        """
+        missing = [p for p in self.precincts if p not in results.index]
+        if missing:
+            raise KeyError(f"{len(missing)} precincts have no results, e.g. {missing[:5]}")
+        extra = len(results.index.difference(pd.Index(self.precincts)))
+        if extra:
+            warnings.warn(f"{extra} precincts in the results have no geometry; their votes are "
+                          "left out")
+        values = results.loc[self.precincts, list(columns)].to_numpy(dtype=np.float64)
+        return pd.DataFrame(self.matrix @ values, index=self.units, columns=list(columns))
+
+    def save(self, path):
+        np.savez_compressed(path, data=self.matrix.data, indices=self.matrix.indices,
+                            indptr=self.matrix.indptr, shape=self.matrix.shape,
+                            precincts=np.asarray(self.precincts), units=np.asarray(self.units))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            matrix = sp.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+            return cls(matrix, f["precincts"].tolist(), f["units"].tolist())
+
+
+def compute_weights(precincts, units, precinct_key, method="area", blocks=None, pop_col=None):
+    """
+    PrecinctWeights from GeoDataFrames: ``precincts`` (identified by their ``precinct_key``
+    column) onto ``units``, whose index is the dual graph's node labels (as it is for a graph read
+    with Graph.from_file). ``method="population"`` needs ``blocks`` with a ``pop_col`` column.
+    """
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}, not {method!r}")
+    units = _projected(units)
+    precincts = precincts.to_crs(units.crs) if units.crs is not None else precincts
+    if method == "area":
+        matrix = areal_weights(precincts.geometry, units.geometry)
+    else:
+        if blocks is None or pop_col is None:
+            raise ValueError("Population weights need blocks and their population column")
+        blocks = blocks.to_crs(units.crs) if units.crs is not None else blocks
+        matrix = population_weights(precincts.geometry, units.geometry, blocks.geometry,
+                                    blocks[pop_col])
+    weights = PrecinctWeights(matrix, precincts[precinct_key].tolist(), units.index.tolist())
+    unplaced = weights.unplaced()
+    if unplaced:
+        warnings.warn(f"{len(unplaced)} precincts overlap no node, e.g. {unplaced[:5]}")
+    return weights
+
+
+def precinct_weights(precinct_path, unit_path, precinct_key, method="area", block_path=None,
+                     pop_col=None, cache_dir=None):
+    """
+    PrecinctWeights for the precinct shapefile ``precinct_path`` onto the dual graph built from
+    ``unit_path``, cached in the dual graph's cache directory. The cache entry is keyed on the
+    contents of every geometry file and the options, so it is recomputed if any of them change.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(unit_path), CACHE_DIR)
+    paths = source_files(precinct_path) + source_files(unit_path)
+    if block_path is not None:
+        paths += source_files(block_path)
+    options = json.dumps([precinct_key, method, pop_col])
+    digest = hashlib.sha256((hash_files(paths) + options).encode()).hexdigest()
+    stem = os.path.splitext(os.path.basename(unit_path))[0]
+    path = os.path.join(cache_dir, f"{stem}-weights-{digest[:16]}.npz")
+    if os.path.exists(path):
+        return PrecinctWeights.load(path)
+
+    blocks = gpd.read_file(block_path) if block_path is not None else None
+    weights = compute_weights(gpd.read_file(precinct_path), gpd.read_file(unit_path), precinct_key,
+                              method, blocks, pop_col)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written under a temporary name first, so a killed run doesn't leave a broken entry
+    tmp = path[:-len(".npz")] + ".tmp.npz"
+    weights.save(tmp)
+    os.replace(tmp, path)
+    return weights
+
+
+def read_results(path, precinct_key, total=None, shares=()):
+    """
+    A precinct results CSV as a DataFrame indexed by ``precinct_key``. Columns listed in ``shares``
+    are fractions of the ``total`` column (like WaterburySampleData.csv's candidate columns) and are
+    turned into vote counts.
+    """
+    results = pd.read_csv(path).set_index(precinct_key)
+    for column in shares:
+        results[column] = results[column] * results[total]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Put precinct election results onto a dual "
+                                                 "graph's nodes")
+    parser.add_argument("--precincts", required=True,
+                        help="precinct shapefile (or any file geopandas can read)")
+    parser.add_argument("--precinct-key", required=True,
+                        help="column naming each precinct, in both the shapefile and the results")
+    parser.add_argument("--results", required=True,
+                        help="CSV of results by precinct")
+    parser.add_argument("--columns", nargs="+", required=True,
+                        help="result columns to put on the graph")
+    parser.add_argument("--share-of", default=None,
+                        help="total votes column, if --columns are shares of it")
+    parser.add_argument("--units", default="PA/PA.shp",
+                        help="the dual graph's shapefile")
+    parser.add_argument("--method", default="area", choices=METHODS,
+                        help="split precincts among nodes by area or by population")
+    parser.add_argument("--blocks", default=None,
+                        help="shapefile of small units with populations, for --method population")
+    parser.add_argument("--pop-col", default="TOTPOP",
+                        help="population column of --blocks")
+    args = parser.parse_args()
+
+    weights = precinct_weights(args.precincts, args.units, args.precinct_key, args.method,
+                               args.blocks, args.pop_col if args.blocks else None)
+    results = read_results(args.results, args.precinct_key, args.share_of,
+                           args.columns if args.share_of else ())
+    node_votes = weights.apply(results, args.columns)
+
+    cached = load_graph(args.units, columns = [])
+    labels = cached.nodes.tolist()
+    cached = add_node_columns(cached, {name: node_votes[name].loc[labels].to_numpy()
+                                       for name in args.columns})
+    for name in args.columns:
+        print(f"{name}: {results[name].sum():,.0f} votes in the results, "
+              f"{np.asarray(cached[name]).sum():,.0f} on the graph")